@@ -26,3 +26,13 @@ FACADE_ANALYSIS_PROMPT = """
 """
 
 GENERAL_ANALYSIS_PROMPT = "分析这张建筑图片。请用中文详细描述它的风格、材质、光照、构图以及核心建筑特征，以便于重新生成类似的图像。"
+
+# 组合模式“先描述参考图”阶段使用的提示词
+REFERENCE_ANALYSIS_PROMPT = "请详细描述这张图片的视觉特征、构图、材质和光照，用于指导AI重新生成类似的画面。"
+
+# analysis_type -> prompt for /api/analyze-image, resolved once instead of per request
+ANALYSIS_PROMPTS = {
+    "scene": SCENE_ANALYSIS_PROMPT,
+    "facade": FACADE_ANALYSIS_PROMPT,
+    "general": GENERAL_ANALYSIS_PROMPT,
+}
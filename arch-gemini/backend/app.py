@@ -1,21 +1,123 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
-import uvicorn
+from typing import Callable, Optional, List
+from contextlib import asynccontextmanager
 import asyncio
+import base64
+import json
 
 # Import services
 from services.qwen_service import optimize_prompt, translate_error
-from services.gemini_gen import generate_image
-from services.gemini_vision import analyze_image
-from core.logger import log_request
+from services import qwen_service
+from services.gemini_gen import generate_image, generate_image_stream, generate_image_variants, generation_router
+from services.gemini_vision import analyze_image, analysis_cache
+from core.logger import ensure_db, log_request, request_log_writer
+from core.http_client import http_client
+from core.config import print_config, settings
+from core.jobs import JobManager, JobQueueFull
+from core import history, derivatives
+from core.limiter import Overloaded, get_limiter, limiter_stats
+from core.metrics import MetricsMiddleware, loop_lag_monitor, metrics, span
+from core.fairness import RateLimited, admit, client_slot, clients, resolution_cost
+from core.shared_state import shared_state, state_stats, state_sync
+from core.dedup import IdempotencyConflict, SharedCodec, fingerprint, generation_dedup, idempotency_key
+from analysis_prompts import ANALYSIS_PROMPTS, GENERAL_ANALYSIS_PROMPT
+from services.image_preprocess import PreprocessReport, max_edge_for, preprocess_images, preprocess_raw
+from services.gemini_files import gemini_files
+from services.generation_cache import generation_cache
+from core.blobs import blob_store
+from core.uploads import BodyLimitMiddleware, OffsetMismatch, UploadTooLarge, resumable_uploads, too_large_detail
 
-app = FastAPI(title="ArchGemini API")
+# Background generation jobs (submit / poll / stream)
+job_manager = JobManager(
+    workers=settings.JOB_WORKERS,
+    queue_size=settings.JOB_QUEUE_SIZE,
+    result_ttl=settings.JOB_RESULT_TTL,
+    # Snapshots let any worker answer /api/jobs/{id} under `uvicorn --workers N`
+    store=shared_state if shared_state.distributed else None,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup work lives here rather than at import, so importing the app stays cheap
+    print_config()
+    await asyncio.to_thread(ensure_db)
+    # Per-upstream connection pools, pre-warmed in the background
+    await http_client.start()
+    await job_manager.start()
+    loop_lag_monitor.start()
+    # Exchange API key cooldowns with the other worker processes
+    state_sync.start()
+    # Render thumbnails/previews in the background as soon as a backup is saved
+    request_log_writer.add_image_listener(derivatives.schedule_all)
+    yield
+    await state_sync.stop()
+    await loop_lag_monitor.stop()
+    await job_manager.stop()
+    # Flush queued request logs and image backups before exiting
+    await asyncio.to_thread(request_log_writer.close)
+    await asyncio.to_thread(derivatives.shutdown)
+    await http_client.close()
+    await shared_state.close()
+
+app = FastAPI(title="ArchGemini API", lifespan=lifespan)
+
+# Concurrency Control
+# Each route has its own adaptive limit with a bounded wait queue (see core/limiter.py),
+# so a burst of 4K generations can't starve cheap prompt optimisation.
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "服务器繁忙，请稍后重试。"},
+        headers={"Retry-After": str(int(exc.retry_after + 0.999))},
+    )
+
+# Per-client token buckets (core/fairness.py); the route queues above are also
+# weighted-fair per client, so one heavy user can't starve the rest of the team.
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "请求过于频繁，请稍后再试。"},
+        headers={"Retry-After": str(int(exc.retry_after + 0.999))},
+    )
 
-# Concurrency Control (Semaphore)
-# Allow up to 10 concurrent heavy tasks (generation/analysis) to avoid excessive queuing/overload
-HEAVY_TASK_SEMAPHORE = asyncio.Semaphore(10)
+# Idempotency-Key reused for a different request body (core/dedup.py)
+@app.exception_handler(IdempotencyConflict)
+async def idempotency_conflict_handler(request: Request, exc: IdempotencyConflict):
+    return JSONResponse(
+        status_code=422,
+        content={"detail": "该 Idempotency-Key 已用于不同的请求内容。"},
+    )
+
+# Upload past its size cap (core/uploads.py)
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request: Request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"detail": too_large_detail(exc.limit)})
+
+# Resumable upload chunk sent for the wrong offset; the client resumes from `offset`
+@app.exception_handler(OffsetMismatch)
+async def offset_mismatch_handler(request: Request, exc: OffsetMismatch):
+    return JSONResponse(
+        status_code=409,
+        content={"detail": "上传进度不一致，请从返回的 offset 继续上传。", "offset": exc.offset},
+    )
+
+# Refuse oversized uploads before (or while) the body is read
+app.add_middleware(
+    BodyLimitMiddleware,
+    limits={
+        "/api/analyze-image": settings.ANALYZE_UPLOAD_MAX_BYTES,
+        "/api/uploads": settings.UPLOAD_MAX_REQUEST_BYTES,
+    },
+)
+
+# Request timing per route template (see /metrics)
+app.add_middleware(MetricsMiddleware)
 
 # CORS
 app.add_middleware(
@@ -34,104 +136,612 @@ class GenerateRequest(BaseModel):
     aspect_ratio: str = "16:9"
     resolution: str = "1K" # 1K, 2K, 4K
     images: List[str] = [] # List of base64 strings
+    image_handles: List[str] = [] # Handles from /api/uploads, sent after `images`
+    describe_references: bool = False # Analyze references and add their descriptions to the prompt
+    force_fresh: bool = False # Skip the generation cache (GENERATION_CACHE_ENABLED) and render again
+
+def _parse_data_url_images(images: List[str]) -> List[dict]:
+    """Split `data:<mime>;base64,<data>` strings into mime_type and data."""
+    processed_images = []
+    for img in images:
+        mime_type = "image/jpeg"
+        data = img
+
+        if "base64," in img:
+            # Format: data:image/png;base64,.....
+            parts = img.split("base64,")
+            data = parts[1]
+
+            # Extract mime type from parts[0]
+            # parts[0] looks like "data:image/png;"
+            if "data:" in parts[0] and ";" in parts[0]:
+                mime_type = parts[0].split("data:")[1].split(";")[0]
+
+        processed_images.append({
+            "data": data,
+            "mime_type": mime_type
+        })
+    return processed_images
+
+def _generation_fields(
+    prompt: str,
+    aspect_ratio: str,
+    resolution: str,
+    describe_references: bool,
+    image_handles: List[str] = [],
+    force_fresh: bool = False,
+) -> dict:
+    """Scalar fields that make two generation requests "the same" for deduplication."""
+    return {
+        "prompt": prompt,
+        "aspect_ratio": aspect_ratio,
+        "resolution": (resolution or "1K").upper(),
+        "describe_references": describe_references,
+        # Handles are content hashes, so they stand in for the image bytes
+        "image_handles": list(image_handles),
+        "force_fresh": force_fresh,
+    }
+
+
+async def _stored_references(handles: List[str]) -> List[dict]:
+    """Look up reference handles from /api/uploads; 404 if any is unknown or evicted."""
+    references = []
+    for handle in handles:
+        info = await blob_store.ainfo(handle.strip().lower())
+        if info is None:
+            raise HTTPException(status_code=404, detail="参考图不存在或已过期，请重新上传。")
+        references.append({"handle": info["handle"], "mime_type": info["mime_type"]})
+    return references
+
+class BatchGenerateRequest(GenerateRequest):
+    count: int = 2 # number of variants
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that always closes its generator and then calls `on_close`.
+
+    Closing an async generator that never started skips its `finally`, and
+    Starlette skips `background` when the client disconnects, so cleanup
+    that must happen (e.g. releasing a limiter slot) goes in `on_close`.
+    """
+
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                await self.body_iterator.aclose()
+            finally:
+                self._on_close()
 
 @app.get("/")
 async def root():
     return {"message": "ArchGemini Backend is running!", "status": "ok"}
 
 @app.post("/api/optimize-prompt")
-async def optimize_prompt_endpoint(req: OptimizeRequest):
-    async with HEAVY_TASK_SEMAPHORE:
+async def optimize_prompt_endpoint(req: OptimizeRequest, request: Request):
+    async with client_slot("optimize", clients.identify(request)):
         try:
             result = await optimize_prompt(req.text)
             return {"optimized_prompt": result}
+        except Overloaded:
+            raise
         except Exception as e:
             print(f"Error optimizing prompt: {e}")
             # Translate error for user
             user_msg = await translate_error(str(e))
             raise HTTPException(status_code=500, detail=user_msg)
 
+class _GeneratedImageCodec(SharedCodec):
+    """Share an idempotent /api/generate-image result across workers without its image.
+
+    The image goes to the BlobStore and only its handle is written to the
+    shared state; another worker reads it back from the same store.
+    """
+
+    async def pack(self, value):
+        result, headers = value
+        data = await asyncio.to_thread(base64.b64decode, result["image_base64"])
+        info = await blob_store.aput(data, result["mime_type"])
+        return {
+            "handle": info["handle"],
+            "mime_type": result["mime_type"],
+            "model_used": result["model_used"],
+            "cached": result["cached"],
+            "headers": headers,
+        }
+
+    async def unpack(self, doc):
+        stored = await blob_store.aread(doc["handle"])
+        if stored is None:
+            return None
+        image_base64 = await asyncio.to_thread(lambda: base64.b64encode(stored[0]).decode("ascii"))
+        result = {
+            "image_base64": image_base64,
+            "mime_type": doc["mime_type"],
+            "model_used": doc["model_used"],
+            "cached": doc["cached"],
+        }
+        return result, doc["headers"]
+
+generated_image_codec = _GeneratedImageCodec()
+
 @app.post("/api/generate-image")
-async def generate_image_endpoint(req: GenerateRequest, request: Request):
-    async with HEAVY_TASK_SEMAPHORE:
-        try:
-            # Get client IP
-            client_ip = request.client.host if request.client else "unknown"
+async def generate_image_endpoint(req: GenerateRequest, request: Request, response: Response):
+    client = clients.identify(request)
+    cost = resolution_cost(req.resolution)
+    references = await _stored_references(req.image_handles)
+    # Double-clicks and retries of the same request share one generation (X-Dedup header)
+    fp = await fingerprint(
+        _generation_fields(
+            req.prompt, req.aspect_ratio, req.resolution, req.describe_references, req.image_handles, req.force_fresh
+        ),
+        tuple(req.images),
+    )
 
-            # Process images to extract mime_type and data
-            processed_images = []
-            for img in req.images:
-                mime_type = "image/jpeg"
-                data = img
-                
-                if "base64," in img:
-                    # Format: data:image/png;base64,.....
-                    parts = img.split("base64,")
-                    data = parts[1]
-                    
-                    # Extract mime type from parts[0]
-                    # parts[0] looks like "data:image/png;"
-                    if "data:" in parts[0] and ";" in parts[0]:
-                        mime_type = parts[0].split("data:")[1].split(";")[0]
+    async def generate():
+        async with client_slot("generate", client, cost):
+            try:
+                # Get client IP
+                client_ip = request.client.host if request.client else "unknown"
+
+                report = PreprocessReport()
+                processed_images = await preprocess_images(
+                    _parse_data_url_images(req.images), req.resolution, report
+                ) + references
+                if report.images:
+                    print(f"Preprocessed inputs: {report}")
+
+                image_base64, mime_type, model_used, api_key_used = await generate_image(
+                    prompt=req.prompt, 
+                    aspect_ratio=req.aspect_ratio, 
+                    resolution=req.resolution,
+                    images=processed_images,
+                    describe_references=req.describe_references,
+                    force_fresh=req.force_fresh
+                )
+                cached = api_key_used is None
                 
-                processed_images.append({
-                    "data": data,
-                    "mime_type": mime_type
-                })
-                    
-            image_base64, mime_type, model_used, api_key_used = await generate_image(
-                prompt=req.prompt, 
-                aspect_ratio=req.aspect_ratio, 
-                resolution=req.resolution,
-                images=processed_images
-            )
-            
-            # Log the request and backup image
-            log_request(
-                client_ip=client_ip,
-                prompt=req.prompt,
-                model=model_used,
-                api_key=api_key_used,
-                image_base64=image_base64,
-                request_type="generation"
-            )
+                # Log the request and backup image (a cache hit has its image already and costs no quota)
+                log_request(
+                    client_ip=client_ip,
+                    prompt=req.prompt,
+                    model=model_used,
+                    api_key=api_key_used,
+                    image_base64=None if cached else image_base64,
+                    request_type="generation",
+                    client_id=client,
+                    cost=0 if cached else cost
+                )
+
+                result = {
+                    "image_base64": image_base64,
+                    "mime_type": mime_type,
+                    "model_used": model_used,
+                    "cached": cached,
+                }
+                return result, {**report.headers(), "X-Cache": generation_cache.status(api_key_used, req.force_fresh)}
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(f"Error generating image: {e}")
+                user_msg = await translate_error(str(e))
+                raise HTTPException(status_code=500, detail=user_msg) from e
 
-            return {
-                "image_base64": image_base64,
-                "mime_type": mime_type,
-                "model_used": model_used,
-            }
+    (result, headers), outcome = await generation_dedup.run(
+        client, fp, generate, idempotency_key(request), share_results=True, codec=generated_image_codec
+    )
+    response.headers.update(headers)
+    response.headers["X-Dedup"] = outcome
+    return result
+
+@app.post("/api/generate-image/stream")
+async def generate_image_stream_endpoint(req: GenerateRequest, request: Request):
+    """/api/generate-image as SSE progress events, so a 20-60 s render isn't a silent spinner.
+
+    Events: `queued` -> `started` (slot acquired) -> `preprocessed` ->
+    `upstream_started` (per attempt; a new model means fallback) ->
+    `first_byte` -> `decoding` -> `done` with the image, or `error` with a
+    translated message (`retry_after` when the server was busy).
+    """
+    client_ip = request.client.host if request.client else "unknown"
+    client = clients.identify(request)
+    cost = resolution_cost(req.resolution)
+    references = await _stored_references(req.image_handles)
+    # Charge before the stream starts so a rate-limited client still gets a proper 429
+    await clients.charge("generate", client, cost)
+    limiter = get_limiter("route:generate")
+
+    async def event_source():
+        yield _sse("queued", {"queued": limiter.stats()["queued"], "resolution": req.resolution.upper()})
+        try:
+            async with limiter.slot(client, cost, clients.weight(client)):
+                yield _sse("started", {})
+                report = PreprocessReport()
+                processed_images = await preprocess_images(
+                    _parse_data_url_images(req.images), req.resolution, report
+                ) + references
+                if report.images:
+                    print(f"Preprocessed inputs: {report}")
+                    yield _sse("preprocessed", {
+                        "saved_bytes": report.saved_bytes,
+                        "elapsed_ms": round(report.elapsed_ms, 1),
+                    })
+
+                async for event in generate_image_stream(
+                    prompt=req.prompt,
+                    aspect_ratio=req.aspect_ratio,
+                    resolution=req.resolution,
+                    images=processed_images,
+                    describe_references=req.describe_references,
+                ):
+                    name = event.pop("event")
+                    if name != "done":
+                        yield _sse(name, event)
+                        continue
+                    log_request(
+                        client_ip=client_ip,
+                        prompt=req.prompt,
+                        model=event["model_used"],
+                        api_key=event["api_key"],
+                        image_base64=event["image_base64"],
+                        request_type="generation",
+                        client_id=client,
+                        cost=cost
+                    )
+                    yield _sse("done", {
+                        "image_base64": event["image_base64"],
+                        "mime_type": event["mime_type"],
+                        "model_used": event["model_used"],
+                    })
+        except Overloaded as e:
+            if e.name == "route:generate":
+                await clients.refund("generate", client, cost)
+            yield _sse("error", {"detail": "服务器繁忙，请稍后重试。", "retry_after": int(e.retry_after + 0.999)})
         except Exception as e:
-            print(f"Error generating image: {e}")
-            user_msg = await translate_error(str(e))
-            raise HTTPException(status_code=500, detail=user_msg)
+            print(f"Error generating image (stream): {e}")
+            yield _sse("error", {"detail": await translate_error(str(e))})
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/api/generate-image/batch")
+async def generate_image_batch_endpoint(req: BatchGenerateRequest, request: Request):
+    """Generate several variants of one prompt, streamed as SSE as each one finishes.
+
+    Emits one `variant` event per success, `variant_error` per failure and a
+    final `done` event with counts; partial success is normal.
+    """
+    if not 1 <= req.count <= settings.MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"count must be between 1 and {settings.MAX_VARIANTS}")
+    client_ip = request.client.host if request.client else "unknown"
+    client = clients.identify(request)
+    cost = resolution_cost(req.resolution)
+    references = await _stored_references(req.image_handles)
+
+    # Admit before the stream starts so overload is still a proper 503/429.
+    # The whole batch is charged up front and queues with its full weight.
+    limiter = await admit("generate", client, cost * req.count)
+    released = False
+
+    def release(latency: Optional[float] = None):
+        # Called by the stream when it ends and again by the response; only the first counts
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release(latency=latency)
+
+    async def event_source():
+        succeeded = 0
+        start = asyncio.get_running_loop().time()
+        try:
+            # Reference images are parsed and preprocessed once for all variants
+            report = PreprocessReport()
+            processed_images = await preprocess_images(
+                _parse_data_url_images(req.images), req.resolution, report
+            ) + references
+            if report.images:
+                print(f"Preprocessed inputs: {report}")
+            yield _sse("started", {"count": req.count})
+
+            async for variant in generate_image_variants(
+                prompt=req.prompt,
+                aspect_ratio=req.aspect_ratio,
+                resolution=req.resolution,
+                images=processed_images,
+                count=req.count,
+                describe_references=req.describe_references,
+            ):
+                if "error" in variant:
+                    print(f"Error generating variant {variant['index']}: {variant['error']}")
+                    user_msg = await translate_error(variant["error"])
+                    yield _sse("variant_error", {"index": variant["index"], "error": user_msg})
+                    continue
+
+                succeeded += 1
+                log_request(
+                    client_ip=client_ip,
+                    prompt=req.prompt,
+                    model=variant["model_used"],
+                    api_key=variant["api_key"],
+                    image_base64=variant["image_base64"],
+                    request_type="generation",
+                    client_id=client,
+                    cost=cost
+                )
+                yield _sse("variant", {
+                    "index": variant["index"],
+                    "image_base64": variant["image_base64"],
+                    "mime_type": variant["mime_type"],
+                    "model_used": variant["model_used"],
+                })
+            yield _sse("done", {"count": req.count, "succeeded": succeeded})
+        finally:
+            release(latency=asyncio.get_running_loop().time() - start if succeeded else None)
+
+    try:
+        return _ClosingStreamingResponse(
+            event_source(),
+            on_close=release,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except BaseException:
+        release()
+        raise
+
+# Chunk size for streaming raw image bodies
+IMAGE_STREAM_CHUNK = 64 * 1024
+
+def _iter_chunks(data: bytes, chunk_size: int = IMAGE_STREAM_CHUNK):
+    """Yield zero-copy slices of `data`."""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+@app.post("/api/generate-image/binary")
+async def generate_image_binary_endpoint(
+    request: Request,
+    prompt: str = Form(...),
+    aspect_ratio: str = Form("16:9"),
+    resolution: str = Form("1K"),
+    files: List[UploadFile] = File(default=[]),
+    image_handles: List[str] = Form(default=[]),
+    stream: bool = Form(False),
+    describe_references: bool = Form(False),
+    force_fresh: bool = Form(False)
+):
+    """Multipart variant of /api/generate-image.
+
+    Reference images arrive as raw file parts and the result is returned as a raw
+    `image/*` body (or streamed when `stream=true`), so neither side pays for a
+    base64-in-JSON round trip. Model info is returned in `X-Model-Used`.
+    """
+    client = clients.identify(request)
+    cost = resolution_cost(resolution)
+    references = await _stored_references(image_handles)
+
+    # Read each upload once; downscaling and base64 encoding for the upstream
+    # JSON happen on the preprocess executor, which keeps only the encoded copy.
+    uploads = []
+    for upload in files:
+        raw = await upload.read()
+        if raw:
+            uploads.append({"bytes": raw, "mime_type": upload.content_type or "image/jpeg"})
+    fp = await fingerprint(
+        _generation_fields(prompt, aspect_ratio, resolution, describe_references, image_handles, force_fresh),
+        tuple(u["bytes"] for u in uploads),
+    )
+
+    async def generate():
+        nonlocal uploads
+        async with client_slot("generate", client, cost):
+            try:
+                client_ip = request.client.host if request.client else "unknown"
+
+                report = PreprocessReport()
+                processed_images = await preprocess_images(uploads, resolution, report) + references
+                uploads = []
+                if report.images:
+                    print(f"Preprocessed inputs: {report}")
+
+                image_base64, mime_type, model_used, api_key_used = await generate_image(
+                    prompt=prompt,
+                    aspect_ratio=aspect_ratio,
+                    resolution=resolution,
+                    images=processed_images,
+                    describe_references=describe_references,
+                    force_fresh=force_fresh
+                )
+                del processed_images
+                cached = api_key_used is None
+
+                # Decode exactly once; the same bytes are backed up and sent to the client
+                with span("base64_decode", model=model_used, resolution=resolution.upper()):
+                    image_bytes = await asyncio.to_thread(base64.b64decode, image_base64)
+                del image_base64
+
+                log_request(
+                    client_ip=client_ip,
+                    prompt=prompt,
+                    model=model_used,
+                    api_key=api_key_used,
+                    request_type="generation",
+                    image_bytes=None if cached else image_bytes,
+                    client_id=client,
+                    cost=0 if cached else cost
+                )
+                headers = {**report.headers(), "X-Cache": generation_cache.status(api_key_used, force_fresh)}
+                return image_bytes, mime_type, model_used, headers
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(f"Error generating image: {e}")
+                user_msg = await translate_error(str(e))
+                raise HTTPException(status_code=500, detail=user_msg) from e
+
+    # Raw bytes aren't shared through the state backend; duplicates coalesce per worker
+    (image_bytes, mime_type, model_used, report_headers), outcome = await generation_dedup.run(
+        client, f"binary:{fp}", generate, idempotency_key(request)
+    )
+    del uploads
+
+    headers = {"X-Model-Used": model_used, "X-Dedup": outcome, "Cache-Control": "no-store", **report_headers}
+    if stream:
+        headers["Content-Length"] = str(len(image_bytes))
+        return StreamingResponse(_iter_chunks(image_bytes), media_type=mime_type, headers=headers)
+    return Response(content=image_bytes, media_type=mime_type, headers=headers)
+
+@app.post("/api/uploads")
+async def upload_references(files: List[UploadFile] = File(...), resolution: str = Form("4K")):
+    """Store reference images once and return content-hash handles.
+
+    Each file is preprocessed for `resolution` (use the largest you will
+    generate at) and kept under its SHA-256, so uploading the same image
+    again is free. Send the handles as `image_handles` to the generation
+    endpoints, or as `handle` to /api/analyze-image, instead of the bytes.
+    """
+    if len(files) > settings.UPLOAD_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"一次最多上传 {settings.UPLOAD_MAX_FILES} 张图片。")
+    too_large = HTTPException(
+        status_code=413, detail=f"图片过大，单张不能超过 {settings.UPLOAD_MAX_BYTES // (1024 * 1024)} MB。"
+    )
+    # Sizes are known once the form is parsed; refuse before reading any file into memory
+    if any(upload.size is not None and upload.size > settings.UPLOAD_MAX_BYTES for upload in files):
+        raise too_large
+    uploads = []
+    for upload in files:
+        raw = await upload.read(settings.UPLOAD_MAX_BYTES + 1)
+        if len(raw) > settings.UPLOAD_MAX_BYTES:
+            raise too_large
+        if not raw:
+            continue
+        data, mime_type = await preprocess_raw(raw, upload.content_type or "image/jpeg", max_edge_for(resolution))
+        try:
+            info = await blob_store.aput(data, mime_type)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"无法识别的图片格式: {upload.filename}")
+        uploads.append({**info, "original_size": len(raw), "filename": upload.filename})
+    if not uploads:
+        raise HTTPException(status_code=400, detail="请上传图片。")
+    return {"uploads": uploads}
+
+@app.get("/api/uploads/{handle}")
+async def get_upload(handle: str):
+    """Metadata of a stored reference image (404 once evicted)."""
+    info = await blob_store.ainfo(handle.lower())
+    if info is None:
+        raise HTTPException(status_code=404, detail="Upload not found or evicted")
+    return info
+
+class AnalyzeUploadRequest(BaseModel):
+    size: Optional[int] = None # Total bytes, if known; the upload is complete once they arrive
+    mime_type: str = "image/png"
+
+@app.post("/api/analyze-image/uploads")
+async def create_analyze_upload(req: AnalyzeUploadRequest):
+    """Start a resumable upload for a large image to analyse.
+
+    PUT the file in chunks to /api/analyze-image/uploads/{upload_id}, each with
+    an `Upload-Offset` header; after a dropped connection, GET the session for
+    the offset to continue from. Then send `upload_id` to /api/analyze-image.
+    """
+    return await resumable_uploads.create(req.mime_type, req.size)
+
+@app.put("/api/analyze-image/uploads/{upload_id}")
+async def append_analyze_upload(upload_id: str, request: Request):
+    """Append the request body (raw bytes) at `Upload-Offset`; returns the new offset."""
+    try:
+        offset = int(request.headers.get("upload-offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="缺少 Upload-Offset 请求头。")
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and offset + int(length) > resumable_uploads.max_bytes:
+        raise UploadTooLarge(resumable_uploads.max_bytes)
+    try:
+        status = await resumable_uploads.append(upload_id.lower(), offset, request.stream())
+    except ClientDisconnect:
+        # What arrived is kept; the client resumes from the offset GET reports
+        return Response(status_code=400)
+    if status is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期，请重新上传。")
+    return status
+
+@app.get("/api/analyze-image/uploads/{upload_id}")
+async def get_analyze_upload(upload_id: str):
+    status = await resumable_uploads.status(upload_id.lower())
+    if status is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期，请重新上传。")
+    return status
+
+@app.delete("/api/analyze-image/uploads/{upload_id}")
+async def delete_analyze_upload(upload_id: str):
+    if not await resumable_uploads.discard(upload_id.lower()):
+        raise HTTPException(status_code=404, detail="上传不存在或已过期，请重新上传。")
+    return {"deleted": upload_id.lower()}
 
 @app.post("/api/analyze-image")
 async def analyze_image_endpoint(
     request: Request,
-    file: UploadFile = File(...), 
+    response: Response,
+    file: Optional[UploadFile] = File(None), 
     prompt: Optional[str] = Form(None),
-    analysis_type: str = Form("general") # general, scene, facade
+    analysis_type: str = Form("general"), # general, scene, facade
+    bypass_cache: bool = Form(False),
+    handle: Optional[str] = Form(None), # From /api/uploads, instead of `file`
+    upload_id: Optional[str] = Form(None) # From /api/analyze-image/uploads, for large files
 ):
-    async with HEAVY_TASK_SEMAPHORE:
+    client = clients.identify(request)
+    if handle:
+        stored = await blob_store.aread(handle.strip().lower())
+        if stored is None:
+            raise HTTPException(status_code=404, detail="参考图不存在或已过期，请重新上传。")
+    elif upload_id:
+        upload_id = upload_id.strip().lower()
+        session = await resumable_uploads.status(upload_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="上传不存在或已过期，请重新上传。")
+        if not session["complete"]:
+            raise OffsetMismatch(session["offset"])
+    elif file is None:
+        raise HTTPException(status_code=400, detail="请上传图片或提供 handle。")
+    elif file.size is not None and file.size > settings.ANALYZE_UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(settings.ANALYZE_UPLOAD_MAX_BYTES)
+    async with client_slot("analyze", client):
+        opened = None
         try:
             client_ip = request.client.host if request.client else "unknown"
-            contents = await file.read()
-            mime_type = file.content_type or "image/png"
+            if handle:
+                contents, mime_type = stored
+            elif upload_id:
+                opened = await resumable_uploads.open(upload_id)
+                if opened is None:
+                    raise ValueError("upload session expired")
+                contents, mime_type = opened
+            else:
+                # The form parser spooled the upload to a temp file; it is read from there in chunks
+                contents = file.file
+                mime_type = file.content_type or "image/png"
             
             # Select prompt based on type
-            from analysis_prompts import SCENE_ANALYSIS_PROMPT, FACADE_ANALYSIS_PROMPT, GENERAL_ANALYSIS_PROMPT
-            
-            final_prompt = prompt
-            if not final_prompt:
-                if analysis_type == "scene":
-                    final_prompt = SCENE_ANALYSIS_PROMPT
-                elif analysis_type == "facade":
-                    final_prompt = FACADE_ANALYSIS_PROMPT
-                else:
-                    final_prompt = GENERAL_ANALYSIS_PROMPT
+            final_prompt = prompt or ANALYSIS_PROMPTS.get(analysis_type, GENERAL_ANALYSIS_PROMPT)
             
-            description, api_key_used = await analyze_image(contents, mime_type, final_prompt)
+            report = PreprocessReport()
+            description, api_key_used = await analyze_image(
+                contents, mime_type, final_prompt, use_cache=not bypass_cache, report=report
+            )
+            if report.images:
+                print(f"Preprocessed inputs: {report}")
+                response.headers.update(report.headers())
             
             # Log analysis request (no generated image to save, but good to track usage)
             log_request(
@@ -140,14 +750,334 @@ async def analyze_image_endpoint(
                 model="gemini-vision",
                 api_key=api_key_used,
                 image_base64=None,
-                request_type="analysis"
+                request_type="analysis",
+                client_id=client
             )
 
-            return {"description": description}
+            # Cache hits don't consume an API key
+            return {"description": description, "cached": api_key_used is None}
+        except Overloaded:
+            raise
         except Exception as e:
             print(f"Error analyzing image: {e}")
             user_msg = await translate_error(str(e))
             raise HTTPException(status_code=500, detail=user_msg)
+        finally:
+            if opened is not None:
+                await asyncio.to_thread(opened[0].close)
+
+@app.get("/api/history")
+async def list_history(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    model: Optional[str] = None,
+    type: Optional[str] = None,
+    client: Optional[str] = None,
+    key_suffix: Optional[str] = None,
+):
+    """Shared, newest-first history. Returns metadata and URLs, never image data."""
+    try:
+        return await asyncio.to_thread(
+            history.list_history,
+            limit=limit,
+            cursor=cursor,
+            since=since,
+            until=until,
+            model=model,
+            request_type=type,
+            client_ip=client,
+            api_key_suffix=key_suffix,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _history_item_or_404(log_id: str) -> dict:
+    item = await asyncio.to_thread(history.get_history_item, log_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="History item not found")
+    return item
+
+@app.get("/api/history/{log_id}")
+async def get_history_item(log_id: str):
+    item = await _history_item_or_404(log_id)
+    item.pop("image_filename", None)
+    return item
+
+def _cached_file_response(request: Request, path: str, media_type: str) -> Response:
+    """FileResponse with ETag/Cache-Control, or 304 when the client copy is current."""
+    etag = derivatives.etag_for(path)
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/api/history/{log_id}/image")
+async def get_history_image(log_id: str, request: Request):
+    item = await _history_item_or_404(log_id)
+    path = history.image_path(item["image_filename"])
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return _cached_file_response(request, path, "image/png")
+
+async def _history_derivative(log_id: str, variant: str, request: Request, format: Optional[str]):
+    item = await _history_item_or_404(log_id)
+    fmt = derivatives.pick_format(format, request.headers.get("accept", ""))
+    try:
+        path = await derivatives.ensure(item["image_filename"], variant, fmt)
+    except Exception as e:
+        print(f"Error rendering {variant} for {log_id}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to render image")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    response = _cached_file_response(request, path, derivatives.FORMATS[fmt][2])
+    response.headers["Vary"] = "Accept"
+    return response
+
+@app.get("/api/history/{log_id}/thumbnail")
+async def get_history_thumbnail(log_id: str, request: Request, format: Optional[str] = None):
+    """256px thumbnail (WebP when accepted, else JPEG; override with ?format=)."""
+    return await _history_derivative(log_id, "thumb", request, format)
+
+@app.get("/api/history/{log_id}/preview")
+async def get_history_preview(log_id: str, request: Request, format: Optional[str] = None):
+    """1024px preview (WebP when accepted, else JPEG; override with ?format=)."""
+    return await _history_derivative(log_id, "preview", request, format)
+
+_POOL_GAUGES = {
+    "limit": metrics.gauge("archgemini_limiter_limit", "Current adaptive concurrency limit", ("limiter",)),
+    "in_flight": metrics.gauge("archgemini_limiter_in_flight", "Requests holding a limiter slot", ("limiter",)),
+    "queued": metrics.gauge("archgemini_limiter_queued", "Requests waiting for a limiter slot", ("limiter",)),
+    "shed": metrics.gauge("archgemini_limiter_shed", "Requests rejected by a limiter since start", ("limiter",)),
+}
+_KEY_IN_FLIGHT = metrics.gauge("archgemini_key_in_flight", "In-flight upstream calls per API key", ("key",))
+_KEY_COOLDOWN = metrics.gauge("archgemini_key_cooldown_seconds", "Remaining cooldown per API key", ("key",))
+_LOG_QUEUE = metrics.gauge("archgemini_log_queue_depth", "Request-log entries waiting to be written")
+_LOG_DROPPED = metrics.gauge("archgemini_log_dropped", "Request-log entries dropped since start")
+_JOB_QUEUE = metrics.gauge("archgemini_job_queue_depth", "Background jobs waiting for a worker")
+_HTTP_CONNECTIONS = metrics.gauge("archgemini_http_connections", "Open upstream connections", ("upstream", "state"))
+
+def _collect_pool_gauges():
+    for name, stats in limiter_stats().items():
+        for field, gauge in _POOL_GAUGES.items():
+            gauge.set(stats[field], limiter=name)
+    for key in settings.key_pool.stats():
+        _KEY_IN_FLIGHT.set(key["in_flight"], key=key["key_suffix"])
+        _KEY_COOLDOWN.set(key["cooldown_remaining"], key=key["key_suffix"])
+    log_stats = request_log_writer.stats()
+    _LOG_QUEUE.set(log_stats["queue_depth"])
+    _LOG_DROPPED.set(log_stats["dropped"])
+    _JOB_QUEUE.set(job_manager.stats()["queue_depth"])
+    for name, pool in http_client.stats().items():
+        _HTTP_CONNECTIONS.set(pool["connections"] - pool["idle"], upstream=name, state="active")
+        _HTTP_CONNECTIONS.set(pool["idle"], upstream=name, state="idle")
+
+metrics.add_collector(_collect_pool_gauges)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition: request/phase histograms, upstream statuses, loop lag."""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/admin/keys")
+async def api_key_stats():
+    """Per-key health (suffix only): in-flight, latency, error rate, cooldown."""
+    return {"keys": settings.key_pool.stats()}
+
+@app.get("/api/admin/http")
+async def http_pool_stats():
+    """Per-upstream connection pools: HTTP/2, open/idle connections, warm-up result."""
+    return http_client.stats()
+
+@app.get("/api/admin/limits")
+async def limits_stats():
+    """Current adaptive limits, in-flight counts and queue lengths per pool."""
+    return limiter_stats()
+
+@app.get("/api/admin/clients")
+async def client_stats(day: Optional[str] = None, client: Optional[str] = None):
+    """Per-client token buckets, queue weights and daily usage counters."""
+    usage = await asyncio.to_thread(history.client_usage, day, client)
+    return {**clients.stats(), "usage": usage}
+
+@app.get("/api/admin/state")
+async def shared_state_stats():
+    """Cross-worker state backend, this worker's id and global upstream slot usage."""
+    return await state_stats()
+
+@app.get("/api/admin/routing")
+async def routing_stats():
+    """Per-model/resolution latency quantiles and retry/fallback/hedge counters."""
+    return generation_router.stats()
+
+@app.get("/api/admin/cache")
+async def cache_stats():
+    """Hit/miss counters and size of the analysis and generation caches, Qwen memo, dedup and upload store."""
+    return {
+        "analysis": await analysis_cache.stats(),
+        "generation": await generation_cache.stats(),
+        "qwen": qwen_service.cache_stats(),
+        "generation_dedup": generation_dedup.stats(),
+        "uploads": await blob_store.astats(),
+        "file_api": gemini_files.stats(),
+        "analyze_uploads": resumable_uploads.stats(),
+    }
+
+@app.get("/api/admin/logger")
+async def logger_stats():
+    """Request-log writer queue depth and dropped/written counters."""
+    return request_log_writer.stats()
+
+@app.post("/api/jobs/generate-image", status_code=202)
+async def submit_generate_job(req: GenerateRequest, request: Request):
+    """Queue an image generation and return a job id immediately."""
+    client_ip = request.client.host if request.client else "unknown"
+    client = clients.identify(request)
+    cost = resolution_cost(req.resolution)
+    # A duplicate submit gets the first submit's job instead of a second generation
+    fp = await fingerprint(
+        _generation_fields(
+            req.prompt, req.aspect_ratio, req.resolution, req.describe_references, req.image_handles, req.force_fresh
+        ),
+        tuple(req.images),
+    )
+    result, _ = await generation_dedup.run(
+        client, f"job:{fp}", lambda: _submit_generate_job(req, client_ip, client, cost),
+        idempotency_key(request), share_results=True,
+    )
+    return result
+
+async def _submit_generate_job(req: GenerateRequest, client_ip: str, client: str, cost: float) -> dict:
+    references = await _stored_references(req.image_handles)
+    # Jobs skip the route queue but still draw from the client's bucket
+    await clients.charge("generate", client, cost)
+    parsed_images = _parse_data_url_images(req.images)
+
+    async def run(job):
+        try:
+            report = PreprocessReport()
+            processed_images = await preprocess_images(parsed_images, req.resolution, report) + references
+            if report.images:
+                job.publish("preprocessed", {
+                    "saved_bytes": report.saved_bytes,
+                    "elapsed_ms": round(report.elapsed_ms, 1),
+                })
+            job.publish("upstream_started", {"resolution": req.resolution})
+            image_base64, mime_type, model_used, api_key_used = await generate_image(
+                prompt=req.prompt,
+                aspect_ratio=req.aspect_ratio,
+                resolution=req.resolution,
+                images=processed_images,
+                describe_references=req.describe_references,
+                force_fresh=req.force_fresh
+            )
+        except Exception as e:
+            print(f"Error generating image (job {job.id}): {e}")
+            raise Exception(await translate_error(str(e)))
+        cached = api_key_used is None
+
+        log_request(
+            client_ip=client_ip,
+            prompt=req.prompt,
+            model=model_used,
+            api_key=api_key_used,
+            image_base64=None if cached else image_base64,
+            request_type="generation",
+            client_id=client,
+            cost=0 if cached else cost
+        )
+        return {
+            "image_base64": image_base64,
+            "mime_type": mime_type,
+            "model_used": model_used,
+            "cached": cached,
+        }
+
+    try:
+        job = job_manager.submit("generate-image", run)
+    except JobQueueFull as e:
+        await clients.refund("generate", client, cost)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events",
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job:
+        return job.to_dict()
+    # Submitted through another worker process
+    snapshot = await job_manager.lookup(job_id)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return snapshot
+
+async def _remote_job_events(snapshot: dict, poll_interval: float = 1.0, keepalive: float = 15.0):
+    """SSE for a job running in another worker: status changes polled from its snapshot."""
+    job_id = snapshot["job_id"]
+    status = None
+    idle = 0.0
+    while True:
+        if snapshot["status"] != status:
+            status = snapshot["status"]
+            idle = 0.0
+            data = {"job_id": job_id}
+            if status == "succeeded":
+                data["result"] = snapshot.get("result")
+            elif status == "failed":
+                data["error"] = snapshot.get("error")
+            yield _sse(status, data)
+            if status in ("succeeded", "failed"):
+                return
+        elif idle >= keepalive:
+            idle = 0.0
+            yield ": keepalive\n\n"
+        await asyncio.sleep(poll_interval)
+        idle += poll_interval
+        snapshot = await job_manager.lookup(job_id)
+        if snapshot is None:
+            return
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Server-Sent Events stream of job progress, ending with the final result."""
+    job = job_manager.get(job_id)
+    if not job:
+        snapshot = await job_manager.lookup(job_id)
+        if not snapshot:
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        return StreamingResponse(
+            _remote_job_events(snapshot),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def event_source():
+        async for event in job.stream_events():
+            if event is None:
+                # Heartbeat comment keeps proxies from closing idle streams
+                yield ": keepalive\n\n"
+                continue
+            data = dict(event["data"], job_id=job.id)
+            if event["event"] == "succeeded":
+                data["result"] = job.result
+            yield _sse(event["event"], data)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 if __name__ == "__main__":
+    # Only needed when run directly; `uvicorn app:app` has it loaded already
+    import uvicorn
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
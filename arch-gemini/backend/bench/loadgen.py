@@ -0,0 +1,306 @@
+"""Load generator for the ArchGemini backend.
+
+Drives /api/generate-image, /api/analyze-image and /api/optimize-prompt and
+reports RPS, latency percentiles and status codes per endpoint, plus the
+backend's peak RSS, event-loop lag and upstream status counts (from /metrics).
+
+The request plan (endpoint, resolution, input image, arrival time) is derived
+from --seed, and can be saved with --save-plan and replayed with --plan, so two
+runs against different builds send exactly the same traffic.
+
+    python -m bench.loadgen --scenario mix --concurrency 8 --requests 200
+    python -m bench.loadgen --scenario generate --rate 2 --duration 60 --resolution 1K:3,4K:1
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import re
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_MIX = "generate:2,analyze:1,optimize:2"
+
+PROMPTS = [
+    "现代美术馆，清水混凝土外墙，黄昏暖光，湖面倒影",
+    "高层住宅立面，竖向铝合金格栅，阴天柔光",
+    "山地民宿，木结构与夯土墙，清晨薄雾",
+    "城市更新街区，红砖厂房改造，人视角街景",
+    "图书馆中庭，天窗洒落光线，木质书架",
+]
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    weights = {}
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition(":")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    return weights
+
+
+def make_image(seed: int, size=(1600, 1200)) -> bytes:
+    """A distinct synthetic JPEG per seed (distinct bytes, so cache hits are controlled)."""
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    img = Image.new("RGB", size, tuple(rnd.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+        draw.rectangle([x, y, x + rnd.randrange(50, 400), y + rnd.randrange(50, 400)],
+                       fill=tuple(rnd.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def build_plan(args) -> List[dict]:
+    rnd = random.Random(args.seed)
+    mix = parse_weights(DEFAULT_MIX if args.scenario == "mix" else f"{args.scenario}:1")
+    resolutions = parse_weights(args.resolution)
+    total = args.requests or int(args.duration * (args.rate or 1000))
+    plan, at = [], 0.0
+    for index in range(total):
+        if args.rate:
+            # Open loop: Poisson arrivals
+            at += rnd.expovariate(args.rate)
+            if args.duration and at > args.duration:
+                break
+        kind = rnd.choices(list(mix), weights=list(mix.values()))[0]
+        plan.append({
+            "index": index,
+            "kind": kind,
+            "at": round(at, 4) if args.rate else None,
+            "resolution": rnd.choices(list(resolutions), weights=list(resolutions.values()))[0],
+            # Unique text so the Qwen result cache doesn't turn the run into a cache benchmark
+            "prompt": f"{rnd.choice(PROMPTS)}，方案 {index}",
+            "image": rnd.randrange(args.distinct_images),
+            "references": args.references if kind == "generate" else 0,
+        })
+    return plan
+
+
+class Results:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self.start = time.monotonic()
+        self.end = self.start
+
+    def add(self, kind: str, seconds: float, status: str):
+        self.samples.setdefault(kind, []).append(seconds)
+        counts = self.statuses.setdefault(kind, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    @staticmethod
+    def percentile(values: List[float], q: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self) -> dict:
+        elapsed = max(1e-9, self.end - self.start)
+        endpoints = {}
+        for kind, values in self.samples.items():
+            ok = self.statuses[kind].get("200", 0)
+            endpoints[kind] = {
+                "requests": len(values),
+                "ok": ok,
+                "rps": round(len(values) / elapsed, 3),
+                "ok_rps": round(ok / elapsed, 3),
+                "p50": self.percentile(values, 0.5),
+                "p90": self.percentile(values, 0.9),
+                "p99": self.percentile(values, 0.99),
+                "max": max(values),
+                "statuses": self.statuses[kind],
+            }
+        total = sum(len(v) for v in self.samples.values())
+        return {"elapsed": round(elapsed, 3), "requests": total, "rps": round(total / elapsed, 3), "endpoints": endpoints}
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """Flatten Prometheus text into {"name{labels}": value}."""
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if match:
+            samples[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+def _histogram_quantile(before: Dict[str, float], after: Dict[str, float], name: str, q: float) -> Optional[float]:
+    buckets = []
+    for key, value in after.items():
+        if key.startswith(name + "_bucket"):
+            le = re.search(r'le="([^"]+)"', key).group(1)
+            buckets.append((float("inf") if le == "+Inf" else float(le), value - before.get(key, 0.0)))
+    buckets.sort()
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    for bound, count in buckets:
+        if count >= rank:
+            return bound
+    return None
+
+
+def backend_report(before: Dict[str, float], after: Dict[str, float]) -> dict:
+    upstream = {}
+    for key, value in after.items():
+        if key.startswith("archgemini_upstream_responses_total"):
+            delta = value - before.get(key, 0.0)
+            if delta:
+                upstream[key[len("archgemini_upstream_responses_total"):]] = int(delta)
+    # Upper bound of the bucket holding the p99 lag sample
+    lag_p99 = _histogram_quantile(before, after, "archgemini_event_loop_lag_seconds", 0.99)
+    return {
+        "peak_rss_mb": round(after.get("archgemini_process_peak_rss_bytes", 0) / 1e6, 1) or None,
+        "rss_mb": round(after.get("archgemini_process_rss_bytes", 0) / 1e6, 1) or None,
+        "loop_lag_max_ms": round(after.get("archgemini_event_loop_lag_max_seconds", 0) * 1000, 2),
+        "loop_lag_p99_ms": round(lag_p99 * 1000, 2) if lag_p99 not in (None, float("inf")) else lag_p99,
+        "upstream_responses": upstream,
+    }
+
+
+async def scrape(client: httpx.AsyncClient) -> Dict[str, float]:
+    try:
+        response = await client.get("/metrics", timeout=10.0)
+        return parse_metrics(response.text) if response.status_code == 200 else {}
+    except httpx.HTTPError:
+        return {}
+
+
+async def send(client: httpx.AsyncClient, item: dict, images: List[bytes], timeout: float) -> str:
+    kind = item["kind"]
+    if kind == "optimize":
+        response = await client.post("/api/optimize-prompt", json={"text": item["prompt"]}, timeout=timeout)
+    elif kind == "analyze":
+        files = {"file": (f"bench_{item['image']}.jpg", images[item["image"]], "image/jpeg")}
+        response = await client.post("/api/analyze-image", files=files, data={"analysis_type": "facade"}, timeout=timeout)
+    else:
+        references = [
+            "data:image/jpeg;base64," + base64.b64encode(images[(item["image"] + i) % len(images)]).decode("ascii")
+            for i in range(item["references"])
+        ]
+        response = await client.post("/api/generate-image", json={
+            "prompt": item["prompt"],
+            "resolution": item["resolution"],
+            "aspect_ratio": "16:9",
+            "images": references,
+        }, timeout=timeout)
+    # Read the full body: large image responses are part of the cost
+    await response.aread()
+    return str(response.status_code)
+
+
+async def run(args) -> dict:
+    if args.plan:
+        with open(args.plan, encoding="utf-8") as f:
+            plan = json.load(f)
+    else:
+        plan = build_plan(args)
+    if args.save_plan:
+        with open(args.save_plan, "w", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False)
+
+    images = [make_image(args.seed * 1000 + i) for i in range(args.distinct_images)]
+    results = Results()
+    limits = httpx.Limits(max_connections=max(args.concurrency, 100), max_keepalive_connections=max(args.concurrency, 100))
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, headers={"X-Client-Token": args.token} if args.token else None) as client:
+        before = await scrape(client)
+        results.start = time.monotonic()
+
+        async def one(item: dict):
+            start = time.monotonic()
+            try:
+                status = await send(client, item, images, args.timeout)
+            except httpx.TimeoutException:
+                status = "timeout"
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            results.add(item["kind"], time.monotonic() - start, status)
+
+        if any(item.get("at") is not None for item in plan):
+            # Open loop: fire on schedule regardless of how slow responses are
+            tasks = []
+            for item in plan:
+                delay = item["at"] - (time.monotonic() - results.start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one(item)))
+            await asyncio.gather(*tasks)
+        else:
+            # Closed loop: `concurrency` workers pull from the plan
+            queue = list(reversed(plan))
+            deadline = results.start + args.duration if args.duration and not args.requests else None
+
+            async def worker():
+                while queue and (deadline is None or time.monotonic() < deadline):
+                    await one(queue.pop())
+
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+        results.end = time.monotonic()
+        after = await scrape(client)
+
+    report = results.summary()
+    report["backend"] = backend_report(before, after) if after else None
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("plan", "save_plan", "out")}
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n{report['requests']} requests in {report['elapsed']}s -> {report['rps']} req/s")
+    print(f"{'endpoint':<10} {'n':>5} {'ok':>5} {'ok/s':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  statuses")
+    for kind, e in sorted(report["endpoints"].items()):
+        fmt = lambda v: f"{v:8.3f}" if v is not None else f"{'-':>8}"
+        print(f"{kind:<10} {e['requests']:>5} {e['ok']:>5} {e['ok_rps']:>7} {fmt(e['p50'])} {fmt(e['p90'])} {fmt(e['p99'])} {fmt(e['max'])}  {e['statuses']}")
+    backend = report.get("backend")
+    if backend:
+        print(f"backend: peak RSS {backend['peak_rss_mb']} MB, loop lag max {backend['loop_lag_max_ms']} ms "
+              f"(p99 <= {backend['loop_lag_p99_ms']} ms)")
+        for labels, count in sorted(backend["upstream_responses"].items()):
+            print(f"  upstream {labels}: {count}")
+    else:
+        print("backend: /metrics unavailable (METRICS_ENABLED=false?)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="backend base URL")
+    parser.add_argument("--scenario", choices=["generate", "analyze", "optimize", "mix"], default="mix")
+    parser.add_argument("--resolution", default="1K", help='weighted mix, e.g. "1K:3,2K:1,4K:1"')
+    parser.add_argument("--concurrency", type=int, default=8, help="closed-loop workers")
+    parser.add_argument("--rate", type=float, default=0.0, help="open-loop arrivals per second (Poisson)")
+    parser.add_argument("--requests", type=int, default=0, help="number of requests (default: --duration)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds, when --requests is not set")
+    parser.add_argument("--references", type=int, default=0, help="reference images per generate request")
+    parser.add_argument("--distinct-images", type=int, default=8, help="input images to cycle (fewer = more cache hits)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--token", default="", help="X-Client-Token to send")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--plan", default="", help="replay a saved request plan")
+    parser.add_argument("--save-plan", default="", help="write the request plan to this file")
+    parser.add_argument("--out", default="", help="write the JSON report to this file")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
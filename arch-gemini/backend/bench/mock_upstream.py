@@ -0,0 +1,290 @@
+"""Local stand-in for the Gemini and Qwen (DashScope) APIs.
+
+Serves the same response shapes as `generateContent` (also streamed,
+`streamGenerateContent?alt=sse`) and `chat/completions` with configurable latency, 429/5xx injection and
+realistically sized 1K/2K/4K `inlineData` payloads, so throughput can be
+measured without touching real quota.
+
+    python -m bench.mock_upstream --port 9100 --time-scale 0.1 --rate-429 0.05
+
+Point the backend at it with
+    GOOGLE_API_BASE_URL=http://127.0.0.1:9100
+    QWEN_API_BASE_URL=http://127.0.0.1:9100/compatible-mode/v1
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import random
+import struct
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Long edge is derived from this "base" size and the aspect ratio (area ~ base^2)
+RESOLUTION_BASE = {"1K": 1024, "2K": 2048, "4K": 4096}
+
+DESCRIPTION = (
+    "这是一张现代建筑的外立面照片。建筑主体为六层混凝土框架结构，立面采用浅灰色石材幕墙与竖向铝合金格栅，"
+    "首层为通高玻璃幕墙的商业空间。屋顶有退台式绿化平台。光线为午后侧光，阴影清晰，天空晴朗。"
+) * 4
+
+
+class MockConfig:
+    """Knobs for the stand-in; set from the command line."""
+
+    def __init__(self):
+        self.time_scale = 1.0
+        # Median seconds and log-normal sigma per kind; generation scales by resolution
+        self.latency = {
+            "generate:1K": (12.0, 0.35),
+            "generate:2K": (18.0, 0.35),
+            "generate:4K": (30.0, 0.4),
+            "vision": (5.0, 0.3),
+            "qwen": (1.5, 0.3),
+        }
+        self.rate_429 = 0.0
+        self.rate_5xx = 0.0
+        self.retry_after = 2.0
+        # Response image size in bytes per resolution
+        self.payload_bytes = {"1K": 1_500_000, "2K": 5_000_000, "4K": 18_000_000}
+        self.seed: Optional[int] = None
+
+
+config = MockConfig()
+_random = random.Random()
+_payload_cache: Dict[Tuple[str, str], str] = {}
+stats: Dict[str, int] = {}
+
+app = FastAPI(title="ArchGemini mock upstream")
+
+
+def _count(name: str):
+    stats[name] = stats.get(name, 0) + 1
+
+
+def _image_size(resolution: str, aspect_ratio: str) -> Tuple[int, int]:
+    base = RESOLUTION_BASE.get(resolution, 1024)
+    try:
+        w, h = (float(x) for x in aspect_ratio.split(":"))
+        ratio = w / h
+    except (ValueError, ZeroDivisionError):
+        ratio = 1.0
+    return max(16, round(base * math.sqrt(ratio))), max(16, round(base / math.sqrt(ratio)))
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def _make_payload(resolution: str, aspect_ratio: str) -> str:
+    """Base64 of a real PNG at the target dimensions, padded to the configured size.
+
+    The image itself is a cheap gradient; a private ancillary chunk of random
+    bytes brings it up to a realistic size while staying decodable by Pillow.
+    """
+    from PIL import Image
+
+    width, height = _image_size(resolution, aspect_ratio)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge("RGB", (gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT), gradient))
+    out = io.BytesIO()
+    img.save(out, "PNG", compress_level=1)
+    png = out.getvalue()
+
+    filler = config.payload_bytes.get(resolution, 0) - len(png) - 12
+    if filler > 0:
+        # Insert before IEND (the last 12 bytes)
+        png = png[:-12] + _png_chunk(b"bnCh", _random.randbytes(filler)) + png[-12:]
+    return base64.b64encode(png).decode("ascii")
+
+
+def _payload(resolution: str, aspect_ratio: str) -> str:
+    key = (resolution, aspect_ratio)
+    if key not in _payload_cache:
+        _payload_cache[key] = _make_payload(resolution, aspect_ratio)
+    return _payload_cache[key]
+
+
+async def _delay(kind: str):
+    median, sigma = config.latency.get(kind, (1.0, 0.3))
+    await asyncio.sleep(median * math.exp(sigma * _random.gauss(0, 1)) * config.time_scale)
+
+
+def _injected_error(kind: str) -> Optional[Response]:
+    roll = _random.random()
+    if roll < config.rate_429:
+        _count(f"{kind}:429")
+        delay = f"{config.retry_after:g}s"
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": f"{config.retry_after:g}"},
+            content={"error": {
+                "code": 429,
+                "message": "Resource has been exhausted (e.g. check quota).",
+                "status": "RESOURCE_EXHAUSTED",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": delay}],
+            }},
+        )
+    if roll < config.rate_429 + config.rate_5xx:
+        _count(f"{kind}:503")
+        return JSONResponse(
+            status_code=503,
+            content={"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}},
+        )
+    return None
+
+
+async def _stream_image(model: str, resolution: str, aspect_ratio: str):
+    """SSE chunks: an early text part (like the model's progress notes), then the image event."""
+    yield ('data: {"candidates":[{"content":{"role":"model","parts":[{"text":"Rendering"}]}}],'
+           '"modelVersion":"' + model + '"}\r\n\r\n').encode("utf-8")
+    await _delay(f"generate:{resolution}")
+    event = (
+        'data: {"candidates":[{"content":{"role":"model","parts":[{"inlineData":{"mimeType":"image/png","data":"'
+        + _payload(resolution, aspect_ratio)
+        + '"}}]},"finishReason":"STOP"}],"modelVersion":"' + model + '"}\r\n\r\n'
+    ).encode("utf-8")
+    # Arrives in network-sized pieces, not as one write
+    for start in range(0, len(event), 256 * 1024):
+        yield event[start:start + 256 * 1024]
+
+
+@app.get("/v1beta/models")
+async def list_models():
+    return {"models": [{"name": "models/mock-image"}, {"name": "models/mock-vision"}]}
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate_content(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    body = json.loads(await request.body())
+    generation_config = body.get("generationConfig") or {}
+    image_config = generation_config.get("imageConfig")
+
+    if image_config is None:
+        # Vision analysis: text in, text out
+        _count("vision")
+        await _delay("vision")
+        error = _injected_error("vision")
+        if error is not None:
+            return error
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": DESCRIPTION}]},
+                "finishReason": "STOP",
+            }],
+            "modelVersion": model,
+        }
+
+    resolution = (image_config.get("imageSize") or "1K").upper()
+    aspect_ratio = image_config.get("aspectRatio") or "1:1"
+    count = max(1, int(generation_config.get("candidateCount") or 1))
+    _count(f"generate:{resolution}")
+    if action == "streamGenerateContent":
+        # Errors come back before the stream starts, as with the real API
+        error = _injected_error(f"generate:{resolution}")
+        if error is not None:
+            return error
+        return StreamingResponse(_stream_image(model, resolution, aspect_ratio), media_type="text/event-stream")
+    await _delay(f"generate:{resolution}")
+    error = _injected_error(f"generate:{resolution}")
+    if error is not None:
+        return error
+
+    data = _payload(resolution, aspect_ratio)
+    candidate = (
+        '{"content":{"role":"model","parts":[{"inlineData":{"mimeType":"image/png","data":"'
+        + data
+        + '"}}]},"finishReason":"STOP"}'
+    )
+    # Built as a string: re-serialising tens of MB per response would make the mock the bottleneck
+    content = '{"candidates":[' + ",".join([candidate] * count) + '],"modelVersion":"' + model + '"}'
+    return Response(content=content, media_type="application/json")
+
+
+async def _chat_completions(request: Request):
+    body = json.loads(await request.body())
+    _count("qwen")
+    await _delay("qwen")
+    error = _injected_error("qwen")
+    if error is not None:
+        return error
+    user = next((m["content"] for m in body.get("messages", []) if m.get("role") == "user"), "")
+    return {
+        "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "model": body.get("model", "qwen-mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": f"Architectural rendering, {user[:200]}, photorealistic, 8k"},
+            "finish_reason": "stop",
+        }],
+    }
+
+
+app.post("/chat/completions")(_chat_completions)
+app.post("/{prefix:path}/chat/completions")(_chat_completions)
+
+
+@app.get("/mock/stats")
+async def mock_stats():
+    return stats
+
+
+@app.post("/mock/reset")
+async def mock_reset():
+    stats.clear()
+    return stats
+
+
+def _parse_latency(spec: str):
+    """"generate:4K=30,0.4;qwen=1.5" -> updates config.latency (median[,sigma])."""
+    for item in spec.split(";"):
+        if "=" not in item:
+            continue
+        kind, value = item.split("=", 1)
+        median, _, sigma = value.partition(",")
+        current = config.latency.get(kind.strip(), (1.0, 0.3))
+        config.latency[kind.strip()] = (float(median), float(sigma) if sigma else current[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiply every latency (0.1 = 10x faster)")
+    parser.add_argument("--latency", default="", help='override medians/sigmas, e.g. "generate:4K=30,0.4;qwen=1.5"')
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--retry-after", type=float, default=2.0)
+    parser.add_argument("--payload-mb", default="", help='image sizes in MB, e.g. "1K=1.5,2K=5,4K=18"')
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config.time_scale = args.time_scale
+    config.rate_429 = args.rate_429
+    config.rate_5xx = args.rate_5xx
+    config.retry_after = args.retry_after
+    config.seed = args.seed
+    _random.seed(args.seed)
+    _parse_latency(args.latency)
+    for item in filter(None, args.payload_mb.split(",")):
+        resolution, size = item.split("=")
+        config.payload_bytes[resolution.strip().upper()] = int(float(size) * 1_000_000)
+
+    # Build payloads up front so the first requests don't pay for it
+    for resolution in RESOLUTION_BASE:
+        _payload(resolution, "16:9")
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Tiny in-memory Redis-protocol (RESP2) server for testing SHARED_STATE_URL=redis://.
+
+Implements only the commands core/shared_state.py's RedisState uses, with
+MULTI/EXEC and WATCH semantics, so multi-worker runs can be exercised
+without installing Redis.
+
+    python -m bench.resp_server --port 6399
+    SHARED_STATE_URL=redis://127.0.0.1:6399/0 uvicorn app:app --workers 4
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from typing import Dict, List, Optional
+
+# Key -> value; values are str (strings), dict (hashes) or ZSet
+_data: Dict[str, object] = {}
+_expires: Dict[str, float] = {}
+# Bumped on every write so WATCH can detect changes
+_versions: Dict[str, int] = {}
+_version_counter = itertools.count(1)
+
+WRITE_COMMANDS = {"SET", "DEL", "HSET", "ZADD", "ZREM", "ZREMRANGEBYSCORE", "PEXPIRE"}
+
+
+# EXEC reply when a WATCHed key changed
+NIL_ARRAY = object()
+
+
+class ZSet(dict):
+    """member -> score."""
+
+
+class CommandError(Exception):
+    pass
+
+
+def _touch(key: str):
+    _versions[key] = next(_version_counter)
+
+
+def _alive(key: str) -> bool:
+    expires = _expires.get(key)
+    if expires is not None and expires <= time.time():
+        _data.pop(key, None)
+        _expires.pop(key, None)
+        _touch(key)
+    return key in _data
+
+
+def _get(key: str, kind: type):
+    if not _alive(key):
+        return None
+    value = _data[key]
+    if not isinstance(value, kind) or (kind is dict and isinstance(value, ZSet)):
+        raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+    return value
+
+
+def _score(bound: str) -> tuple:
+    """Parse a ZRANGEBYSCORE bound: (value, exclusive)."""
+    exclusive = bound.startswith("(")
+    bound = bound[1:] if exclusive else bound
+    value = {"-inf": float("-inf"), "+inf": float("inf"), "inf": float("inf")}.get(bound)
+    return (float(bound) if value is None else value), exclusive
+
+
+def _in_range(score: float, low: tuple, high: tuple) -> bool:
+    above = score > low[0] if low[1] else score >= low[0]
+    below = score < high[0] if high[1] else score <= high[0]
+    return above and below
+
+
+def execute(args: List[str]):
+    name = args[0].upper()
+    if name == "PING":
+        return "PONG"
+    if name in ("AUTH", "SELECT"):
+        return "OK"
+    if name == "GET":
+        return _get(args[1], str)
+    if name == "SET":
+        key, value = args[1], args[2]
+        _data[key] = value
+        _expires.pop(key, None)
+        options = [a.upper() for a in args[3:]]
+        if "PX" in options:
+            _expires[key] = time.time() + int(args[3 + options.index("PX") + 1]) / 1000
+        elif "EX" in options:
+            _expires[key] = time.time() + int(args[3 + options.index("EX") + 1])
+        return "OK"
+    if name == "DEL":
+        removed = 0
+        for key in args[1:]:
+            if _alive(key):
+                del _data[key]
+                _touch(key)
+                removed += 1
+        return removed
+    if name == "PEXPIRE":
+        if not _alive(args[1]):
+            return 0
+        _expires[args[1]] = time.time() + int(args[2]) / 1000
+        return 1
+    if name == "HSET":
+        current = _get(args[1], dict)
+        if current is None:
+            current = _data[args[1]] = {}
+        pairs = args[2:]
+        added = sum(1 for field in pairs[::2] if field not in current)
+        current.update(zip(pairs[::2], pairs[1::2]))
+        return added
+    if name == "HGET":
+        return (_get(args[1], dict) or {}).get(args[2])
+    if name == "HMGET":
+        current = _get(args[1], dict) or {}
+        return [current.get(field) for field in args[2:]]
+    if name == "HGETALL":
+        current = _get(args[1], dict) or {}
+        return [item for pair in current.items() for item in pair]
+    if name == "ZADD":
+        current = _get(args[1], ZSet)
+        if current is None:
+            current = _data[args[1]] = ZSet()
+        pairs = args[2:]
+        added = sum(1 for member in pairs[1::2] if member not in current)
+        current.update((member, float(score)) for score, member in zip(pairs[::2], pairs[1::2]))
+        return added
+    if name == "ZREM":
+        current = _get(args[1], ZSet) or {}
+        return sum(1 for member in args[2:] if current.pop(member, None) is not None)
+    if name == "ZCARD":
+        return len(_get(args[1], ZSet) or {})
+    if name in ("ZCOUNT", "ZREMRANGEBYSCORE"):
+        current = _get(args[1], ZSet) or ZSet()
+        low, high = _score(args[2]), _score(args[3])
+        members = [m for m, score in current.items() if _in_range(score, low, high)]
+        if name == "ZREMRANGEBYSCORE":
+            for member in members:
+                del current[member]
+        return len(members)
+    raise CommandError(f"ERR unknown command '{args[0]}'")
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if value is NIL_ARRAY:
+        return b"*-1\r\n"
+    if isinstance(value, CommandError):
+        return b"-" + str(value).encode("utf-8") + b"\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(v) for v in value)
+    if value in ("OK", "PONG", "QUEUED"):
+        return b"+" + value.encode("utf-8") + b"\r\n"
+    data = str(value).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[List[str]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command (e.g. `PING` typed into telnet)
+        return line.decode("utf-8").split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+    return args
+
+
+def _run_one(args: List[str]):
+    try:
+        result = execute(args)
+    except CommandError as e:
+        return e
+    except (IndexError, ValueError):
+        return CommandError(f"ERR wrong arguments for '{args[0]}' command")
+    if args[0].upper() in WRITE_COMMANDS:
+        _touch(args[1])
+    return result
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    queued: Optional[List[List[str]]] = None
+    watched: Dict[str, int] = {}
+    try:
+        while True:
+            args = await _read_command(reader)
+            if args is None:
+                break
+            if not args:
+                continue
+            name = args[0].upper()
+            # Everything below runs without awaiting, so each command (and EXEC) is atomic
+            if name == "MULTI":
+                queued = []
+                reply = "OK"
+            elif name == "WATCH":
+                for key in args[1:]:
+                    watched[key] = _versions.get(key, 0)
+                reply = "OK"
+            elif name == "UNWATCH":
+                watched.clear()
+                reply = "OK"
+            elif name == "DISCARD":
+                queued = None
+                watched.clear()
+                reply = "OK"
+            elif name == "EXEC":
+                if queued is None:
+                    reply = CommandError("ERR EXEC without MULTI")
+                else:
+                    for key in watched:
+                        _alive(key)
+                    changed = any(_versions.get(key, 0) != version for key, version in watched.items())
+                    reply = NIL_ARRAY if changed else [_run_one(command) for command in queued]
+                    queued = None
+                    watched.clear()
+            elif queued is not None:
+                queued.append(args)
+                reply = "QUEUED"
+            else:
+                reply = _run_one(args)
+            writer.write(_encode(reply))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int):
+    server = await asyncio.start_server(handle, host, port)
+    print(f"RESP stand-in listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6399)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""One-shot offline benchmark: mock upstream + backend + load generator.
+
+Starts bench.mock_upstream and the backend (uvicorn) on free local ports,
+with fake API keys and a throwaway data directory (history, caches,
+uploads; removed afterwards unless --keep), runs bench.loadgen against it
+and shuts both down. Arguments not listed below go to loadgen.
+
+    python -m bench.run --time-scale 0.05 --rate-429 0.05 -- --scenario mix --requests 200
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench import loadgen
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout:.0f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--keys", type=int, default=3, help="number of fake Google API keys")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument(
+        "--redis", action="store_true",
+        help="share worker state through bench.resp_server (default with --workers > 1: SQLite)",
+    )
+    parser.add_argument("--time-scale", type=float, default=0.05, help="mock latency multiplier")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--payload-mb", default="")
+    parser.add_argument("--env", action="append", default=[], help="extra backend env, e.g. --env PREPROCESS_ENABLED=false")
+    parser.add_argument("--keep", action="store_true", help="keep the throwaway data directory afterwards")
+    args, rest = parser.parse_known_args(argv)
+    if rest[:1] == ["--"]:
+        rest = rest[1:]
+
+    mock_port, backend_port, redis_port = _free_port(), _free_port(), _free_port()
+    workdir = tempfile.mkdtemp(prefix="archgemini-bench-")
+    env = dict(
+        os.environ,
+        GOOGLE_API_BASE_URL=f"http://127.0.0.1:{mock_port}",
+        QWEN_API_BASE_URL=f"http://127.0.0.1:{mock_port}/compatible-mode/v1",
+        GOOGLE_API_KEY=",".join(f"bench-key-{i:04d}" for i in range(args.keys)),
+        QWEN_API_KEY="bench-qwen-key",
+        HISTORY_DB=os.path.join(workdir, "history.db"),
+        HISTORY_IMAGES_DIR=os.path.join(workdir, "history_images"),
+        ANALYSIS_CACHE_DB=os.path.join(workdir, "analysis_cache.db"),
+        BLOB_STORE_DIR=os.path.join(workdir, "uploads"),
+        ANALYZE_UPLOAD_DIR=os.path.join(workdir, "uploads", "sessions"),
+        METRICS_ENABLED="true",
+        # One load generator looks like one client; measure the server, not the per-client buckets
+        CLIENT_RATE_LIMITS="",
+    )
+    if args.redis:
+        env["SHARED_STATE_URL"] = f"redis://127.0.0.1:{redis_port}/0"
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+
+    mock_cmd = [
+        sys.executable, "-m", "bench.mock_upstream", "--port", str(mock_port),
+        "--time-scale", str(args.time_scale), "--rate-429", str(args.rate_429), "--rate-5xx", str(args.rate_5xx),
+    ]
+    if args.payload_mb:
+        mock_cmd += ["--payload-mb", args.payload_mb]
+    backend_cmd = [
+        sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(backend_port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ]
+
+    processes = []
+    try:
+        mock = subprocess.Popen(mock_cmd, cwd=BACKEND_DIR, env=env)
+        processes.append(mock)
+        _wait_ready(f"http://127.0.0.1:{mock_port}/v1beta/models", mock)
+        if args.redis:
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "bench.resp_server", "--port", str(redis_port)], cwd=BACKEND_DIR, env=env,
+            ))
+        backend = subprocess.Popen(backend_cmd, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL)
+        processes.append(backend)
+        _wait_ready(f"http://127.0.0.1:{backend_port}/", backend)
+        print(f"mock upstream :{mock_port}, backend :{backend_port}, data in {workdir}")
+        loadgen.main(["--url", f"http://127.0.0.1:{backend_port}"] + rest)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        # Image backups of a 4K run add up to gigabytes
+        if args.keep:
+            print(f"data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Startup benchmark: import cost of `app` and time until the first request is served.
+
+Runs `python -X importtime -c "import app"` a few times and reports the
+median import time plus the slowest modules, then starts uvicorn and times
+how long it takes until `GET /` answers. Fails (exit code 1) when a budget
+is exceeded, so it can gate CI or a release build.
+
+    python -m bench.startup
+    python -m bench.startup --runs 10 --import-budget-ms 800 --out startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+from bench.run import BACKEND_DIR, _free_port
+
+# Our own modules; an import-time side effect in any of these shows up as self time
+PROJECT_MODULES = ("app", "core", "services", "prompts", "analysis_prompts", "error_prompts")
+
+
+def _env(workdir: str) -> dict:
+    return dict(
+        os.environ,
+        GOOGLE_API_KEY="bench-key-0000",
+        QWEN_API_KEY="bench-qwen-key",
+        # Unroutable, so nothing leaves the machine; warm-up failures don't block readiness
+        GOOGLE_API_BASE_URL="http://127.0.0.1:9",
+        QWEN_API_BASE_URL="http://127.0.0.1:9/compatible-mode/v1",
+        HISTORY_DB=os.path.join(workdir, "history.db"),
+        HISTORY_IMAGES_DIR=os.path.join(workdir, "history_images"),
+        ANALYSIS_CACHE_DB=os.path.join(workdir, "analysis_cache.db"),
+        BLOB_STORE_DIR=os.path.join(workdir, "uploads"),
+        ANALYZE_UPLOAD_DIR=os.path.join(workdir, "uploads", "sessions"),
+        HTTP_WARMUP_CONNECTIONS="0",
+    )
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """`-X importtime` lines -> [(module, self_us, cumulative_us)] in import order."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure_import(env: dict) -> Dict[str, object]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{result.stderr[-2000:]}")
+    rows = parse_importtime(result.stderr)
+    app_ms = next((cumulative for name, _, cumulative in rows if name == "app"), 0) / 1000
+    return {"wall_ms": wall_ms, "app_ms": app_ms, "modules": rows, "stdout": result.stdout}
+
+
+def measure_ready(env: dict, timeout: float = 60.0) -> float:
+    """Milliseconds from spawning uvicorn until `GET /` answers 200."""
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"backend exited with code {process.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1.0).status_code == 200:
+                    return (time.perf_counter() - start) * 1000
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f"backend did not become ready in {timeout:.0f}s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _is_project(name: str) -> bool:
+    return name.split(".")[0] in PROJECT_MODULES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="repetitions; medians are reported")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--import-budget-ms", type=float, default=1500, help="median `import app` limit")
+    parser.add_argument("--ready-budget-ms", type=float, default=4000, help="median spawn-to-first-response limit")
+    parser.add_argument(
+        "--module-budget-ms", type=float, default=25,
+        help="self-time limit for project modules other than app, whose own time is route setup "
+             "(catches work done at import)",
+    )
+    parser.add_argument("--skip-ready", action="store_true", help="only measure imports")
+    parser.add_argument("--out", default="", help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    env = _env(tempfile.mkdtemp(prefix="archgemini-startup-"))
+    imports = [measure_import(env) for _ in range(max(1, args.runs))]
+    ready = [] if args.skip_ready else [measure_ready(env) for _ in range(max(1, args.runs))]
+
+    # Per-module self time, median over runs
+    self_times: Dict[str, List[int]] = {}
+    for run in imports:
+        for name, self_us, _ in run["modules"]:
+            self_times.setdefault(name, []).append(self_us)
+    module_ms = {name: statistics.median(values) / 1000 for name, values in self_times.items()}
+    slowest = sorted(module_ms.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    project_ms = {name: ms for name, ms in module_ms.items() if _is_project(name)}
+
+    report = {
+        "runs": len(imports),
+        "import_app_ms": round(statistics.median(run["app_ms"] for run in imports), 1),
+        "interpreter_wall_ms": round(statistics.median(run["wall_ms"] for run in imports), 1),
+        "project_self_ms": round(sum(project_ms.values()), 1),
+        "ready_ms": round(statistics.median(ready), 1) if ready else None,
+        "slowest_modules": [{"module": name, "self_ms": round(ms, 2)} for name, ms in slowest],
+        "import_stdout_bytes": len(imports[0]["stdout"]),
+    }
+    failures = []
+    if report["import_app_ms"] > args.import_budget_ms:
+        failures.append(f"import app {report['import_app_ms']} ms > {args.import_budget_ms} ms")
+    if ready and report["ready_ms"] > args.ready_budget_ms:
+        failures.append(f"first response {report['ready_ms']} ms > {args.ready_budget_ms} ms")
+    for name, ms in sorted(project_ms.items(), key=lambda item: item[1], reverse=True):
+        if name != "app" and ms > args.module_budget_ms:
+            failures.append(f"module {name} self {ms:.1f} ms > {args.module_budget_ms} ms")
+    report["failures"] = failures
+
+    print(f"\nimport app: {report['import_app_ms']} ms (interpreter total {report['interpreter_wall_ms']} ms, "
+          f"project modules {report['project_self_ms']} ms self), median of {report['runs']}")
+    if ready:
+        print(f"spawn -> first response: {report['ready_ms']} ms")
+    print(f"{'module':<48} {'self ms':>8}")
+    for name, ms in slowest:
+        print(f"{name:<48} {ms:>8.2f}{'  *' if _is_project(name) else ''}")
+    if report["import_stdout_bytes"]:
+        print(f"note: importing app printed {report['import_stdout_bytes']} bytes")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if failures:
+        print("\nOVER BUDGET:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("\nwithin budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from core.config import settings
+
+# Blob files are written and read here; the index updates are small
+_blob_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="blob-store")
+
+_HANDLE_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Don't rewrite accessed_at on every read of a hot blob
+_TOUCH_INTERVAL = 60.0
+
+
+def valid_handle(handle: str) -> bool:
+    return bool(handle) and bool(_HANDLE_RE.match(handle))
+
+
+def _image_size(data: bytes) -> Tuple[int, int]:
+    """Width and height from the image header; raises ValueError for non-images."""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Exception as e:
+        raise ValueError(f"not a readable image: {e}") from e
+
+
+class BlobStore:
+    """Content-addressed images on disk, bounded by total size (LRU).
+
+    Each blob is stored once under its SHA-256 (`root/ab/abcdef...`) and its
+    hex digest is the handle clients send back instead of the image. The
+    SQLite index is shared by every worker process; it also remembers the
+    Gemini File API URI each blob was uploaded as, per API key (files belong
+    to the key's project) until the upload expires, and can map arbitrary
+    keys (e.g. request fingerprints) to blobs with `put_keyed`/`get_keyed`.
+
+    Methods are blocking; the `a*` wrappers run them on a small thread pool.
+    """
+
+    def __init__(self, root: str, max_bytes: int, busy_timeout: float = 30.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.busy_timeout = busy_timeout
+        self.stored = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(
+                os.path.join(self.root, "index.db"), check_same_thread=False, timeout=self.busy_timeout
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                handle TEXT PRIMARY KEY,
+                mime_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_accessed ON blobs(accessed_at)")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS blob_files (
+                handle TEXT NOT NULL,
+                key_id TEXT NOT NULL,
+                uri TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (handle, key_id)
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS blob_keys (
+                key TEXT PRIMARY KEY,
+                handle TEXT NOT NULL,
+                meta TEXT,
+                created_at REAL NOT NULL
+            )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blob_keys_handle ON blob_keys(handle)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _path(self, handle: str) -> str:
+        return os.path.join(self.root, handle[:2], handle)
+
+    @staticmethod
+    def _row(row) -> Dict:
+        handle, mime_type, size, width, height, created_at = row[:6]
+        return {
+            "handle": handle,
+            "mime_type": mime_type,
+            "size": size,
+            "width": width,
+            "height": height,
+            "created_at": created_at,
+        }
+
+    def put(self, data: bytes, mime_type: str) -> Dict:
+        """Store `data` (if new) and return its metadata plus `existing`."""
+        handle = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute(
+                "SELECT handle, mime_type, size, width, height, created_at FROM blobs WHERE handle = ?", (handle,)
+            ).fetchone()
+            if row is not None and os.path.exists(self._path(handle)):
+                conn.execute("UPDATE blobs SET accessed_at = ? WHERE handle = ?", (now, handle))
+                conn.commit()
+                self.deduplicated += 1
+                return {**self._row(row), "existing": True}
+
+        width, height = _image_size(data)
+        path = self._path(handle)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so another worker never reads a half-written blob
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (handle, mime_type, size, width, height, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (handle, mime_type, len(data), width, height, now, now),
+            )
+            self._evict(conn, keep=handle)
+            conn.commit()
+        self.stored += 1
+        return {
+            "handle": handle,
+            "mime_type": mime_type,
+            "size": len(data),
+            "width": width,
+            "height": height,
+            "created_at": now,
+            "existing": False,
+        }
+
+    def _evict(self, conn: sqlite3.Connection, keep: str):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for handle, size in conn.execute(
+            "SELECT handle, size FROM blobs WHERE handle != ? ORDER BY accessed_at ASC", (keep,)
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM blobs WHERE handle = ?", (handle,))
+            conn.execute("DELETE FROM blob_files WHERE handle = ?", (handle,))
+            conn.execute("DELETE FROM blob_keys WHERE handle = ?", (handle,))
+            try:
+                os.remove(self._path(handle))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evicted += 1
+
+    def info(self, handle: str) -> Optional[Dict]:
+        """Metadata for `handle`, or None if unknown or evicted. Counts as a use."""
+        if not valid_handle(handle):
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT handle, mime_type, size, width, height, created_at, accessed_at FROM blobs WHERE handle = ?",
+                (handle,),
+            ).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(self._path(handle)):
+                # File removed behind our back (e.g. another worker evicted it)
+                conn.execute("DELETE FROM blobs WHERE handle = ?", (handle,))
+                conn.commit()
+                return None
+            now = time.time()
+            if now - row[6] > _TOUCH_INTERVAL:
+                conn.execute("UPDATE blobs SET accessed_at = ? WHERE handle = ?", (now, handle))
+                conn.commit()
+            return self._row(row)
+
+    def read(self, handle: str) -> Optional[Tuple[bytes, str]]:
+        """`(data, mime_type)` for `handle`, or None if unknown or evicted."""
+        info = self.info(handle)
+        if info is None:
+            return None
+        try:
+            with open(self._path(handle), "rb") as f:
+                return f.read(), info["mime_type"]
+        except FileNotFoundError:
+            return None
+
+    def put_keyed(self, key: str, data: bytes, mime_type: str, meta: Optional[Dict] = None) -> Dict:
+        """Store `data` and point `key` at it; `meta` is returned with it by `get_keyed`."""
+        info = self.put(data, mime_type)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO blob_keys (key, handle, meta, created_at) VALUES (?, ?, ?, ?)",
+                (key, info["handle"], json.dumps(meta or {}, ensure_ascii=False), time.time()),
+            )
+            conn.commit()
+        return info
+
+    def get_keyed(self, key: str) -> Optional[Tuple[bytes, str, Dict]]:
+        """`(data, mime_type, meta)` stored under `key`, or None. Counts as a use of the blob."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT handle, meta, created_at FROM blob_keys WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        found = self.read(row[0])
+        if found is None:
+            return None
+        meta = json.loads(row[1] or "{}")
+        meta["stored_at"] = row[2]
+        return found[0], found[1], meta
+
+    def file_uri(self, handle: str, key_id: str, min_ttl: float = 0) -> Optional[str]:
+        """File API URI of `handle` for a key, if it outlives `min_ttl` seconds."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT uri, expires_at FROM blob_files WHERE handle = ? AND key_id = ?", (handle, key_id)
+            ).fetchone()
+        if row is None or row[1] <= time.time() + min_ttl:
+            return None
+        return row[0]
+
+    def set_file_uri(self, handle: str, key_id: str, uri: str, expires_at: float):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO blob_files (handle, key_id, uri, expires_at) VALUES (?, ?, ?, ?)",
+                (handle, key_id, uri, expires_at),
+            )
+            conn.execute("DELETE FROM blob_files WHERE expires_at < ?", (time.time(),))
+            conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            conn = self._connect()
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            files = conn.execute(
+                "SELECT COUNT(*) FROM blob_files WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+            keys = conn.execute("SELECT COUNT(*) FROM blob_keys").fetchone()[0]
+        return {
+            "root": self.root,
+            "blobs": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "file_uris": files,
+            "keys": keys,
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+        }
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(_blob_executor, fn, *args)
+
+    async def aput(self, data: bytes, mime_type: str) -> Dict:
+        return await self._run(self.put, data, mime_type)
+
+    async def ainfo(self, handle: str) -> Optional[Dict]:
+        return await self._run(self.info, handle)
+
+    async def aread(self, handle: str) -> Optional[Tuple[bytes, str]]:
+        return await self._run(self.read, handle)
+
+    async def aput_keyed(self, key: str, data: bytes, mime_type: str, meta: Optional[Dict] = None) -> Dict:
+        return await self._run(self.put_keyed, key, data, mime_type, meta)
+
+    async def aget_keyed(self, key: str) -> Optional[Tuple[bytes, str, Dict]]:
+        return await self._run(self.get_keyed, key)
+
+    async def afile_uri(self, handle: str, key_id: str, min_ttl: float = 0) -> Optional[str]:
+        return await self._run(self.file_uri, handle, key_id, min_ttl)
+
+    async def aset_file_uri(self, handle: str, key_id: str, uri: str, expires_at: float):
+        await self._run(self.set_file_uri, handle, key_id, uri, expires_at)
+
+    async def astats(self) -> Dict:
+        return await self._run(self.stats)
+
+
+blob_store = BlobStore(
+    settings.BLOB_STORE_DIR,
+    max_bytes=settings.BLOB_STORE_MAX_BYTES,
+    busy_timeout=settings.SQLITE_BUSY_TIMEOUT,
+)
@@ -1,8 +1,11 @@
 import os
 from dotenv import load_dotenv
+from core.key_pool import KeyPool
 
 load_dotenv()
 
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class Settings:
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
     QWEN_API_KEY = os.getenv("QWEN_API_KEY")
@@ -14,40 +17,185 @@ class Settings:
     GEMINI_VISION_MODEL = os.getenv("GEMINI_VISION_MODEL", "gemini-3-pro-image-preview")
     QWEN_MODEL = os.getenv("QWEN_MODEL", "qwen-plus")
 
+    # Generation routing: retries per error class ("class:count,..."), backoff, hedging
+    GEMINI_RETRY_POLICY = os.getenv("GEMINI_RETRY_POLICY", "throttled:2,server:2,timeout:1,network:2")
+    GEMINI_RETRY_BACKOFF_BASE = float(os.getenv("GEMINI_RETRY_BACKOFF_BASE", "1.0"))
+    GEMINI_RETRY_BACKOFF_MAX = float(os.getenv("GEMINI_RETRY_BACKOFF_MAX", "20"))
+    GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+    GEMINI_HEDGE_QUANTILE = float(os.getenv("GEMINI_HEDGE_QUANTILE", "0.95"))
+    GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+    GEMINI_HEDGE_MAX_RATIO = float(os.getenv("GEMINI_HEDGE_MAX_RATIO", "0.1"))
+    GEMINI_HEDGE_TO_FALLBACK = os.getenv("GEMINI_HEDGE_TO_FALLBACK", "false").lower() in ("1", "true", "yes")
+
+    # Multi-variant generation: models that honour generationConfig.candidateCount
+    # (probe with debug_params.py); others fan out into concurrent calls
+    GEMINI_CANDIDATE_COUNT_MODELS = [
+        m.strip() for m in os.getenv("GEMINI_CANDIDATE_COUNT_MODELS", "").split(",") if m.strip()
+    ]
+    MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "4"))
+
+    # "Describe references first" stage for composition mode
+    REFERENCE_ANALYSIS_CONCURRENCY = int(os.getenv("REFERENCE_ANALYSIS_CONCURRENCY", "4"))
+    REFERENCE_ANALYSIS_TIMEOUT = float(os.getenv("REFERENCE_ANALYSIS_TIMEOUT", "45"))
+
+    # Background job queue for /api/jobs/*
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+    JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+    JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))
+
+    # API key pool health tracking
+    KEY_THROTTLE_COOLDOWN = float(os.getenv("KEY_THROTTLE_COOLDOWN", "30"))
+    KEY_REJECTED_COOLDOWN = float(os.getenv("KEY_REJECTED_COOLDOWN", "300"))
+    KEY_MAX_ATTEMPTS = int(os.getenv("KEY_MAX_ATTEMPTS", "3"))
+
+    # Image analysis result cache (memory LRU + SQLite)
+    ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    ANALYSIS_CACHE_MEMORY_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MEMORY_ENTRIES", "256"))
+    ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+    ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))
+    ANALYSIS_CACHE_DB = os.getenv("ANALYSIS_CACHE_DB", os.path.join(BACKEND_DIR, "analysis_cache.db"))
+
+    # Qwen result memoization
+    QWEN_CACHE_ENTRIES = int(os.getenv("QWEN_CACHE_ENTRIES", "512"))
+    QWEN_CACHE_TTL = float(os.getenv("QWEN_CACHE_TTL", "3600"))
+
+    # Duplicate generation requests (core/dedup.py): identical concurrent requests from
+    # one client share one upstream call. A finished result is replayed for
+    # IDEMPOTENCY_TTL seconds when the client sent an Idempotency-Key header; without
+    # one, only for DEDUP_REPLAY_WINDOW seconds, which defaults to 0 (in-flight only)
+    # because resubmitting the same prompt is how users ask for another variant
+    DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+    DEDUP_REPLAY_WINDOW = float(os.getenv("DEDUP_REPLAY_WINDOW", "0"))
+    IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+    DEDUP_MAX_BYTES = int(os.getenv("DEDUP_MAX_BYTES", str(256 * 1024 * 1024)))
+
+    # Adaptive concurrency limits (core/limiter.py)
+    LIMITER_MAX_QUEUE = int(os.getenv("LIMITER_MAX_QUEUE", "50"))
+    LIMITER_QUEUE_TIMEOUT = float(os.getenv("LIMITER_QUEUE_TIMEOUT", "30"))
+    GEMINI_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_CONCURRENCY_PER_KEY", "4"))
+
+    # Upstream HTTP pools (core/http_client.py); HTTP/2 needs the optional `h2` package
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
+    GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "100"))
+    GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "40"))
+    QWEN_MAX_CONNECTIONS = int(os.getenv("QWEN_MAX_CONNECTIONS", "50"))
+    QWEN_MAX_KEEPALIVE = int(os.getenv("QWEN_MAX_KEEPALIVE", "20"))
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+    # Connections opened per upstream at startup (one is enough with HTTP/2); 0 disables
+    HTTP_WARMUP_CONNECTIONS = int(os.getenv("HTTP_WARMUP_CONNECTIONS", "2"))
+
+    # Per-client fairness (core/fairness.py). Clients are identified by IP unless
+    # they send a known token in CLIENT_TOKEN_HEADER ("token:name,...").
+    CLIENT_TOKEN_HEADER = os.getenv("CLIENT_TOKEN_HEADER", "X-Client-Token")
+    CLIENT_TOKENS = os.getenv("CLIENT_TOKENS", "")
+    # Peers whose X-Real-IP / X-Forwarded-For is trusted (the Nginx front end)
+    TRUSTED_PROXIES = [
+        p.strip() for p in os.getenv("TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if p.strip()
+    ]
+    # Fair-queueing weights per client name or IP ("name:weight,..."), default 1
+    CLIENT_WEIGHTS = os.getenv("CLIENT_WEIGHTS", "")
+    # Token buckets per route: "route:units_per_minute/burst"; 1K=1 unit, 2K=2, 4K=4
+    CLIENT_RATE_LIMITS = os.getenv("CLIENT_RATE_LIMITS", "generate:20/12,analyze:30/10,optimize:60/20")
+
+    # /metrics (core/metrics.py); off = spans and the loop-lag probe are no-ops
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+    METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
+
+    # Request history (SQLite) and image backups; override to keep benchmark runs separate
+    HISTORY_DB = os.getenv("HISTORY_DB", os.path.join(BACKEND_DIR, "history.db"))
+    HISTORY_IMAGES_DIR = os.getenv("HISTORY_IMAGES_DIR", os.path.join(BACKEND_DIR, "history_images"))
+
+    # Persistent generation results by request fingerprint (services/generation_cache.py).
+    # Opt-in: a hit returns the earlier image instead of a fresh render. Stored under
+    # HISTORY_IMAGES_DIR/cache/, least recently used evicted past the quota.
+    GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(5 * 1024 * 1024 * 1024)))
+
+    # State shared by `uvicorn --workers N` processes (core/shared_state.py): global
+    # upstream slots, client token buckets, API key cooldowns and job snapshots.
+    # "memory", "sqlite:///path/state.db" or "redis://[:password@]host:6379/0";
+    # "auto" = SQLite next to HISTORY_DB when running as a worker process, else memory.
+    SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "auto")
+    SHARED_STATE_SYNC_INTERVAL = float(os.getenv("SHARED_STATE_SYNC_INTERVAL", "1"))
+    # A worker that dies holding a global upstream slot gives it back after this long
+    SHARED_SLOT_TTL = float(os.getenv("SHARED_SLOT_TTL", "300"))
+    # Seconds a SQLite connection waits for another process's write lock
+    SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))
+
+    # Background request-log writer
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "1000"))
+    LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+    # Image backups waiting in the queue; past this, entries are logged without their image
+    LOG_QUEUE_MAX_BYTES = int(os.getenv("LOG_QUEUE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+    # Thumbnail / preview rendering (process pool)
+    DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+
+    # Input downscaling / re-encoding before upload to Gemini
+    PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() in ("1", "true", "yes")
+    PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+    PREPROCESS_SKIP_BYTES = int(os.getenv("PREPROCESS_SKIP_BYTES", str(512 * 1024)))
+    PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", "90"))
+    VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "1536"))
+
+    # Reference images uploaded once via /api/uploads and referenced by handle (core/blobs.py)
+    BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", os.path.join(BACKEND_DIR, "uploads"))
+    BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+    # Largest single file accepted by /api/uploads, before preprocessing
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(30 * 1024 * 1024)))
+    # Files per /api/uploads request, and the whole request body (refused early with 413)
+    UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "10"))
+    UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))
+    # /api/analyze-image reads uploads from disk, never whole into memory (core/uploads.py).
+    # Largest file it accepts, directly or via resumable chunked upload sessions; sessions
+    # live under ANALYZE_UPLOAD_DIR until ANALYZE_UPLOAD_TTL seconds after their last chunk.
+    ANALYZE_UPLOAD_MAX_BYTES = int(os.getenv("ANALYZE_UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+    ANALYZE_UPLOAD_DIR = os.getenv("ANALYZE_UPLOAD_DIR", os.path.join(BACKEND_DIR, "uploads", "sessions"))
+    ANALYZE_UPLOAD_TTL = float(os.getenv("ANALYZE_UPLOAD_TTL", str(24 * 3600)))
+    # Send stored references as Gemini File API URIs (uploaded once per key, kept ~48h)
+    # instead of inline base64. Off by default: many relays don't proxy /upload/.
+    GEMINI_FILE_API_ENABLED = os.getenv("GEMINI_FILE_API_ENABLED", "false").lower() in ("1", "true", "yes")
+
     def __init__(self):
         # Support multiple keys separated by comma
         raw_keys = os.getenv("GOOGLE_API_KEY", "")
         self.GOOGLE_API_KEYS = [k.strip() for k in raw_keys.split(",") if k.strip()]
-        self._key_index = 0
+        self.key_pool = KeyPool(
+            self.GOOGLE_API_KEYS,
+            throttle_cooldown=self.KEY_THROTTLE_COOLDOWN,
+            rejected_cooldown=self.KEY_REJECTED_COOLDOWN,
+            max_attempts=self.KEY_MAX_ATTEMPTS,
+        )
         
         # Keep the single property for backward compatibility (returns the first one or None)
         self.GOOGLE_API_KEY = self.GOOGLE_API_KEYS[0] if self.GOOGLE_API_KEYS else None
 
     def get_google_api_key(self) -> str:
-        """Get the next API key in rotation."""
-        if not self.GOOGLE_API_KEYS:
-            return None
-        
-        # Round-robin selection
-        key = self.GOOGLE_API_KEYS[self._key_index]
-        self._key_index = (self._key_index + 1) % len(self.GOOGLE_API_KEYS)
-        return key
+        """Get the least-loaded healthy API key.
+
+        Prefer `key_pool.call()` for upstream requests so the outcome is tracked
+        and throttled keys are retried on another key.
+        """
+        return self.key_pool.pick()
 
 settings = Settings()
 
-# Debug: Print loaded configuration
-print("="*30)
-print("ArchGemini Backend Configuration:")
-print(f"GOOGLE_API_BASE_URL: {settings.GOOGLE_API_BASE_URL}")
-print(f"GEMINI_IMAGE_MODEL: {settings.GEMINI_IMAGE_MODEL}")
-if settings.GOOGLE_API_KEYS:
-    print(f"GOOGLE_API_KEYS: Loaded {len(settings.GOOGLE_API_KEYS)} keys.")
-    print(f"Current Key (Ends with): ...{settings.GOOGLE_API_KEYS[0][-4:] if len(settings.GOOGLE_API_KEYS[0]) > 4 else '****'}")
-else:
-    print("GOOGLE_API_KEY: Not Set")
-
-if settings.QWEN_API_KEY:
-    print(f"QWEN_API_KEY: Found (Ends with ...{settings.QWEN_API_KEY[-4:] if len(settings.QWEN_API_KEY) > 4 else '****'})")
-else:
-    print("QWEN_API_KEY: Not Set")
-print("="*30)
+def print_config():
+    """Debug: Print loaded configuration. Called from the app lifespan, not at import,
+    so tools and `--reload` parent processes that import config stay quiet and fast."""
+    print("="*30)
+    print("ArchGemini Backend Configuration:")
+    print(f"GOOGLE_API_BASE_URL: {settings.GOOGLE_API_BASE_URL}")
+    print(f"GEMINI_IMAGE_MODEL: {settings.GEMINI_IMAGE_MODEL}")
+    if settings.GOOGLE_API_KEYS:
+        print(f"GOOGLE_API_KEYS: Loaded {len(settings.GOOGLE_API_KEYS)} keys.")
+        print(f"Current Key (Ends with): ...{settings.GOOGLE_API_KEYS[0][-4:] if len(settings.GOOGLE_API_KEYS[0]) > 4 else '****'}")
+    else:
+        print("GOOGLE_API_KEY: Not Set")
+
+    if settings.QWEN_API_KEY:
+        print(f"QWEN_API_KEY: Found (Ends with ...{settings.QWEN_API_KEY[-4:] if len(settings.QWEN_API_KEY) > 4 else '****'})")
+    else:
+        print("QWEN_API_KEY: Not Set")
+    print("="*30)
@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from core.config import settings
+from core.shared_state import WORKER_ID, shared_state
+from core.singleflight import SingleFlight
+
+# Outcomes, also sent back in the X-Dedup response header
+MISS = "miss"
+JOINED = "joined"
+REPLAYED = "replayed"
+
+# Hash payloads bigger than this on a thread instead of the event loop
+_THREAD_HASH_BYTES = 1024 * 1024
+
+# Larger shared documents aren't written to the state backend (it also holds slots and buckets)
+_SHARED_DOC_BYTES = 64 * 1024
+
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key was reused with a different request body (maps to 422)."""
+
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__(f"Idempotency-Key {key!r} was already used for a different request")
+
+
+def _digest(parts: list) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, (bytes, bytearray, memoryview)) else str(part).encode("utf-8")
+        # Length-prefix each part so ("ab", "c") and ("a", "bc") differ
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+async def fingerprint(fields: Dict[str, Any], blobs: Tuple = ()) -> str:
+    """Canonical hash of a request: its scalar fields plus any image payloads.
+
+    `fields` are serialised with sorted keys, so field order and JSON
+    formatting don't matter; `blobs` (base64 strings or raw bytes) are hashed
+    in order.
+    """
+    parts = [json.dumps(fields, sort_keys=True, ensure_ascii=False, separators=(",", ":"))] + list(blobs)
+    if sum(len(b) for b in blobs) > _THREAD_HASH_BYTES:
+        return await asyncio.to_thread(_digest, parts)
+    return _digest(parts)
+
+
+def _size(value: Any) -> int:
+    """Rough in-memory size of a result: the strings and bytes it holds."""
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    return 64
+
+
+class ReplayStore:
+    """Recently completed results by key, bounded by total size and per-entry TTL."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key -> (fingerprint, value, size, expires_at)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[3] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key: str, fp: str, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._data[key] = (fp, value, size, time.monotonic() + ttl)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+
+    def _remove(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SharedCodec:
+    """How a result is shared with other workers: as a small JSON document.
+
+    The default shares the result as is; results holding images override
+    `pack` to move the image elsewhere (e.g. the BlobStore) and `unpack` to
+    load it back, returning None once it is gone.
+    """
+
+    async def pack(self, value: Any) -> Any:
+        return value
+
+    async def unpack(self, doc: Any) -> Optional[Any]:
+        return doc
+
+
+class RequestDeduplicator:
+    """Coalesce duplicate generation requests from the same client.
+
+    - Concurrent requests with the same key share one call (SingleFlight).
+    - A completed result is replayed for `idempotency_ttl` when the client
+      sent an explicit Idempotency-Key, otherwise for `replay_window` seconds
+      (0 = never: a resubmitted prompt gets a fresh generation).
+    - An explicit key reused with a different body raises IdempotencyConflict.
+
+    Keys are scoped per client, so nobody can read another client's result
+    by guessing a key. With a cross-process state backend, explicit keys are
+    also coalesced across workers (`share_results`): the first worker takes a
+    one-holder lease on the key and publishes the result for the others,
+    packed by `codec`. Documents over 64 KB are not shared.
+    """
+
+    def __init__(
+        self, name: str, replay_window: float, idempotency_ttl: float, max_bytes: int, enabled: bool = True
+    ):
+        self.name = name
+        self.enabled = enabled
+        self.replay_window = replay_window
+        self.idempotency_ttl = idempotency_ttl
+        self._flights = SingleFlight()
+        self._fingerprints: Dict[str, str] = {}
+        self._replay = ReplayStore(max_bytes)
+        self.counts = {MISS: 0, JOINED: 0, REPLAYED: 0}
+        self.conflicts = 0
+
+    def _check(self, fp: str, stored_fp: str, idempotency_key: Optional[str]):
+        if idempotency_key and stored_fp != fp:
+            self.conflicts += 1
+            raise IdempotencyConflict(idempotency_key)
+
+    async def run(
+        self,
+        client: str,
+        fp: str,
+        fn: Callable[[], Awaitable[Any]],
+        idempotency_key: Optional[str] = None,
+        share_results: bool = False,
+        codec: Optional[SharedCodec] = None,
+    ) -> Tuple[Any, str]:
+        """Return `(result, outcome)`, calling `fn()` only if no duplicate is in flight or fresh.
+
+        `fp` is the request's `fingerprint()`. Failures are never replayed.
+        """
+        if not self.enabled:
+            return await fn(), MISS
+        explicit = bool(idempotency_key)
+        key = f"{client}:{'key:' + idempotency_key if explicit else fp}"
+
+        hit = self._replay.get(key)
+        if hit is not None:
+            self._check(fp, hit[0], idempotency_key)
+            self.counts[REPLAYED] += 1
+            return hit[1], REPLAYED
+
+        if key in self._fingerprints:
+            self._check(fp, self._fingerprints[key], idempotency_key)
+            self.counts[JOINED] += 1
+            value, _ = await self._flights.do(key, fn)
+            return value, JOINED
+
+        self._fingerprints[key] = fp
+        ttl = self.idempotency_ttl if explicit else self.replay_window
+
+        async def lead():
+            try:
+                if explicit and share_results and shared_state.distributed:
+                    value, outcome = await self._lead_shared(key, fp, fn, idempotency_key, codec or SharedCodec())
+                else:
+                    value, outcome = await fn(), MISS
+                self._replay.put(key, fp, value, ttl)
+                return value, outcome
+            finally:
+                self._fingerprints.pop(key, None)
+
+        value, outcome = await self._flights.do(key, lead)
+        self.counts[outcome] += 1
+        return value, outcome
+
+    async def _lead_shared(
+        self, key: str, fp: str, fn: Callable[[], Awaitable[Any]], idempotency_key: str, codec: SharedCodec
+    ) -> Tuple[Any, str]:
+        doc_key = f"idempotency:{self.name}:{key}"
+        holder = f"{WORKER_ID}:{id(fn)}"
+        deadline = time.monotonic() + settings.SHARED_SLOT_TTL
+        try:
+            while True:
+                doc = await shared_state.get_json(doc_key)
+                if doc is not None:
+                    self._check(fp, doc["fingerprint"], idempotency_key)
+                    value = await codec.unpack(doc["value"])
+                    if value is not None:
+                        return value, REPLAYED
+                    # The shared result's payload is gone (e.g. evicted); generate and publish it again
+                    break
+                if await shared_state.acquire_slot(doc_key, holder, 1, settings.SHARED_SLOT_TTL):
+                    break
+                if time.monotonic() > deadline:
+                    break
+                # Another worker is running it; wait for its result (or its lease to go)
+                await asyncio.sleep(0.5)
+        except IdempotencyConflict:
+            raise
+        except Exception as e:
+            print(f"Shared idempotency check for {self.name} skipped: {e}")
+            return await fn(), MISS
+
+        try:
+            value = await fn()
+            try:
+                doc = {"fingerprint": fp, "value": await codec.pack(value)}
+                if _size(doc) > _SHARED_DOC_BYTES:
+                    print(f"Idempotent result for {self.name} too large to share ({_size(doc)} bytes)")
+                else:
+                    await shared_state.set_json(doc_key, doc, self.idempotency_ttl)
+            except Exception as e:
+                print(f"Failed to share idempotent result for {self.name}: {e}")
+            return value, MISS
+        finally:
+            try:
+                await shared_state.release_slot(doc_key, holder)
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            **self.counts,
+            "conflicts": self.conflicts,
+            "in_flight": self._flights.in_flight(),
+            "replay_entries": len(self._replay),
+            "replay_bytes": self._replay.bytes,
+            "replay_window": self.replay_window,
+            "idempotency_ttl": self.idempotency_ttl,
+        }
+
+
+def idempotency_key(request) -> Optional[str]:
+    """The request's Idempotency-Key header (trimmed, at most 200 chars), if any."""
+    key = (request.headers.get("idempotency-key") or "").strip()
+    return key[:200] or None
+
+
+generation_dedup = RequestDeduplicator(
+    "generate",
+    replay_window=settings.DEDUP_REPLAY_WINDOW,
+    idempotency_ttl=settings.IDEMPOTENCY_TTL,
+    max_bytes=settings.DEDUP_MAX_BYTES,
+    enabled=settings.DEDUP_ENABLED,
+)
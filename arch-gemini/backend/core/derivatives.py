@@ -0,0 +1,132 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from core.config import settings
+from core.logger import IMAGES_DIR
+from core.singleflight import SingleFlight
+
+DERIVED_DIR = os.path.join(IMAGES_DIR, "derived")
+
+# variant -> longest edge in pixels
+VARIANTS: Dict[str, int] = {
+    "thumb": 256,
+    "preview": 1024,
+}
+
+# format -> (Pillow format, file extension, media type, quality)
+FORMATS: Dict[str, Tuple[str, str, str, int]] = {
+    "webp": ("WEBP", "webp", "image/webp", 80),
+    "jpeg": ("JPEG", "jpg", "image/jpeg", 85),
+}
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_flights = SingleFlight()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.DERIVATIVE_WORKERS)
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True, cancel_futures=True)
+            _executor = None
+
+
+def derivative_path(filename: str, variant: str, fmt: str) -> str:
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(DERIVED_DIR, f"{stem}.{variant}.{FORMATS[fmt][1]}")
+
+
+def _render(source: str, outputs: List[Tuple[str, int, str, int]]) -> List[str]:
+    """Resize `source` once per output. Runs in a worker process.
+
+    Each output is (target path, longest edge, Pillow format, quality). Larger
+    sizes are rendered first and reused as the base for smaller ones.
+    """
+    from PIL import Image
+
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+    written = []
+    with Image.open(source) as original:
+        original.load()
+        current = original
+        for target, edge, pil_format, quality in sorted(outputs, key=lambda o: -o[1]):
+            img = current.copy()
+            img.thumbnail((edge, edge), Image.LANCZOS)
+            current = img
+            if pil_format == "JPEG" and img.mode != "RGB":
+                if img.mode in ("RGBA", "LA", "P"):
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+                else:
+                    img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.mode else "RGB")
+            tmp = target + ".tmp"
+            img.save(tmp, pil_format, quality=quality, optimize=True)
+            os.replace(tmp, target)
+            written.append(target)
+    return written
+
+
+def _outputs_for(filename: str, variants: List[str], formats: List[str]) -> List[Tuple[str, int, str, int]]:
+    outputs = []
+    for variant in variants:
+        for fmt in formats:
+            pil_format, _, _, quality = FORMATS[fmt]
+            outputs.append((derivative_path(filename, variant, fmt), VARIANTS[variant], pil_format, quality))
+    return outputs
+
+
+def schedule_all(filename: str):
+    """Queue every derivative of a freshly saved image. Safe to call from any thread."""
+    source = os.path.join(IMAGES_DIR, filename)
+    outputs = _outputs_for(filename, list(VARIANTS), list(FORMATS))
+    future = _get_executor().submit(_render, source, outputs)
+
+    def _report(f):
+        if not f.cancelled() and f.exception() is not None:
+            print(f"Failed to render derivatives for {filename}: {f.exception()}")
+
+    future.add_done_callback(_report)
+
+
+async def ensure(filename: str, variant: str, fmt: str) -> Optional[str]:
+    """Path of a derivative, rendering it on first request (e.g. legacy images)."""
+    source = os.path.join(IMAGES_DIR, filename)
+    if not filename or os.path.basename(filename) != filename or not os.path.isfile(source):
+        return None
+    target = derivative_path(filename, variant, fmt)
+    if os.path.isfile(target):
+        return target
+
+    async def render():
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_get_executor(), _render, source, _outputs_for(filename, [variant], [fmt]))
+        return target
+
+    return await _flights.do(target, render)
+
+
+def etag_for(path: str) -> str:
+    stat = os.stat(path)
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def pick_format(requested: Optional[str], accept: str) -> str:
+    if requested in FORMATS:
+        return requested
+    return "webp" if "image/webp" in (accept or "") else "jpeg"
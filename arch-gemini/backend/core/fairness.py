@@ -0,0 +1,221 @@
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from core.config import settings
+from core.limiter import Overloaded, get_limiter
+from core.shared_state import shared_state
+
+# Relative cost of one generation per resolution (token-bucket units and queue weight)
+RESOLUTION_COST = {
+    "1K": 1.0,
+    "2K": 2.0,
+    "4K": 4.0,
+}
+
+# Idle bucket readings are dropped after this long so the table doesn't grow with every IP seen
+BUCKET_IDLE_TTL = 3600.0
+
+
+class RateLimited(Exception):
+    """Raised when a client's token bucket for a route is empty (maps to 429)."""
+
+    def __init__(self, client: str, route: str, retry_after: float):
+        self.client = client
+        self.route = route
+        self.retry_after = retry_after
+        super().__init__(f"Rate limited ({client} on {route}), retry after {retry_after:.0f}s")
+
+
+def parse_mapping(spec: str) -> Dict[str, str]:
+    """Parse "a:x,b:y" into {"a": "x", "b": "y"}."""
+    mapping = {}
+    for item in (spec or "").split(","):
+        if ":" not in item:
+            continue
+        name, value = item.rsplit(":", 1)
+        if name.strip():
+            mapping[name.strip()] = value.strip()
+    return mapping
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Parse "generate:20/12,..." into {route: (units per second, burst)}."""
+    limits = {}
+    for route, value in parse_mapping(spec).items():
+        per_minute, _, burst = value.partition("/")
+        try:
+            rate = float(per_minute) / 60.0
+            limits[route] = (rate, float(burst) if burst else max(1.0, rate * 60.0))
+        except ValueError:
+            continue
+    return limits
+
+
+def resolution_cost(resolution: Optional[str]) -> float:
+    return RESOLUTION_COST.get((resolution or "1K").upper(), 1.0)
+
+
+class ClientRegistry:
+    """Client identity, fair-queueing weights and per-route token buckets.
+
+    The buckets live in the shared state backend, so a client's allowance is
+    the same however many worker processes its requests are spread over.
+    """
+
+    def __init__(
+        self,
+        token_header: str,
+        tokens: Dict[str, str],
+        trusted_proxies: List[str],
+        weights: Dict[str, float],
+        rate_limits: Dict[str, Tuple[float, float]],
+    ):
+        self.token_header = token_header
+        self.tokens = tokens
+        self.trusted_proxies = set(trusted_proxies)
+        self.weights = weights
+        self.rate_limits = rate_limits
+        # (route, client) -> (tokens, rate, burst, seen at) as of this worker's last charge
+        self._levels: Dict[Tuple[str, str], Tuple[float, float, float, float]] = {}
+        self._lock = threading.Lock()
+        self.rate_limited: Dict[str, int] = {}
+        self._last_sweep = time.monotonic()
+
+    def client_ip(self, request) -> str:
+        """Peer IP, or the forwarded one when the peer is a trusted reverse proxy."""
+        peer = request.client.host if request.client else "unknown"
+        if peer in self.trusted_proxies:
+            forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "")
+            forwarded = forwarded.split(",")[0].strip()
+            if forwarded:
+                return forwarded
+        return peer
+
+    def identify(self, request) -> str:
+        """Client name for a FastAPI request: a known token's name, else the IP.
+
+        Unknown tokens are ignored so nobody can dodge their bucket by sending
+        a fresh header on every request.
+        """
+        token = request.headers.get(self.token_header) if self.token_header else None
+        if token and token in self.tokens:
+            return self.tokens[token]
+        return self.client_ip(request)
+
+    def weight(self, client: str) -> float:
+        return self.weights.get(client, 1.0)
+
+    def _limit(self, route: str, client: str) -> Optional[Tuple[float, float]]:
+        limit = self.rate_limits.get(route)
+        if limit is None:
+            return None
+        # Heavier-weighted clients get a proportionally larger allowance
+        weight = self.weight(client)
+        return limit[0] * weight, limit[1] * weight
+
+    def _record(self, route: str, client: str, tokens: float, rate: float, burst: float):
+        """Remember the last bucket level this worker saw, for /api/admin/clients."""
+        now = time.monotonic()
+        with self._lock:
+            self._levels[(route, client)] = (tokens, rate, burst, now)
+            if now - self._last_sweep >= BUCKET_IDLE_TTL:
+                self._last_sweep = now
+                for key, level in list(self._levels.items()):
+                    if now - level[3] > BUCKET_IDLE_TTL:
+                        del self._levels[key]
+
+    async def charge(self, route: str, client: str, cost: float = 1.0):
+        """Take `cost` units from the client's bucket for `route` or raise RateLimited."""
+        limit = self._limit(route, client)
+        if limit is None:
+            return
+        rate, burst = limit
+        try:
+            tokens, wait = await shared_state.take_tokens(f"{route}:{client}", rate, burst, cost)
+        except Exception as e:
+            # Fail open: an unreachable state backend shouldn't turn into a 429 for everyone
+            print(f"Rate limit check for {client} on {route} skipped: {e}")
+            return
+        self._record(route, client, tokens, rate, burst)
+        if wait:
+            with self._lock:
+                self.rate_limited[client] = self.rate_limited.get(client, 0) + 1
+            raise RateLimited(client, route, wait)
+
+    async def refund(self, route: str, client: str, cost: float = 1.0):
+        """Give units back, e.g. when the request was shed before doing any work."""
+        limit = self._limit(route, client)
+        if limit is None:
+            return
+        try:
+            await shared_state.refund_tokens(f"{route}:{client}", limit[0], limit[1], cost)
+        except Exception as e:
+            print(f"Rate limit refund for {client} on {route} failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            buckets: Dict[str, dict] = {}
+            for (route, client), (tokens, rate, burst, seen) in self._levels.items():
+                buckets.setdefault(client, {})[route] = {
+                    "tokens": round(min(burst, tokens + (now - seen) * rate), 2),
+                    "burst": burst,
+                }
+            return {
+                "weights": dict(self.weights),
+                "rate_limits": {
+                    route: {"per_minute": round(rate * 60, 2), "burst": burst}
+                    for route, (rate, burst) in self.rate_limits.items()
+                },
+                "buckets": buckets,
+                "rate_limited": dict(self.rate_limited),
+            }
+
+
+def _parse_weights(spec: str) -> Dict[str, float]:
+    weights = {}
+    for name, value in parse_mapping(spec).items():
+        try:
+            weights[name] = max(0.01, float(value))
+        except ValueError:
+            continue
+    return weights
+
+
+clients = ClientRegistry(
+    token_header=settings.CLIENT_TOKEN_HEADER,
+    tokens=parse_mapping(settings.CLIENT_TOKENS),
+    trusted_proxies=settings.TRUSTED_PROXIES,
+    weights=_parse_weights(settings.CLIENT_WEIGHTS),
+    rate_limits=parse_rate_limits(settings.CLIENT_RATE_LIMITS),
+)
+
+
+async def admit(route: str, client: str, cost: float = 1.0):
+    """Charge the client's bucket, then wait for a fair slot in the route limiter.
+
+    Returns the limiter; the caller must `release()` it. Prefer `client_slot`.
+    """
+    await clients.charge(route, client, cost)
+    limiter = get_limiter(f"route:{route}")
+    try:
+        await limiter.acquire(client, cost, clients.weight(client))
+    except Overloaded:
+        await clients.refund(route, client, cost)
+        raise
+    return limiter
+
+
+@asynccontextmanager
+async def client_slot(route: str, client: str, cost: float = 1.0):
+    """Rate-limit and fairly admit one request from `client` for the block."""
+    await clients.charge(route, client, cost)
+    try:
+        async with get_limiter(f"route:{route}").slot(client, cost, clients.weight(client)):
+            yield
+    except Overloaded as e:
+        if e.name == f"route:{route}":
+            await clients.refund(route, client, cost)
+        raise
@@ -0,0 +1,140 @@
+import base64
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Optional, Tuple
+
+from core.config import settings
+from core.logger import DB_PATH, IMAGES_DIR, ensure_db
+
+MAX_PAGE_SIZE = 100
+
+_local = threading.local()
+
+_COLUMNS = "id, timestamp, client_ip, prompt, model, api_key_suffix, image_filename, request_type"
+
+
+def _connection() -> sqlite3.Connection:
+    """One read connection per worker thread; the log writer owns the write side."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        ensure_db()
+        conn = sqlite3.connect(DB_PATH, timeout=settings.SQLITE_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        _local.conn = conn
+    return conn
+
+
+def encode_cursor(timestamp: str, log_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp}|{log_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return timestamp, log_id
+
+
+def _row_to_item(row: sqlite3.Row) -> dict:
+    has_image = bool(row["image_filename"])
+    return {
+        "id": row["id"],
+        "timestamp": row["timestamp"],
+        "client_ip": row["client_ip"],
+        "prompt": row["prompt"],
+        "model": row["model"],
+        "api_key_suffix": row["api_key_suffix"],
+        "request_type": row["request_type"],
+        "has_image": has_image,
+        "image_url": f"/api/history/{row['id']}/image" if has_image else None,
+        "thumbnail_url": f"/api/history/{row['id']}/thumbnail" if has_image else None,
+        "preview_url": f"/api/history/{row['id']}/preview" if has_image else None,
+    }
+
+
+def list_history(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    model: Optional[str] = None,
+    request_type: Optional[str] = None,
+    client_ip: Optional[str] = None,
+    api_key_suffix: Optional[str] = None,
+) -> dict:
+    """Newest-first page of request logs using keyset pagination on (timestamp, id)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    clauses = []
+    params: list = []
+
+    if cursor:
+        cursor_ts, cursor_id = decode_cursor(cursor)
+        clauses.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+        params.extend([cursor_ts, cursor_ts, cursor_id])
+    if since:
+        clauses.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        clauses.append("timestamp < ?")
+        params.append(until)
+    if model:
+        clauses.append("model = ?")
+        params.append(model)
+    if request_type:
+        clauses.append("request_type = ?")
+        params.append(request_type)
+    if client_ip:
+        clauses.append("client_ip = ?")
+        params.append(client_ip)
+    if api_key_suffix:
+        clauses.append("api_key_suffix = ?")
+        params.append(api_key_suffix)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # Fetch one extra row to know whether another page exists
+    rows = _connection().execute(
+        f"SELECT {_COLUMNS} FROM request_logs {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+        params + [limit + 1],
+    ).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]["timestamp"], rows[-1]["id"]) if has_more else None
+    return {"items": [_row_to_item(r) for r in rows], "next_cursor": next_cursor}
+
+
+def get_history_item(log_id: str) -> Optional[dict]:
+    row = _connection().execute(
+        f"SELECT {_COLUMNS} FROM request_logs WHERE id = ?", (log_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    item = _row_to_item(row)
+    item["image_filename"] = row["image_filename"]
+    return item
+
+
+def image_path(filename: str) -> Optional[str]:
+    """Absolute path of a stored image, or None if it is missing."""
+    if not filename or os.path.basename(filename) != filename:
+        return None
+    path = os.path.join(IMAGES_DIR, filename)
+    return path if os.path.isfile(path) else None
+
+
+def client_usage(day: Optional[str] = None, client: Optional[str] = None) -> list:
+    """Per-client usage counters for one day (YYYY-MM-DD, default today), busiest first."""
+    day = day or datetime.now().strftime("%Y-%m-%d")
+    params: list = [day]
+    where = "day = ?"
+    if client:
+        where += " AND client = ?"
+        params.append(client)
+    rows = _connection().execute(
+        f"SELECT day, client, request_type, requests, cost FROM client_usage WHERE {where} ORDER BY cost DESC",
+        params,
+    ).fetchall()
+    return [dict(row) for row in rows]
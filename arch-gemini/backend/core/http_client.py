@@ -1,20 +1,162 @@
+import asyncio
+from typing import Dict, Optional
+
 import httpx
 
+from core.config import settings
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class UpstreamPool:
+    """Pool settings for one upstream: base URL, limits, HTTP/2 and a warm-up path."""
+
+    def __init__(self, name: str, base_url: str, max_connections: int, max_keepalive: int, warmup_path: str):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.warmup_path = warmup_path
+        self.http2 = settings.HTTP2_ENABLED and _h2_available()
+        self.requests = 0
+        self.responses = 0
+        self.warmed = False
+        self.warmup_ms: Optional[float] = None
+
+
 class HTTPClientManager:
-    client: httpx.AsyncClient = None
+    """One `httpx.AsyncClient` per upstream, created and closed in the app lifespan.
+
+    Gemini responses are multi-MB and slow while DashScope calls are small, so
+    they get separate pools and one can't exhaust the other's connections.
+    HTTP/2 is used when `h2` is installed (HTTPS upstreams negotiate it via
+    ALPN and fall back to HTTP/1.1). `start()` opens connections ahead of the
+    first request so it doesn't pay DNS + TLS.
+    """
+
+    pools: Dict[str, UpstreamPool] = {}
+    clients: Dict[str, httpx.AsyncClient] = {}
+    _warmup_task: Optional[asyncio.Task] = None
 
     @classmethod
-    def get_client(cls) -> httpx.AsyncClient:
-        if cls.client is None:
-            # Initialize with reasonable limits
-            limits = httpx.Limits(max_keepalive_connections=20, max_connections=50)
-            cls.client = httpx.AsyncClient(limits=limits, timeout=60.0)
-        return cls.client
+    def _configure(cls):
+        if cls.pools:
+            return
+        cls.pools = {
+            "gemini": UpstreamPool(
+                "gemini", settings.GOOGLE_API_BASE_URL,
+                settings.GEMINI_MAX_CONNECTIONS, settings.GEMINI_MAX_KEEPALIVE, "/v1beta/models",
+            ),
+            "qwen": UpstreamPool(
+                "qwen", settings.QWEN_API_BASE_URL,
+                settings.QWEN_MAX_CONNECTIONS, settings.QWEN_MAX_KEEPALIVE, "/models",
+            ),
+        }
+
+    @classmethod
+    def _create(cls, name: str) -> httpx.AsyncClient:
+        pool = cls.pools[name]
+
+        async def on_request(request):
+            pool.requests += 1
+
+        async def on_response(response):
+            pool.responses += 1
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=pool.max_connections,
+                max_keepalive_connections=pool.max_keepalive,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(60.0, connect=settings.HTTP_CONNECT_TIMEOUT),
+            http2=pool.http2,
+            event_hooks={"request": [on_request], "response": [on_response]},
+        )
+
+    @classmethod
+    def get_client(cls, upstream: str = "gemini") -> httpx.AsyncClient:
+        """Client for `upstream` ("gemini" or "qwen"); created on first use outside the app."""
+        client = cls.clients.get(upstream)
+        if client is None:
+            cls._configure()
+            client = cls.clients[upstream] = cls._create(upstream)
+        return client
+
+    @classmethod
+    async def start(cls):
+        cls._configure()
+        for name in cls.pools:
+            cls.get_client(name)
+        if settings.HTTP_WARMUP_CONNECTIONS > 0:
+            # Don't hold up startup; the first requests will simply find warm connections
+            cls._warmup_task = asyncio.get_running_loop().create_task(cls.warmup())
+
+    @classmethod
+    async def warmup(cls):
+        async def open_one(name: str):
+            pool = cls.pools[name]
+            client = cls.get_client(name)
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            # One HTTP/2 connection multiplexes everything; HTTP/1.1 needs one per concurrent call
+            h2 = pool.http2 and pool.base_url.startswith("https")
+            count = 1 if h2 else settings.HTTP_WARMUP_CONNECTIONS
+            # Unauthenticated GETs answer 4xx immediately and cost no quota; the point is the handshake
+            results = await asyncio.gather(*[
+                client.get(pool.base_url + pool.warmup_path, timeout=settings.HTTP_CONNECT_TIMEOUT + 5)
+                for _ in range(count)
+            ], return_exceptions=True)
+            errors = [r for r in results if isinstance(r, Exception)]
+            pool.warmed = len(errors) < len(results)
+            pool.warmup_ms = round((loop.time() - start) * 1000, 1)
+            if errors:
+                print(f"HTTP warm-up for {name} ({pool.base_url}) failed: {errors[0]!r}")
+            else:
+                print(f"HTTP warm-up for {name}: {count} connection(s) in {pool.warmup_ms} ms")
+
+        await asyncio.gather(*[open_one(name) for name in cls.pools])
+
+    @classmethod
+    def stats(cls) -> Dict[str, dict]:
+        result = {}
+        for name, pool in cls.pools.items():
+            client = cls.clients.get(name)
+            connections = _pool_connections(client) if client is not None else []
+            result[name] = {
+                "base_url": pool.base_url,
+                "http2_enabled": pool.http2,
+                "max_connections": pool.max_connections,
+                "max_keepalive": pool.max_keepalive,
+                "connections": len(connections),
+                "idle": sum(1 for c in connections if c.is_idle()),
+                "http2_connections": sum(1 for c in connections if "HTTP/2" in c.info()),
+                "requests": pool.requests,
+                "responses": pool.responses,
+                "warmed": pool.warmed,
+                "warmup_ms": pool.warmup_ms,
+            }
+        return result
 
     @classmethod
     async def close(cls):
-        if cls.client:
-            await cls.client.aclose()
-            cls.client = None
+        if cls._warmup_task is not None:
+            cls._warmup_task.cancel()
+            cls._warmup_task = None
+        clients, cls.clients = cls.clients, {}
+        await asyncio.gather(*[client.aclose() for client in clients.values()], return_exceptions=True)
+
+
+def _pool_connections(client: httpx.AsyncClient) -> list:
+    # httpcore's connection pool is not public API; degrade to "unknown" (empty) if it changes
+    pool = getattr(client._transport, "_pool", None)
+    return list(getattr(pool, "connections", []) or [])
+
 
 http_client = HTTPClientManager
@@ -0,0 +1,209 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue cannot accept more work."""
+
+
+class Job:
+    def __init__(self, kind: str, handler: Callable[["Job"], Awaitable[Any]]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.handler = handler
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        # Full event history so late subscribers can replay progress
+        self.events: list = []
+        self._changed = asyncio.Event()
+
+    def publish(self, event: str, data: Optional[Dict[str, Any]] = None):
+        """Record a progress event and wake up any SSE subscribers."""
+        self.events.append({"event": event, "data": data or {}, "time": time.time()})
+        # Swap the event so waiters wake once and new waiters block again
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATES
+
+    async def stream_events(self, keepalive: float = 15.0):
+        """Yield events from the beginning until the job reaches a terminal state.
+
+        Yields None when no event arrived within `keepalive` seconds so the
+        caller can send a heartbeat through proxies.
+        """
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.done:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+    def to_dict(self) -> Dict[str, Any]:
+        info = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == SUCCEEDED:
+            info["result"] = self.result
+        elif self.status == FAILED:
+            info["error"] = self.error
+        return info
+
+
+class JobManager:
+    """In-process job scheduler with a bounded worker pool and TTL result retention.
+
+    With a `store` (a cross-process SharedState), every status change is also
+    saved as a snapshot, so a job can be polled through any worker process.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 100, result_ttl: float = 600.0, store=None):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.result_ttl = result_ttl
+        self.store = store
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+        self._pending_saves: set = set()
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._reaper()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, kind: str, handler: Callable[[Job], Awaitable[Any]]) -> Job:
+        """Queue a job and return immediately. `handler(job)` runs on a worker."""
+        if self._queue is None:
+            raise RuntimeError("JobManager is not started")
+        job = Job(kind, handler)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"Job queue is full ({self.queue_size} pending)")
+        self.jobs[job.id] = job
+        job.publish(QUEUED, {"position": self._queue.qsize()})
+        self._save_later(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    async def lookup(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Snapshot (`Job.to_dict()`) of a job owned by another worker process."""
+        if self.store is None:
+            return None
+        try:
+            return await self.store.get_json(f"job:{job_id}")
+        except Exception as e:
+            print(f"Job snapshot lookup failed: {e}")
+            return None
+
+    async def _save(self, job: Job):
+        if self.store is None:
+            return
+        try:
+            await self.store.set_json(f"job:{job.id}", job.to_dict(), self.result_ttl)
+        except Exception as e:
+            print(f"Failed to save job snapshot {job.id}: {e}")
+
+    def _save_later(self, job: Job):
+        if self.store is not None:
+            task = asyncio.get_running_loop().create_task(self._save(job))
+            self._pending_saves.add(task)
+            task.add_done_callback(self._pending_saves.discard)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        job.publish(RUNNING)
+        await self._save(job)
+        try:
+            job.result = await job.handler(job)
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            job.status = FAILED
+            job.error = "Job cancelled (server shutting down)"
+            raise
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            # Drop the handler closure so request payloads can be freed early
+            job.handler = None
+            if job.status == SUCCEEDED:
+                job.publish(SUCCEEDED)
+            else:
+                job.publish(FAILED, {"error": job.error})
+            await asyncio.shield(self._save(job))
+
+    async def _reaper(self):
+        interval = min(30.0, max(1.0, self.result_ttl / 2))
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+    def expire(self):
+        """Drop finished jobs whose results are older than the TTL."""
+        cutoff = time.time() - self.result_ttl
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.done and job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queue_size": self.queue_size,
+            "jobs": counts,
+        }
@@ -0,0 +1,240 @@
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+# Status codes that mean "this key can't serve right now, try another one"
+THROTTLE_STATUSES = {429}
+REJECTED_KEY_STATUSES = {401, 403}
+
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+
+class NoHealthyKeyError(Exception):
+    """Raised when every API key is cooling down."""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"All API keys are rate limited, retry after {retry_after:.0f}s")
+
+
+def key_suffix(key: Optional[str]) -> str:
+    return key[-4:] if key and len(key) > 4 else "unknown"
+
+
+def key_id(key: str) -> str:
+    """Stable, non-reversible id for a key, safe to store outside the process."""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Read Retry-After (seconds) from headers, or Google's RetryInfo.retryDelay from the body."""
+    header = response.headers.get("retry-after")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+    try:
+        match = _RETRY_DELAY_RE.search(response.text)
+    except Exception:
+        match = None
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class KeyState:
+    def __init__(self, key: str):
+        self.key = key
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.last_status: Optional[int] = None
+
+    def is_cooling(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def load_score(self) -> tuple:
+        # Fewest in-flight first, then the healthier key, then the faster one
+        return (self.in_flight, round(self.error_rate, 1), self.latency_ewma or 0.0)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "key_suffix": key_suffix(self.key),
+            "in_flight": self.in_flight,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "cooldown_remaining": round(max(0.0, self.cooldown_until - now), 1),
+            "successes": self.successes,
+            "failures": self.failures,
+            "last_status": self.last_status,
+        }
+
+
+class KeyPool:
+    """Health-aware API key selection.
+
+    Tracks in-flight requests, latency and error rate per key, puts keys into a
+    cooldown window on 429 (honouring Retry-After) or 401/403, and always hands
+    out the least-loaded key that is not cooling down. Selection and bookkeeping
+    happen under a lock, so it is safe from coroutines and executor threads alike.
+    """
+
+    def __init__(
+        self,
+        keys: List[str],
+        throttle_cooldown: float = 30.0,
+        rejected_cooldown: float = 300.0,
+        max_attempts: int = 3,
+        alpha: float = 0.3,
+    ):
+        self.states = [KeyState(k) for k in keys]
+        self.throttle_cooldown = throttle_cooldown
+        self.rejected_cooldown = rejected_cooldown
+        self.max_attempts = max(1, max_attempts)
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        # Cooldowns started here since the last drain_cooldowns(): {key: monotonic end}
+        self._new_cooldowns: Dict[str, float] = {}
+        self._ids = {key_id(s.key): s for s in self.states}
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def healthy_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for s in self.states if not s.is_cooling(now))
+
+    def acquire(self, exclude: Tuple[str, ...] = ()) -> Optional[KeyState]:
+        """Reserve the least-loaded healthy key. Returns None if there are no keys."""
+        with self._lock:
+            if not self.states:
+                return None
+            now = time.monotonic()
+            candidates = [s for s in self.states if s.key not in exclude and not s.is_cooling(now)]
+            if not candidates:
+                pending = [s for s in self.states if s.key not in exclude] or self.states
+                retry_after = min(s.cooldown_until for s in pending) - now
+                raise NoHealthyKeyError(max(retry_after, 0.0))
+            state = min(candidates, key=KeyState.load_score)
+            state.in_flight += 1
+            return state
+
+    def release(
+        self,
+        state: KeyState,
+        latency: Optional[float] = None,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ):
+        """Return a key and record the outcome. `status` is None for success."""
+        with self._lock:
+            state.in_flight = max(0, state.in_flight - 1)
+            state.last_status = status
+            failed = status is not None
+            state.error_rate += self.alpha * ((1.0 if failed else 0.0) - state.error_rate)
+            if failed:
+                state.failures += 1
+            else:
+                state.successes += 1
+                if latency is not None:
+                    if state.latency_ewma is None:
+                        state.latency_ewma = latency
+                    else:
+                        state.latency_ewma += self.alpha * (latency - state.latency_ewma)
+
+            cooldown = 0.0
+            if status in THROTTLE_STATUSES:
+                cooldown = retry_after if retry_after is not None else self.throttle_cooldown
+            elif status in REJECTED_KEY_STATUSES:
+                cooldown = self.rejected_cooldown
+            if cooldown:
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + cooldown)
+                self._new_cooldowns[state.key] = state.cooldown_until
+
+    def drain_cooldowns(self) -> List[Tuple[str, float]]:
+        """Cooldowns started since the last call, as (key_id, seconds), for other workers."""
+        with self._lock:
+            drained, self._new_cooldowns = self._new_cooldowns, {}
+        now = time.monotonic()
+        return [(key_id(key), until - now) for key, until in drained.items() if until > now]
+
+    def apply_cooldowns(self, remaining: Dict[str, float]):
+        """Cool down keys (by key_id) that other workers saw throttled or rejected."""
+        now = time.monotonic()
+        with self._lock:
+            for kid, seconds in remaining.items():
+                state = self._ids.get(kid)
+                if state is not None and seconds > 0:
+                    state.cooldown_until = max(state.cooldown_until, now + seconds)
+
+    def pick(self) -> Optional[str]:
+        """Pick a key without tracking the call (legacy `get_google_api_key` behaviour)."""
+        try:
+            state = self.acquire()
+        except NoHealthyKeyError:
+            return None
+        if state is None:
+            return None
+        self.abandon(state)
+        return state.key
+
+    def abandon(self, state: KeyState):
+        """Return a key without recording an outcome."""
+        with self._lock:
+            state.in_flight = max(0, state.in_flight - 1)
+
+    async def call(self, fn: Callable[[str], Awaitable[Any]]) -> Tuple[Any, str]:
+        """Run `fn(api_key)`, retrying on another key when one is throttled or rejected.
+
+        Returns `(result, api_key)`. Non-key errors (5xx, timeouts, bad payloads)
+        are recorded against the key and re-raised without retrying.
+        """
+        tried: Tuple[str, ...] = ()
+        last_error: Optional[Exception] = None
+        for _ in range(min(self.max_attempts, max(1, len(self.states)))):
+            try:
+                state = self.acquire(exclude=tried)
+            except NoHealthyKeyError:
+                if last_error is not None:
+                    raise last_error
+                raise
+            if state is None:
+                raise ValueError("GOOGLE_API_KEY is not set")
+
+            tried += (state.key,)
+            start = time.monotonic()
+            try:
+                result = await fn(state.key)
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                self.release(state, status=status, retry_after=parse_retry_after(e.response))
+                if status in THROTTLE_STATUSES or status in REJECTED_KEY_STATUSES:
+                    print(f"API key ...{key_suffix(state.key)} returned {status}, retrying on another key")
+                    last_error = e
+                    continue
+                raise
+            except Exception:
+                # Network errors and timeouts: count as a failure but keep the key usable
+                self.release(state, status=0)
+                raise
+            except BaseException:
+                # Cancelled (client gone, hedge lost): free the slot without judging the key
+                self.abandon(state)
+                raise
+            self.release(state, latency=time.monotonic() - start)
+            return result, state.key
+
+        raise last_error
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [s.to_dict(now) for s in self.states]
@@ -0,0 +1,313 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from core.config import settings
+from core.metrics import observe_queue_wait
+from core.routing import THROTTLED, classify_error_chain
+from core.shared_state import WORKER_ID, shared_state
+
+
+class Overloaded(Exception):
+    """Raised when a limiter's wait queue is full or the wait timed out (maps to 503)."""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"Server busy ({name}), retry after {retry_after:.0f}s")
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that adapts with AIMD.
+
+    - Each success adds 1/limit (so roughly +1 per full window of successes).
+    - A throttled outcome (429 / no healthy key, also when wrapped in another
+      error) multiplies the limit by `backoff_ratio`, at most once per
+      `decrease_interval`.
+    - With `latency_tolerance` set, a success slower than tolerance x the
+      latency baseline counts as congestion and shrinks the limit gently.
+
+    Callers beyond the limit wait in a bounded queue; when it is full, or the
+    wait exceeds `queue_timeout`, `Overloaded` is raised so the request can be
+    shed fast with 503 + Retry-After.
+
+    The queue is weighted-fair across clients: each waiter gets a virtual
+    finish tag of `max(now, client's last tag) + cost / weight` and the lowest
+    tag is admitted first, so one client queueing many 4K jobs only delays its
+    own later requests. Without a client every waiter shares "" (plain FIFO).
+
+    With `shared_limit` set and a cross-process state backend, `slot()` also
+    leases one of `shared_limit` global slots, so N workers together stay under
+    the same ceiling as one. The local limit still adapts per worker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: float,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        max_queue: int = 50,
+        queue_timeout: float = 30.0,
+        latency_tolerance: Optional[float] = None,
+        backoff_ratio: float = 0.7,
+        decrease_interval: float = 2.0,
+        shared_limit: Optional[int] = None,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.decrease_interval = decrease_interval
+        self.shared_limit = shared_limit if shared_state.distributed else None
+        self._holders = itertools.count()
+        self.shared_errors = 0
+        self.in_flight = 0
+        # Heap of [finish_tag, seq, future, client]
+        self._waiters: List[list] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._last_decrease = 0.0
+        self.latency_baseline: Optional[float] = None
+        self.admitted = 0
+        self.shed = 0
+        self.throttled = 0
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def retry_after(self) -> float:
+        """Rough time until a queued request would be admitted."""
+        per_slot = self.latency_baseline or 1.0
+        return max(1.0, per_slot * (len(self._waiters) + 1) / max(1, int(self.limit)))
+
+    def _enqueue(self, client: str, cost: float, weight: float) -> list:
+        start = max(self._virtual_time, self._last_finish.get(client, 0.0))
+        tag = start + cost / max(weight, 0.01)
+        self._last_finish[client] = tag
+        entry = [tag, next(self._seq), asyncio.get_running_loop().create_future(), client]
+        heapq.heappush(self._waiters, entry)
+        return entry
+
+    def _dequeue(self, entry: list):
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+        if not self._waiters:
+            # Everyone caught up: forget per-client tags so idle clients start fresh
+            self._last_finish.clear()
+
+    async def acquire(self, client: str = "", cost: float = 1.0, weight: float = 1.0):
+        if self._has_capacity() and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            observe_queue_wait(self.name, 0.0)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(self.name, self.retry_after())
+
+        queued_at = time.monotonic()
+        entry = self._enqueue(client, cost, weight)
+        waiter = entry[2]
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted just as we timed out: hand it back
+                self.in_flight -= 1
+                self._wake()
+            else:
+                waiter.cancel()
+            self.shed += 1
+            raise Overloaded(self.name, self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            self._dequeue(entry)
+            observe_queue_wait(self.name, time.monotonic() - queued_at)
+        self.admitted += 1
+
+    def _wake(self):
+        while self._waiters and self._has_capacity():
+            entry = heapq.heappop(self._waiters)
+            waiter = entry[2]
+            if waiter.done():
+                continue
+            self._virtual_time = max(self._virtual_time, entry[0])
+            self.in_flight += 1
+            waiter.set_result(None)
+        if not self._waiters:
+            self._last_finish.clear()
+
+    def release(self, latency: Optional[float] = None, throttled: bool = False):
+        self.in_flight = max(0, self.in_flight - 1)
+        now = time.monotonic()
+        if throttled:
+            self.throttled += 1
+            if now - self._last_decrease >= self.decrease_interval:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self._last_decrease = now
+        elif latency is not None:
+            congested = (
+                self.latency_tolerance is not None
+                and self.latency_baseline is not None
+                and latency > self.latency_baseline * self.latency_tolerance
+            )
+            if congested and now - self._last_decrease >= self.decrease_interval:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+                self._last_decrease = now
+            elif not congested:
+                self.limit = min(self.max_limit, self.limit + 1.0 / max(1.0, self.limit))
+            # Slow-moving baseline so one slow call doesn't redefine "normal"
+            if self.latency_baseline is None:
+                self.latency_baseline = latency
+            else:
+                self.latency_baseline += 0.05 * (latency - self.latency_baseline)
+        self._wake()
+
+    async def _acquire_shared(self) -> Optional[str]:
+        """Lease a global slot, polling with backoff. Returns the lease holder id.
+
+        If the state backend is unreachable the call goes ahead on the local
+        limit alone: a broken Redis shouldn't take generation down with it.
+        """
+        holder = f"{WORKER_ID}:{next(self._holders)}"
+        deadline = time.monotonic() + self.queue_timeout
+        queued_at = time.monotonic()
+        delay = 0.05
+        while True:
+            try:
+                if await shared_state.acquire_slot(self.name, holder, self.shared_limit, settings.SHARED_SLOT_TTL):
+                    if delay > 0.05:
+                        observe_queue_wait(self.name, time.monotonic() - queued_at)
+                    return holder
+            except Exception as e:
+                self.shared_errors += 1
+                print(f"Shared slot for {self.name} unavailable, using the local limit only: {e}")
+                return None
+            if time.monotonic() + delay > deadline:
+                self.shed += 1
+                raise Overloaded(self.name, self.retry_after())
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(1.0, delay * 2)
+
+    async def _release_shared(self, holder: Optional[str]):
+        if holder is None:
+            return
+        try:
+            await shared_state.release_slot(self.name, holder)
+        except Exception as e:
+            # The lease expires after SHARED_SLOT_TTL anyway
+            self.shared_errors += 1
+            print(f"Failed to release shared slot for {self.name}: {e}")
+
+    @asynccontextmanager
+    async def slot(self, client: str = "", cost: float = 1.0, weight: float = 1.0):
+        """Hold one slot for the block; outcome and latency feed the limit."""
+        await self.acquire(client, cost, weight)
+        holder = None
+        if self.shared_limit:
+            try:
+                holder = await self._acquire_shared()
+            except BaseException:
+                self.release()
+                raise
+        start = time.monotonic()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        except Exception as e:
+            self.release(throttled=classify_error_chain(e) == THROTTLED)
+            raise
+        else:
+            self.release(latency=time.monotonic() - start)
+        finally:
+            if holder is not None:
+                await asyncio.shield(self._release_shared(holder))
+
+    def queued_by_client(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for entry in self._waiters:
+            if not entry[2].done():
+                counts[entry[3]] = counts.get(entry[3], 0) + 1
+        return counts
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "max_queue": self.max_queue,
+            "queued_by_client": self.queued_by_client(),
+            "latency_baseline": round(self.latency_baseline, 3) if self.latency_baseline is not None else None,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "throttled": self.throttled,
+            "shared_limit": self.shared_limit,
+            "shared_errors": self.shared_errors,
+        }
+
+
+_key_count = max(1, len(settings.GOOGLE_API_KEYS))
+
+# Per-route admission pools (what a request waits on at the edge) and
+# per-upstream pools (what actually talks to Gemini / DashScope). Gemini limits
+# scale with the number of configured keys. Generation latency depends heavily
+# on resolution, so Gemini pools adapt on 429s only. Upstream pools also share
+# a global ceiling (their single-worker maximum) across worker processes.
+limiters: Dict[str, AdaptiveLimiter] = {
+    "route:optimize": AdaptiveLimiter(
+        "route:optimize", initial=16, max_limit=64,
+        max_queue=settings.LIMITER_MAX_QUEUE, queue_timeout=settings.LIMITER_QUEUE_TIMEOUT,
+        latency_tolerance=3.0,
+    ),
+    "route:analyze": AdaptiveLimiter(
+        "route:analyze", initial=2 * _key_count, max_limit=8 * _key_count,
+        max_queue=settings.LIMITER_MAX_QUEUE, queue_timeout=settings.LIMITER_QUEUE_TIMEOUT,
+        latency_tolerance=3.0,
+    ),
+    "route:generate": AdaptiveLimiter(
+        "route:generate", initial=2 * _key_count, max_limit=8 * _key_count,
+        max_queue=settings.LIMITER_MAX_QUEUE, queue_timeout=settings.LIMITER_QUEUE_TIMEOUT,
+    ),
+    "upstream:gemini": AdaptiveLimiter(
+        "upstream:gemini", initial=settings.GEMINI_CONCURRENCY_PER_KEY * _key_count,
+        max_limit=4 * settings.GEMINI_CONCURRENCY_PER_KEY * _key_count,
+        max_queue=4 * settings.LIMITER_MAX_QUEUE, queue_timeout=2 * settings.LIMITER_QUEUE_TIMEOUT,
+        shared_limit=4 * settings.GEMINI_CONCURRENCY_PER_KEY * _key_count,
+    ),
+    "upstream:qwen": AdaptiveLimiter(
+        "upstream:qwen", initial=16, max_limit=64,
+        max_queue=4 * settings.LIMITER_MAX_QUEUE, queue_timeout=settings.LIMITER_QUEUE_TIMEOUT,
+        latency_tolerance=3.0, shared_limit=64,
+    ),
+}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    return limiters[name]
+
+
+def limiter_stats() -> Dict[str, dict]:
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -1,23 +1,30 @@
 import sqlite3
 import os
 import base64
+import queue
+import threading
+import time
 import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
+from core.config import settings
+from core.metrics import span
 
 # Setup paths
-BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(BACKEND_DIR, "history.db")
-IMAGES_DIR = os.path.join(BACKEND_DIR, "history_images")
+DB_PATH = settings.HISTORY_DB
+IMAGES_DIR = settings.HISTORY_IMAGES_DIR
 
-# Ensure images directory exists
-os.makedirs(IMAGES_DIR, exist_ok=True)
+_db_ready = False
+_db_lock = threading.Lock()
 
 def init_db():
     """Initialize the SQLite database."""
-    conn = sqlite3.connect(DB_PATH)
+    # Several worker processes may run this at once; wait for each other's locks
+    conn = sqlite3.connect(DB_PATH, timeout=settings.SQLITE_BUSY_TIMEOUT)
+    # WAL is persistent, so readers in every process never block the writers
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
-    
+
     # Create table for request logs
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS request_logs (
@@ -31,63 +38,336 @@ def init_db():
         request_type TEXT
     )
     ''')
-    
+
+    # Indexes for the /api/history queries
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_logs_timestamp ON request_logs(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_logs_type_timestamp ON request_logs(request_type, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_logs_key_suffix ON request_logs(api_key_suffix)")
+
+    # Per-client daily usage, updated by the log writer alongside request_logs
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS client_usage (
+        day TEXT NOT NULL,
+        client TEXT NOT NULL,
+        request_type TEXT NOT NULL,
+        requests INTEGER NOT NULL DEFAULT 0,
+        cost REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, client, request_type)
+    )
+    ''')
+
     conn.commit()
     conn.close()
 
-# Initialize DB on module load
-init_db()
+def ensure_db():
+    """Create the images directory and tables once per process.
 
-def save_image_backup(image_base64: str) -> str:
-    """Save base64 image to local disk and return filename."""
-    try:
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        
+    Runs in the app lifespan (off the event loop) rather than at import; the
+    log writer and history reads also call it, so scripts that use this module
+    without the app still work. A flag check after the first call.
+    """
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_lock:
+        if not _db_ready:
+            os.makedirs(IMAGES_DIR, exist_ok=True)
+            init_db()
+            _db_ready = True
+
+def _new_image_filename() -> str:
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
+
+def _write_image(filename: str, image: Union[str, bytes]):
+    if isinstance(image, str):
         # Remove header if present
-        if "base64," in image_base64:
-            image_base64 = image_base64.split("base64,")[1]
-            
-        with open(filepath, "wb") as f:
-            f.write(base64.b64decode(image_base64))
-            
+        if "base64," in image:
+            image = image.split("base64,")[1]
+        image = base64.b64decode(image)
+
+    with open(os.path.join(IMAGES_DIR, filename), "wb") as f:
+        f.write(image)
+
+def save_image_backup(image: Union[str, bytes]) -> str:
+    """Save an image (base64 string or raw bytes) to local disk and return filename.
+
+    Blocking; request handlers should go through `log_request`, which writes off-loop.
+    """
+    try:
+        filename = _new_image_filename()
+        _write_image(filename, image)
         return filename
     except Exception as e:
         print(f"Failed to save image backup: {e}")
         return ""
 
+class RequestLogWriter:
+    """Background writer for request logs.
+
+    Entries go into a bounded queue and are drained by a single thread that owns
+    one long-lived WAL-mode connection, writes image backups and inserts rows in
+    batches with `executemany`. When the queue is full new entries are dropped
+    (and counted) rather than blocking the request. Queued image backups are
+    also bounded by total size (`max_bytes`): past it, an entry is still
+    logged but its image is not kept.
+
+    Each worker process runs its own writer against the same file. SQLite
+    allows one writer at a time, so connections wait `SQLITE_BUSY_TIMEOUT` for
+    the lock and a batch that still hits "database is locked" is retried.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self, db_path: str, max_queue: int = 1000, batch_size: int = 50, max_retries: int = 3,
+        max_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.max_bytes = max_bytes
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        # Size of the images waiting in the queue; a 4K backup is several MB
+        self._queued_bytes = 0
+        self._bytes_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._image_listeners: list = []
+        self.written = 0
+        self.dropped = 0
+        self.images_dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.retries = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="request-log-writer", daemon=True)
+                self._thread.start()
+
+    def add_image_listener(self, callback):
+        """Call `callback(filename)` on the writer thread after each image backup is saved."""
+        self._image_listeners.append(callback)
+
+    def submit(self, entry: dict) -> bool:
+        self.start()
+        size = len(entry.get("image") or b"")
+        if size:
+            with self._bytes_lock:
+                if self._queued_bytes + size > self.max_bytes:
+                    size = 0
+                else:
+                    self._queued_bytes += size
+            if not size:
+                # The writer is behind; keep the row, skip the backup
+                self.images_dropped += 1
+                print(f"Request log queue over {self.max_bytes} bytes, not backing up image of {entry['id']}")
+                entry["image"] = None
+                entry["image_filename"] = ""
+        entry["image_size"] = size
+        try:
+            self._queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self._release_bytes(size)
+            self.dropped += 1
+            print(f"Request log queue full, dropped entry {entry['id']}")
+            return False
+
+    def _release_bytes(self, size: int):
+        if size:
+            with self._bytes_lock:
+                self._queued_bytes -= size
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Block until everything queued so far is on disk (or the timeout expires)."""
+        if self._thread is None:
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def close(self, timeout: float = 10.0):
+        """Flush pending entries and stop the writer thread. Call on shutdown."""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=settings.SQLITE_BUSY_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _run(self):
+        ensure_db()
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                # Drain whatever else is already waiting, up to one batch
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = any(entry is self._STOP for entry in batch)
+                entries = [entry for entry in batch if entry is not self._STOP]
+                try:
+                    if entries:
+                        with span("log_write"):
+                            self._write_batch(conn, entries)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+                if stop:
+                    # Flush whatever arrived after the stop marker, then exit
+                    remaining = []
+                    while True:
+                        try:
+                            entry = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        self._queue.task_done()
+                        if entry is not self._STOP:
+                            remaining.append(entry)
+                    if remaining:
+                        self._write_batch(conn, remaining)
+                    return
+        finally:
+            conn.close()
+
+    def _write_backup(self, entry: dict, image: Union[str, bytes, None]):
+        if not image:
+            return
+        try:
+            _write_image(entry["image_filename"], image)
+        except Exception as e:
+            self.errors += 1
+            print(f"Failed to save image backup: {e}")
+            entry["image_filename"] = ""
+        else:
+            for callback in self._image_listeners:
+                try:
+                    callback(entry["image_filename"])
+                except Exception as e:
+                    print(f"Image listener failed: {e}")
+
+    def _write_batch(self, conn: sqlite3.Connection, entries: list):
+        rows = []
+        usage: dict = {}
+        for entry in entries:
+            self._write_backup(entry, entry.pop("image", None))
+            self._release_bytes(entry.pop("image_size", 0))
+            rows.append((
+                entry["id"], entry["timestamp"], entry["client_ip"], entry["prompt"],
+                entry["model"], entry["api_key_suffix"], entry["image_filename"], entry["request_type"],
+            ))
+            client = entry.get("client_id") or entry["client_ip"] or "unknown"
+            usage_key = (entry["timestamp"][:10], client, entry["request_type"] or "")
+            requests, cost = usage.get(usage_key, (0, 0.0))
+            usage[usage_key] = (requests + 1, cost + entry.get("cost", 1.0))
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._insert(conn, rows, usage)
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                if attempt < self.max_retries and ("locked" in str(e) or "busy" in str(e)):
+                    self.retries += 1
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                self.errors += 1
+                print(f"Failed to log request batch: {e}")
+                return
+            except Exception as e:
+                conn.rollback()
+                self.errors += 1
+                print(f"Failed to log request batch: {e}")
+                return
+            self.written += len(rows)
+            self.batches += 1
+            print(f"Request log batch written: {len(rows)} entries")
+            return
+
+    def _insert(self, conn: sqlite3.Connection, rows: list, usage: dict):
+        conn.executemany('''
+        INSERT INTO request_logs (id, timestamp, client_ip, prompt, model, api_key_suffix, image_filename, request_type)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.executemany('''
+        INSERT INTO client_usage (day, client, request_type, requests, cost)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day, client, request_type) DO UPDATE SET
+            requests = requests + excluded.requests,
+            cost = cost + excluded.cost
+        ''', [key + value for key, value in usage.items()])
+        conn.commit()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "queued_bytes": self._queued_bytes,
+            "max_bytes": self.max_bytes,
+            "written": self.written,
+            "dropped": self.dropped,
+            "images_dropped": self.images_dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+            "retries": self.retries,
+        }
+
+request_log_writer = RequestLogWriter(
+    DB_PATH,
+    max_queue=settings.LOG_QUEUE_SIZE,
+    batch_size=settings.LOG_BATCH_SIZE,
+    max_bytes=settings.LOG_QUEUE_MAX_BYTES,
+)
+
 def log_request(
-    client_ip: str, 
-    prompt: str, 
-    model: str, 
-    api_key: str, 
+    client_ip: str,
+    prompt: str,
+    model: str,
+    api_key: str,
     image_base64: Optional[str] = None,
-    request_type: str = "generation"
-):
-    """Log the request details and save image backup."""
+    request_type: str = "generation",
+    image_bytes: Optional[bytes] = None,
+    client_id: Optional[str] = None,
+    cost: float = 1.0
+) -> Optional[str]:
+    """Queue the request details and image backup for the background writer.
+
+    Pass `image_bytes` instead of `image_base64` when the image is already decoded.
+    `client_id` / `cost` feed the daily `client_usage` counters (defaults: the IP, 1 unit).
+    Returns the log id, or None if the entry was dropped.
+    """
     try:
-        timestamp = datetime.now().isoformat()
-        log_id = str(uuid.uuid4())
-        
         # Extract key suffix for identification
         key_suffix = api_key[-4:] if api_key and len(api_key) > 4 else "unknown"
-        
-        image_filename = ""
-        if image_base64:
-            image_filename = save_image_backup(image_base64)
-            
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO request_logs (id, timestamp, client_ip, prompt, model, api_key_suffix, image_filename, request_type)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (log_id, timestamp, client_ip, prompt, model, key_suffix, image_filename, request_type))
-        
-        conn.commit()
-        conn.close()
-        
-        print(f"Request logged: {log_id} | IP: {client_ip} | Model: {model}")
-        
+        image = image_bytes or image_base64
+
+        entry = {
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.now().isoformat(),
+            "client_ip": client_ip,
+            "prompt": prompt,
+            "model": model,
+            "api_key_suffix": key_suffix,
+            "image_filename": _new_image_filename() if image else "",
+            "request_type": request_type,
+            "image": image,
+            "client_id": client_id,
+            "cost": cost,
+        }
+        if not request_log_writer.submit(entry):
+            return None
+        return entry["id"]
+
     except Exception as e:
         print(f"Failed to log request: {e}")
+        return None
@@ -0,0 +1,359 @@
+import asyncio
+import bisect
+import contextvars
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from core.config import settings
+
+# Upper bounds (seconds) for phase / request histograms: sub-ms JSON work up to 4K renders
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 20, 30, 60, 120,
+)
+
+# Event-loop lag: anything above a few ms means something is blocking the loop
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# The ASGI scope of the request being handled, so spans can label themselves by route
+_current_scope: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("metrics_scope", default=None)
+
+
+_INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self.series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(s[0]), s[1], s[2]) for key, s in self.series.items()]
+        lines = self.header()
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _INF_LABEL)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text format.
+
+    Recording is a dict lookup, a bisect and a short lock; with `enabled` off
+    every span and observation returns immediately.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Call `collector()` before each scrape, e.g. to copy pool stats into gauges."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=settings.METRICS_ENABLED)
+
+REQUEST_SECONDS = metrics.histogram(
+    "archgemini_request_seconds", "HTTP request duration (full body for streams)", ("route", "method", "status"),
+)
+PHASE_SECONDS = metrics.histogram(
+    "archgemini_phase_seconds", "Time spent per request phase",
+    ("phase", "route", "model", "resolution", "key"),
+)
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "archgemini_queue_wait_seconds", "Time spent waiting for a limiter slot", ("limiter", "route"),
+)
+UPSTREAM_RESPONSES = metrics.counter(
+    "archgemini_upstream_responses_total", "Upstream responses by status (or timeout/network/error)",
+    ("upstream", "model", "status"),
+)
+LOOP_LAG_SECONDS = metrics.histogram(
+    "archgemini_event_loop_lag_seconds", "How late the event loop woke a periodic timer", (), LAG_BUCKETS,
+)
+LOOP_LAG_MAX = metrics.gauge(
+    "archgemini_event_loop_lag_max_seconds", "Largest event-loop lag since the previous scrape",
+)
+
+PROCESS_RSS = metrics.gauge("archgemini_process_rss_bytes", "Resident memory of this worker")
+PROCESS_PEAK_RSS = metrics.gauge("archgemini_process_peak_rss_bytes", "Peak resident memory of this worker")
+
+
+def _collect_process_memory():
+    try:
+        import resource
+    except ImportError:
+        # Windows: no getrusage; memory gauges are simply absent
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, KiB on Linux
+    PROCESS_PEAK_RSS.set(peak if sys.platform == "darwin" else peak * 1024)
+    try:
+        with open("/proc/self/statm") as f:
+            PROCESS_RSS.set(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, IndexError):
+        pass
+
+
+metrics.add_collector(_collect_process_memory)
+
+
+def current_route() -> str:
+    scope = _current_scope.get()
+    if scope is None:
+        return ""
+    route = scope.get("route")
+    return getattr(route, "path", "") or "unmatched"
+
+
+class span:
+    """Time a block into `archgemini_phase_seconds`.
+
+        with span("decode", model=model, resolution="4K"):
+            ...
+
+    Usable around `await`. The route label comes from the request being handled.
+    Labels can be filled in late via `set(key=...)` (e.g. once the key is known).
+    """
+
+    __slots__ = ("phase", "labels", "start")
+
+    def __init__(self, phase: str, **labels):
+        self.phase = phase
+        self.labels = labels
+        self.start = 0.0
+
+    def set(self, **labels):
+        self.labels.update(labels)
+
+    def __enter__(self):
+        if metrics.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if metrics.enabled and self.start:
+            PHASE_SECONDS.observe(
+                time.perf_counter() - self.start, phase=self.phase, route=current_route(), **self.labels
+            )
+        return False
+
+
+def upstream_status(error: Optional[BaseException]) -> str:
+    if error is None:
+        return "200"
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "network"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    return "error"
+
+
+class upstream_span(span):
+    """`span("upstream", ...)` that also counts the response status per upstream/model."""
+
+    __slots__ = ("upstream",)
+
+    def __init__(self, upstream: str, **labels):
+        super().__init__("upstream", **labels)
+        self.upstream = upstream
+
+    def __exit__(self, exc_type, exc, tb):
+        if metrics.enabled:
+            UPSTREAM_RESPONSES.inc(upstream=self.upstream, model=self.labels.get("model", ""), status=upstream_status(exc))
+        return super().__exit__(exc_type, exc, tb)
+
+
+def observe_queue_wait(limiter: str, seconds: float):
+    if metrics.enabled:
+        QUEUE_WAIT_SECONDS.observe(seconds, limiter=limiter, route=current_route())
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: request duration per route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        token = _current_scope.set(scope)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                route=current_route(), method=scope.get("method", ""), status=str(status[0]),
+            )
+            _current_scope.reset(token)
+
+
+class LoopLagMonitor:
+    """Sleeps for `interval` in a loop and records how late each wake-up was."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._max = 0.0
+
+    def start(self):
+        if metrics.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            metrics.add_collector(self._collect)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            self._max = max(self._max, lag)
+
+    def _collect(self):
+        LOOP_LAG_MAX.set(self._max)
+        self._max = 0.0
+
+
+loop_lag_monitor = LoopLagMonitor(interval=settings.METRICS_LOOP_LAG_INTERVAL)
@@ -0,0 +1,269 @@
+import asyncio
+import bisect
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from core.key_pool import NoHealthyKeyError, parse_retry_after
+
+# Error classes used to pick a retry policy
+THROTTLED = "throttled"
+SERVER = "server"
+TIMEOUT = "timeout"
+NETWORK = "network"
+NOT_FOUND = "not_found"
+CLIENT = "client"
+OTHER = "other"
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120]
+
+
+def classify_error(error: BaseException) -> str:
+    if isinstance(error, NoHealthyKeyError):
+        return THROTTLED
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status == 429:
+            return THROTTLED
+        if status == 404:
+            return NOT_FOUND
+        if status >= 500:
+            return SERVER
+        return CLIENT
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, httpx.TransportError):
+        return NETWORK
+    return OTHER
+
+
+def classify_error_chain(error: BaseException) -> str:
+    """`classify_error` of the first wrapped error that has a class.
+
+    Service errors and the HTTPException raised at the edge wrap the upstream
+    error (`raise ... from e`, or implicitly while handling it), so a 429
+    behind a 500 response still counts as THROTTLED.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        kind = classify_error(error)
+        if kind != OTHER:
+            return kind
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return OTHER
+
+
+def parse_retry_policy(spec: str) -> Dict[str, int]:
+    """Parse "throttled:2,server:2,timeout:1" into retries per error class."""
+    policy = {}
+    for item in (spec or "").split(","):
+        if ":" not in item:
+            continue
+        name, count = item.split(":", 1)
+        try:
+            policy[name.strip()] = max(0, int(count))
+        except ValueError:
+            continue
+    return policy
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with approximate quantiles."""
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1] * 2
+                # Linear interpolation inside the bucket
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class ModelRouter:
+    """Primary/fallback model routing with per-class retries and optional hedging.
+
+    - 404 switches straight to the fallback model.
+    - Throttled / 5xx / timeout / network errors are retried with exponential
+      backoff (honouring Retry-After) up to the policy limit, then the fallback
+      model gets one try.
+    - With hedging on, an attempt that is still pending at the model's p95
+      latency is raced against a second attempt (another key on the same model,
+      or the fallback model); the loser is cancelled. Hedges are capped at
+      `hedge_max_ratio` of requests so quota use stays close to 1x.
+    """
+
+    def __init__(
+        self,
+        primary: str,
+        fallback: Optional[str] = None,
+        retry_policy: Optional[Dict[str, int]] = None,
+        backoff_base: float = 1.0,
+        backoff_max: float = 20.0,
+        hedge_enabled: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        hedge_max_ratio: float = 0.1,
+        hedge_to_fallback: bool = False,
+    ):
+        self.primary = primary
+        self.fallback = fallback if fallback and fallback != primary else None
+        self.retry_policy = retry_policy or {}
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_max_ratio = hedge_max_ratio
+        self.hedge_to_fallback = hedge_to_fallback
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.requests = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _histogram(self, key: str) -> LatencyHistogram:
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        return histogram
+
+    def hedge_deadline(self, latency_key: str) -> Optional[float]:
+        histogram = self.histograms.get(latency_key)
+        if histogram is None or histogram.count < self.hedge_min_samples:
+            return None
+        return histogram.quantile(self.hedge_quantile)
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        retry_after = None
+        if isinstance(error, NoHealthyKeyError):
+            retry_after = error.retry_after
+        elif isinstance(error, httpx.HTTPStatusError):
+            retry_after = parse_retry_after(error.response)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = delay * (0.5 + random.random() / 2)  # jitter
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    async def _timed(self, model: str, latency_suffix: str, fn: Callable[[str], Awaitable[Any]]) -> Any:
+        start = time.monotonic()
+        result = await fn(model)
+        self._histogram(f"{model}:{latency_suffix}").record(time.monotonic() - start)
+        return result
+
+    async def _attempt(self, model: str, latency_suffix: str, fn, hedge: bool) -> Tuple[Any, str]:
+        """One routed attempt, possibly hedged. Returns (result, model that answered)."""
+        primary_task = asyncio.ensure_future(self._timed(model, latency_suffix, fn))
+        deadline = self.hedge_deadline(f"{model}:{latency_suffix}") if hedge else None
+        budget_ok = self.hedges < self.hedge_max_ratio * max(1, self.requests)
+        if deadline is None or not budget_ok:
+            return await primary_task, model
+
+        done, _ = await asyncio.wait({primary_task}, timeout=deadline)
+        if done:
+            return primary_task.result(), model
+
+        hedge_model = self.fallback if self.hedge_to_fallback and self.fallback else model
+        self.hedges += 1
+        print(f"Hedging {model} after {deadline:.1f}s with {hedge_model}")
+        hedge_task = asyncio.ensure_future(self._timed(hedge_model, latency_suffix, fn))
+        owners = {primary_task: model, hedge_task: hedge_model}
+        pending = {primary_task, hedge_task}
+        last_error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        return task.result(), owners[task]
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def run(
+        self,
+        fn: Callable[[str], Awaitable[Any]],
+        latency_key: str = "",
+        hedge: bool = True,
+    ) -> Tuple[Any, str]:
+        """Call `fn(model)` under the routing policy. Returns (result, model used)."""
+        self.requests += 1
+        hedge = hedge and self.hedge_enabled
+        model = self.primary
+        attempts: Dict[str, int] = {}
+        while True:
+            try:
+                return await self._attempt(model, latency_key, fn, hedge)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_class = classify_error(e)
+                if error_class == NOT_FOUND and model != self.fallback and self.fallback:
+                    self.fallbacks += 1
+                    model = self.fallback
+                    continue
+
+                used = attempts.get(error_class, 0)
+                if used < self.retry_policy.get(error_class, 0):
+                    attempts[error_class] = used + 1
+                    self.retries += 1
+                    delay = self._backoff(used, e)
+                    print(f"{model} failed ({error_class}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if error_class in (THROTTLED, SERVER, TIMEOUT, NETWORK) and self.fallback and model != self.fallback:
+                    self.fallbacks += 1
+                    print(f"{model} exhausted retries ({error_class}), trying fallback {self.fallback}")
+                    model = self.fallback
+                    attempts = {}
+                    continue
+                raise
+
+    def stats(self) -> dict:
+        return {
+            "primary": self.primary,
+            "fallback": self.fallback,
+            "requests": self.requests,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_enabled": self.hedge_enabled,
+            "latency": {key: h.to_dict() for key, h in self.histograms.items()},
+        }
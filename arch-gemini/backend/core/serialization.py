@@ -0,0 +1,140 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # optional speedup, install with `backend[fast]`
+    orjson = None
+
+# Payloads above this size are encoded/decoded on a worker thread
+OFFLOAD_THRESHOLD = 256 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="json")
+
+# Markers that introduce inline image data in Gemini responses
+_INLINE_MARKERS = (b'"inlineData"', b'"inline_data"')
+_DATA_KEY = b'"data"'
+_PLACEHOLDER = "__inline_data_%d__"
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+async def adumps(obj: Any, size_hint: int = 0) -> bytes:
+    """Encode to JSON bytes, off the event loop when `size_hint` is large."""
+    if size_hint < OFFLOAD_THRESHOLD:
+        return dumps(obj)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, dumps, obj)
+
+
+async def aloads(data: Union[bytes, str]) -> Any:
+    """Decode JSON, off the event loop when the payload is large."""
+    if len(data) < OFFLOAD_THRESHOLD:
+        return loads(data)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, loads, data)
+
+
+def _find_inline_data_spans(raw: bytes) -> List[Tuple[int, int]]:
+    """Locate the (start, end) byte offsets of every inlineData.data string value."""
+    spans = []
+    pos = 0
+    while True:
+        hits = [i for i in (raw.find(m, pos) for m in _INLINE_MARKERS) if i != -1]
+        if not hits:
+            return spans
+        marker = min(hits)
+        key = raw.find(_DATA_KEY, marker)
+        if key == -1:
+            return spans
+        # Skip whitespace and the colon to reach the opening quote
+        i = key + len(_DATA_KEY)
+        while i < len(raw) and raw[i] in b" \t\r\n:":
+            i += 1
+        if i >= len(raw) or raw[i] != ord('"'):
+            pos = key + len(_DATA_KEY)
+            continue
+        start = i + 1
+        end = raw.find(b'"', start)
+        if end == -1:
+            return spans
+        spans.append((start, end))
+        pos = end + 1
+
+
+def split_inline_data(raw: bytes) -> Dict[str, Any]:
+    """Parse a Gemini response without building Python objects for the image payload.
+
+    The base64 `inlineData.data` strings are cut out of the raw body by offset
+    (base64 never contains quotes or escapes), the remaining small JSON envelope
+    is parsed, and each string is decoded once straight from the buffer and put
+    back in place. Falls back to a plain parse if the body looks unusual.
+    """
+    spans = _find_inline_data_spans(raw)
+    if not spans:
+        return loads(raw)
+
+    view = memoryview(raw)
+    pieces = []
+    values = []
+    cursor = 0
+    for index, (start, end) in enumerate(spans):
+        if raw.find(b"\\", start, end) != -1:
+            # Escaped content: not plain base64, let the real parser handle it
+            return loads(raw)
+        pieces.append(view[cursor:start])
+        pieces.append((_PLACEHOLDER % index).encode("ascii"))
+        values.append(str(view[start:end], "ascii"))
+        cursor = end
+    pieces.append(view[cursor:])
+
+    envelope = loads(b"".join(pieces))
+    _restore_inline_data(envelope, values)
+    return envelope
+
+
+def _restore_inline_data(result: Dict[str, Any], values: List[str]):
+    for candidate in result.get("candidates") or []:
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            inline = part.get("inlineData") or part.get("inline_data")
+            if not inline:
+                continue
+            data = inline.get("data")
+            if isinstance(data, str) and data.startswith("__inline_data_"):
+                inline["data"] = values[int(data[len("__inline_data_"):-2])]
+
+
+async def aload_gemini_response(raw: bytes) -> Dict[str, Any]:
+    """Async wrapper for `split_inline_data` that offloads large bodies."""
+    if len(raw) < OFFLOAD_THRESHOLD:
+        return split_inline_data(raw)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, split_inline_data, raw)
+
+
+def payload_size_hint(parts: Optional[List[Dict[str, Any]]]) -> int:
+    """Rough encoded size of a Gemini `parts` list, dominated by inline image data."""
+    size = 0
+    for part in parts or []:
+        inline = part.get("inlineData")
+        if inline:
+            size += len(inline.get("data") or "")
+        else:
+            size += len(part.get("text") or "")
+    return size
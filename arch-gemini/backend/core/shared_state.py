@@ -0,0 +1,617 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from core.config import settings
+
+# Buckets nobody touched for this long are dropped by the backends
+BUCKET_TTL = 3600.0
+
+# Identifies this process in slot leases and /api/admin/state
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def bucket_update(
+    tokens: Optional[float], updated: float, now: float, rate: float, burst: float, cost: float
+) -> Tuple[float, float]:
+    """Refill a token bucket to `now` and take `cost` (negative = refund).
+
+    `tokens` None means a new, full bucket. Returns `(tokens left, wait)`:
+    wait is 0 when the units were taken, else seconds until they'd be available.
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if cost <= 0:
+        return min(burst, tokens - cost), 0.0
+    # A single request costing more than the burst is allowed once the bucket is full
+    cost = min(cost, burst)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    if rate <= 0:
+        return tokens, float("inf")
+    return tokens, (cost - tokens) / rate
+
+
+class SharedState(ABC):
+    """State that has to be shared by every worker process.
+
+    - Slots: leased global concurrency ("at most N upstream calls across all
+      workers"). Leases expire after `ttl` so a crashed worker can't leak them.
+    - Token buckets for per-client rate limits.
+    - Cooldowns: `member -> until` (wall-clock) maps, used for API keys.
+    - Small JSON documents with a TTL (job snapshots).
+
+    Times are `time.time()` so they mean the same thing in every process.
+    """
+
+    backend = "base"
+    # False when only this process can see the state (no point in global slots)
+    distributed = True
+
+    @abstractmethod
+    async def acquire_slot(self, name: str, holder: str, limit: int, ttl: float) -> bool:
+        """Lease one of `limit` slots of `name` for `ttl` seconds; False if all are taken."""
+
+    @abstractmethod
+    async def release_slot(self, name: str, holder: str):
+        """Give back `holder`'s lease (a no-op if it already expired)."""
+
+    @abstractmethod
+    async def slot_count(self, name: str) -> int:
+        """Unexpired leases on `name`."""
+
+    @abstractmethod
+    async def take_tokens(self, key: str, rate: float, burst: float, cost: float) -> Tuple[float, float]:
+        """Take `cost` units from bucket `key`; see `bucket_update` for the result."""
+
+    async def refund_tokens(self, key: str, rate: float, burst: float, cost: float):
+        await self.take_tokens(key, rate, burst, -cost)
+
+    @abstractmethod
+    async def set_cooldown(self, name: str, member: str, until: float):
+        """Mark `member` of `name` as cooling down until `until` (wall-clock)."""
+
+    @abstractmethod
+    async def cooldowns(self, name: str) -> Dict[str, float]:
+        """Members of `name` still cooling down, with their wall-clock end time."""
+
+    @abstractmethod
+    async def set_json(self, key: str, value: Any, ttl: float):
+        """Store `value` under `key` for `ttl` seconds."""
+
+    @abstractmethod
+    async def get_json(self, key: str) -> Any:
+        """The value stored under `key`, or None if missing or expired."""
+
+    async def close(self):
+        pass
+
+    def describe(self) -> str:
+        return self.backend
+
+
+class MemoryState(SharedState):
+    """Plain dicts; correct for a single worker process only."""
+
+    backend = "memory"
+    distributed = False
+
+    def __init__(self):
+        self._slots: Dict[str, Dict[str, float]] = {}
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._cooldowns: Dict[str, Dict[str, float]] = {}
+        self._docs: Dict[str, Tuple[str, float]] = {}
+        self._last_sweep = time.time()
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < BUCKET_TTL}
+        self._docs = {k: v for k, v in self._docs.items() if v[1] > now}
+
+    async def acquire_slot(self, name: str, holder: str, limit: int, ttl: float) -> bool:
+        now = time.time()
+        leases = self._slots.setdefault(name, {})
+        for expired in [h for h, until in leases.items() if until <= now]:
+            del leases[expired]
+        if len(leases) >= limit:
+            return False
+        leases[holder] = now + ttl
+        return True
+
+    async def release_slot(self, name: str, holder: str):
+        self._slots.get(name, {}).pop(holder, None)
+
+    async def slot_count(self, name: str) -> int:
+        now = time.time()
+        return sum(1 for until in self._slots.get(name, {}).values() if until > now)
+
+    async def take_tokens(self, key: str, rate: float, burst: float, cost: float) -> Tuple[float, float]:
+        now = time.time()
+        self._sweep(now)
+        tokens, updated = self._buckets.get(key, (None, now))
+        tokens, wait = bucket_update(tokens, updated, now, rate, burst, cost)
+        self._buckets[key] = (tokens, now)
+        return tokens, wait
+
+    async def set_cooldown(self, name: str, member: str, until: float):
+        members = self._cooldowns.setdefault(name, {})
+        members[member] = max(until, members.get(member, 0.0))
+
+    async def cooldowns(self, name: str) -> Dict[str, float]:
+        now = time.time()
+        return {m: until for m, until in self._cooldowns.get(name, {}).items() if until > now}
+
+    async def set_json(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        self._sweep(now)
+        self._docs[key] = (json.dumps(value), now + ttl)
+
+    async def get_json(self, key: str) -> Any:
+        doc = self._docs.get(key)
+        if doc is None or doc[1] <= time.time():
+            return None
+        return json.loads(doc[0])
+
+
+class SQLiteState(SharedState):
+    """A WAL-mode SQLite file shared by the workers on one host.
+
+    Every operation is one short `BEGIN IMMEDIATE` transaction run on a
+    single helper thread per process, so operations from one worker are
+    serialised and other workers wait on SQLite's lock (`busy_timeout`).
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, busy_timeout: float = 30.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._last_sweep = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Autocommit mode; transactions are opened explicitly in _transaction
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS slots (
+                name TEXT NOT NULL, holder TEXT NOT NULL, expires REAL NOT NULL,
+                PRIMARY KEY (name, holder)
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cooldowns (
+                name TEXT NOT NULL, member TEXT NOT NULL, until REAL NOT NULL,
+                PRIMARY KEY (name, member)
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL
+            );
+            ''')
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, fn, args, write: bool):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            result = fn(conn, time.time(), *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def _run(self, fn, *args, write: bool = True):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, fn, args, write)
+
+    def _sweep(self, conn: sqlite3.Connection, now: float):
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        conn.execute("DELETE FROM slots WHERE expires <= ?", (now,))
+        conn.execute("DELETE FROM buckets WHERE updated < ?", (now - BUCKET_TTL,))
+        conn.execute("DELETE FROM cooldowns WHERE until <= ?", (now,))
+        conn.execute("DELETE FROM documents WHERE expires <= ?", (now,))
+
+    @staticmethod
+    def _acquire_slot(conn, now, name, holder, limit, ttl):
+        conn.execute("DELETE FROM slots WHERE name = ? AND expires <= ?", (name, now))
+        (count,) = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (name,)).fetchone()
+        if count >= limit:
+            return False
+        conn.execute("INSERT OR REPLACE INTO slots (name, holder, expires) VALUES (?, ?, ?)", (name, holder, now + ttl))
+        return True
+
+    async def acquire_slot(self, name: str, holder: str, limit: int, ttl: float) -> bool:
+        return await self._run(self._acquire_slot, name, holder, limit, ttl)
+
+    async def release_slot(self, name: str, holder: str):
+        await self._run(lambda conn, now: conn.execute(
+            "DELETE FROM slots WHERE name = ? AND holder = ?", (name, holder)
+        ))
+
+    async def slot_count(self, name: str) -> int:
+        return await self._run(lambda conn, now: conn.execute(
+            "SELECT COUNT(*) FROM slots WHERE name = ? AND expires > ?", (name, now)
+        ).fetchone()[0], write=False)
+
+    def _take_tokens(self, conn, now, key, rate, burst, cost):
+        self._sweep(conn, now)
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens, wait = bucket_update(row[0] if row else None, row[1] if row else now, now, rate, burst, cost)
+        conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+        return tokens, wait
+
+    async def take_tokens(self, key: str, rate: float, burst: float, cost: float) -> Tuple[float, float]:
+        return await self._run(self._take_tokens, key, rate, burst, cost)
+
+    async def set_cooldown(self, name: str, member: str, until: float):
+        await self._run(lambda conn, now: conn.execute('''
+            INSERT INTO cooldowns (name, member, until) VALUES (?, ?, ?)
+            ON CONFLICT(name, member) DO UPDATE SET until = MAX(until, excluded.until)
+        ''', (name, member, until)))
+
+    async def cooldowns(self, name: str) -> Dict[str, float]:
+        rows = await self._run(lambda conn, now: conn.execute(
+            "SELECT member, until FROM cooldowns WHERE name = ? AND until > ?", (name, now)
+        ).fetchall(), write=False)
+        return dict(rows)
+
+    def _set_json(self, conn, now, key, value, ttl):
+        self._sweep(conn, now)
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, now + ttl),
+        )
+
+    async def set_json(self, key: str, value: Any, ttl: float):
+        await self._run(self._set_json, key, json.dumps(value), ttl)
+
+    async def get_json(self, key: str) -> Any:
+        row = await self._run(lambda conn, now: conn.execute(
+            "SELECT value FROM documents WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone(), write=False)
+        return json.loads(row[0]) if row else None
+
+    async def close(self):
+        def close_conn():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, close_conn)
+
+    def describe(self) -> str:
+        return f"sqlite:{self.path}"
+
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server."""
+
+
+class RedisConnection:
+    """Minimal RESP2 client over asyncio streams: just enough for RedisState.
+
+    One connection per process; commands are serialised by a lock, which is
+    fine for the handful of tiny commands each request issues. The
+    connection is re-opened after an error or when used from a new event loop.
+    """
+
+    def __init__(self, host: str, port: int, password: Optional[str] = None, db: int = 0, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._reader = self._writer = None
+        return self._lock
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RedisError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            for reply in await self._send(setup):
+                if isinstance(reply, RedisError):
+                    raise reply
+
+    async def _send(self, commands: List[tuple]) -> list:
+        self._writer.write(b"".join(self._encode(c) for c in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def pipeline(self, commands: List[tuple]) -> list:
+        """Send commands in one write and return their replies (errors as RedisError objects).
+
+        The caller must hold `lock()`.
+        """
+        try:
+            if self._writer is None:
+                await asyncio.wait_for(self._open(), self.timeout)
+            return await asyncio.wait_for(self._send(commands), self.timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            await self.close()
+            raise
+
+    async def execute(self, *args):
+        async with self.lock():
+            reply = (await self.pipeline([args]))[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def close(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+
+class RedisState(SharedState):
+    """State in Redis (or anything speaking its protocol), for workers on several hosts.
+
+    Only plain commands plus MULTI/EXEC and WATCH are used (no Lua), so a
+    small stand-in server like `bench/resp_server.py` is enough to test it.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str = "archgemini:"):
+        parsed = urlparse(url)
+        db = (parsed.path or "/0").lstrip("/") or "0"
+        self.url = f"redis://{parsed.hostname or '127.0.0.1'}:{parsed.port or 6379}/{db}"
+        self.prefix = prefix
+        self.conn = RedisConnection(
+            parsed.hostname or "127.0.0.1",
+            parsed.port or 6379,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(db),
+        )
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    async def _transaction(self, commands: List[tuple]) -> Optional[list]:
+        async with self.conn.lock():
+            replies = await self.conn.pipeline([("MULTI",)] + commands + [("EXEC",)])
+        result = replies[-1]
+        if isinstance(result, RedisError):
+            raise result
+        return result
+
+    async def acquire_slot(self, name: str, holder: str, limit: int, ttl: float) -> bool:
+        key = self._key("slots", name)
+        now = time.time()
+        # Add ourselves, then back out if that took the set over the limit. Two
+        # racing workers may both back out; that errs on the side of fewer calls.
+        result = await self._transaction([
+            ("ZREMRANGEBYSCORE", key, "-inf", now),
+            ("ZADD", key, now + ttl, holder),
+            ("ZCARD", key),
+            ("PEXPIRE", key, int(ttl * 1000)),
+        ])
+        if result[2] <= limit:
+            return True
+        await self.conn.execute("ZREM", key, holder)
+        return False
+
+    async def release_slot(self, name: str, holder: str):
+        await self.conn.execute("ZREM", self._key("slots", name), holder)
+
+    async def slot_count(self, name: str) -> int:
+        return await self.conn.execute("ZCOUNT", self._key("slots", name), f"({time.time()}", "+inf")
+
+    async def take_tokens(self, key: str, rate: float, burst: float, cost: float) -> Tuple[float, float]:
+        key = self._key("bucket", key)
+        # Optimistic read-modify-write: EXEC returns nil if another worker touched the key
+        for _ in range(10):
+            async with self.conn.lock():
+                watched = await self.conn.pipeline([("WATCH", key), ("HMGET", key, "tokens", "updated")])
+                tokens, updated = watched[1] if not isinstance(watched[1], RedisError) else (None, None)
+                now = time.time()
+                tokens, wait = bucket_update(
+                    float(tokens) if tokens is not None else None,
+                    float(updated) if updated is not None else now,
+                    now, rate, burst, cost,
+                )
+                replies = await self.conn.pipeline([
+                    ("MULTI",),
+                    ("HSET", key, "tokens", repr(tokens), "updated", repr(now)),
+                    ("PEXPIRE", key, int(BUCKET_TTL * 1000)),
+                    ("EXEC",),
+                ])
+            if replies[-1] is not None:
+                return tokens, wait
+        raise RedisError(f"Token bucket {key} is too contended")
+
+    async def set_cooldown(self, name: str, member: str, until: float):
+        key = self._key("cooldowns", name)
+        current = await self.conn.execute("HGET", key, member)
+        if current is None or float(current) < until:
+            await self.conn.execute("HSET", key, member, repr(until))
+
+    async def cooldowns(self, name: str) -> Dict[str, float]:
+        reply = await self.conn.execute("HGETALL", self._key("cooldowns", name))
+        now = time.time()
+        pairs = dict(zip(reply[::2], reply[1::2]))
+        return {member: float(until) for member, until in pairs.items() if float(until) > now}
+
+    async def set_json(self, key: str, value: Any, ttl: float):
+        await self.conn.execute("SET", self._key("doc", key), json.dumps(value), "PX", int(ttl * 1000))
+
+    async def get_json(self, key: str) -> Any:
+        value = await self.conn.execute("GET", self._key("doc", key))
+        return json.loads(value) if value is not None else None
+
+    async def close(self):
+        await self.conn.close()
+
+    def describe(self) -> str:
+        return self.url
+
+
+def _is_worker_process() -> bool:
+    # uvicorn --workers / --reload run the app in multiprocessing children
+    return multiprocessing.parent_process() is not None
+
+
+def create_state(url: str) -> SharedState:
+    """Backend for SHARED_STATE_URL: "memory", "sqlite:///path", "redis://host:port/db" or "auto"."""
+    url = (url or "auto").strip()
+    if url == "auto":
+        if not _is_worker_process():
+            return MemoryState()
+        url = "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(settings.HISTORY_DB)), "shared_state.db")
+    if url == "memory":
+        return MemoryState()
+    if url.startswith("sqlite:///"):
+        return SQLiteState(url[len("sqlite:///"):], busy_timeout=settings.SQLITE_BUSY_TIMEOUT)
+    if url.startswith("redis://"):
+        return RedisState(url)
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+
+shared_state = create_state(settings.SHARED_STATE_URL)
+
+
+class StateSync:
+    """Periodically exchanges API key cooldowns between this worker and the others.
+
+    A key that gets a 429 in one worker is cooled down in all of them within
+    about one `interval`, instead of every worker finding out the hard way.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.errors = 0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        if shared_state.distributed and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.sync_keys()
+        except Exception:
+            pass
+
+    async def sync_keys(self):
+        pool = settings.key_pool
+        now = time.time()
+        for key_id, remaining in pool.drain_cooldowns():
+            await shared_state.set_cooldown("keys", key_id, now + remaining)
+        remote = await shared_state.cooldowns("keys")
+        pool.apply_cooldowns({key_id: until - time.time() for key_id, until in remote.items()})
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_keys()
+            except Exception as e:
+                self.errors += 1
+                if self.last_error != str(e):
+                    print(f"Shared state sync failed: {e}")
+                self.last_error = str(e)
+            await asyncio.sleep(self.interval)
+
+
+state_sync = StateSync(interval=settings.SHARED_STATE_SYNC_INTERVAL)
+
+
+async def state_stats() -> dict:
+    """Backend, this worker's id and the global slot counts (for /api/admin/state)."""
+    from core.limiter import limiters
+
+    slots = {}
+    for name, limiter in limiters.items():
+        if limiter.shared_limit:
+            try:
+                slots[name] = {"in_use": await shared_state.slot_count(name), "limit": limiter.shared_limit}
+            except Exception as e:
+                slots[name] = {"error": str(e)}
+    return {
+        "backend": shared_state.describe(),
+        "distributed": shared_state.distributed,
+        "worker_id": WORKER_ID,
+        "global_slots": slots,
+        "sync_errors": state_sync.errors,
+        "last_sync_error": state_sync.last_error,
+    }
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import os
+import re
+import secrets
+import time
+from typing import AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+from core.config import settings
+
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Buffer this much of a streamed chunk before each disk write
+_WRITE_BYTES = 1024 * 1024
+
+# Multipart boundaries and the small form fields around the file
+FORM_OVERHEAD = 64 * 1024
+
+
+def too_large_detail(limit: int) -> str:
+    return f"图片过大，不能超过 {limit // (1024 * 1024)} MB。"
+
+
+class UploadTooLarge(Exception):
+    """An upload went past its size cap (maps to 413)."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        super().__init__(f"upload exceeds {limit} bytes")
+
+
+class OffsetMismatch(Exception):
+    """A chunk was sent for the wrong offset (maps to 409 with the current offset)."""
+
+    def __init__(self, offset: int):
+        self.offset = offset
+        super().__init__(f"upload is at offset {offset}")
+
+
+class ResumableUploads:
+    """Large images uploaded in chunks, spooled straight to disk.
+
+    `create` opens a session; `append` writes one chunk at the offset the
+    client says it starts at, so after a dropped connection the client asks
+    for the current offset and carries on from there. A finished upload is
+    opened as a file and analysed in place, so nothing holds the whole image
+    in memory. Sessions are files under `root` (shared by every worker on the
+    host) and are removed `ttl` seconds after they were last written.
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.created = 0
+        self.expired = 0
+        # upload_id -> [lock, requests using it]; one chunk at a time per session in this worker
+        self._locks: Dict[str, list] = {}
+
+    def _paths(self, upload_id: str):
+        base = os.path.join(self.root, upload_id)
+        return base + ".part", base + ".json"
+
+    def _read_meta(self, upload_id: str) -> Optional[Dict]:
+        if not _UPLOAD_ID_RE.match(upload_id or ""):
+            return None
+        part, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            offset = os.path.getsize(part)
+            updated_at = os.path.getmtime(part)
+        except (OSError, ValueError):
+            return None
+        if updated_at + self.ttl < time.time():
+            self._remove(upload_id)
+            self.expired += 1
+            return None
+        return {
+            **meta,
+            "upload_id": upload_id,
+            "offset": offset,
+            "complete": meta.get("size") is None or offset >= meta["size"],
+            "expires_at": updated_at + self.ttl,
+        }
+
+    def _remove(self, upload_id: str):
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _sweep(self):
+        """Drop sessions nobody has written to within the TTL."""
+        cutoff = time.time() - self.ttl
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(".part"):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.root, name)) < cutoff:
+                    self._remove(name[:-len(".part")])
+                    self.expired += 1
+            except FileNotFoundError:
+                pass
+
+    def _create(self, mime_type: str, size: Optional[int]) -> Dict:
+        os.makedirs(self.root, exist_ok=True)
+        self._sweep()
+        upload_id = secrets.token_hex(16)
+        part, meta_path = self._paths(upload_id)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"mime_type": mime_type, "size": size, "created_at": time.time()}, f)
+        open(part, "wb").close()
+        self.created += 1
+        return self._read_meta(upload_id)
+
+    async def create(self, mime_type: str, size: Optional[int] = None) -> Dict:
+        """Open a session; `size` (if known) marks it complete once that many bytes arrive."""
+        if size is not None and size > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+        return await asyncio.to_thread(self._create, mime_type, size)
+
+    async def status(self, upload_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._read_meta, upload_id)
+
+    async def append(self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Optional[Dict]:
+        """Write `chunks` at `offset`; returns the new status, or None if the session is gone.
+
+        Raises OffsetMismatch unless `offset` is the current end of the upload,
+        and UploadTooLarge (keeping the data before this chunk) past the cap.
+        """
+        entry = self._locks.setdefault(upload_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                meta = await self.status(upload_id)
+                if meta is None:
+                    return None
+                if offset != meta["offset"]:
+                    raise OffsetMismatch(meta["offset"])
+                limit = min(self.max_bytes, meta["size"] if meta.get("size") is not None else self.max_bytes)
+                part, _ = self._paths(upload_id)
+                f = await asyncio.to_thread(open, part, "r+b")
+                try:
+                    await asyncio.to_thread(f.seek, offset)
+                    written, pending = offset, []
+                    buffered = 0
+                    # Whatever arrived before a dropped connection stays; the client resumes after it
+                    try:
+                        async for chunk in chunks:
+                            written += len(chunk)
+                            if written > limit:
+                                await asyncio.to_thread(f.truncate, offset)
+                                raise UploadTooLarge(limit)
+                            pending.append(chunk)
+                            buffered += len(chunk)
+                            if buffered >= _WRITE_BYTES:
+                                await asyncio.to_thread(f.write, b"".join(pending))
+                                pending, buffered = [], 0
+                    finally:
+                        if pending and written <= limit:
+                            await asyncio.to_thread(f.write, b"".join(pending))
+                finally:
+                    await asyncio.to_thread(f.close)
+                return await self.status(upload_id)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(upload_id, None)
+
+    async def open(self, upload_id: str) -> Optional[Tuple[BinaryIO, str]]:
+        """`(file, mime_type)` of a finished upload (caller closes the file); None if unknown or expired."""
+        meta = await self.status(upload_id)
+        if meta is None:
+            return None
+        if not meta["complete"]:
+            raise OffsetMismatch(meta["offset"])
+        f = await asyncio.to_thread(open, self._paths(upload_id)[0], "rb")
+        return f, meta["mime_type"]
+
+    async def discard(self, upload_id: str) -> bool:
+        if await self.status(upload_id) is None:
+            return False
+        await asyncio.to_thread(self._remove, upload_id)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "root": self.root,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "created": self.created,
+            "expired": self.expired,
+            "writing": len(self._locks),
+        }
+
+
+class BodyLimitMiddleware:
+    """Pure ASGI middleware: 413 for request bodies over a per-path cap.
+
+    Requests whose Content-Length is already too big are refused before any
+    of the body is read; chunked bodies are counted as they stream in and cut
+    off at the cap. `limits` maps exact paths to byte limits.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    @staticmethod
+    async def _reject(send, limit: int):
+        body = json.dumps({"detail": too_large_detail(limit)}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    too_big = int(value) > limit + FORM_OVERHEAD
+                except ValueError:
+                    too_big = False
+                if too_big:
+                    await self._reject(send, limit)
+                    return
+
+        state = {"received": 0, "over": False, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > limit + FORM_OVERHEAD:
+                    state["over"] = True
+                    raise UploadTooLarge(limit)
+            return message
+
+        async def guarded_send(message):
+            # Once the body is cut off, whatever the app answers is replaced by the 413
+            if state["over"]:
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not state["over"]:
+                raise
+        if state["over"] and not state["started"]:
+            await self._reject(send, limit)
+
+
+resumable_uploads = ResumableUploads(
+    settings.ANALYZE_UPLOAD_DIR,
+    max_bytes=settings.ANALYZE_UPLOAD_MAX_BYTES,
+    ttl=settings.ANALYZE_UPLOAD_TTL,
+)
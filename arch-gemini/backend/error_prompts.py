@@ -19,3 +19,33 @@ ERROR_TRANSLATION_SYSTEM_PROMPT = """
 输入: "Safety filter triggered: content unsafe"
 输出: "生成内容涉及敏感信息，已被拦截。"
 """
+
+# Known error signatures -> user-facing message.
+# Checked in order before calling the LLM, so common failures need no Qwen round-trip.
+# Case-sensitive, and anchored on what the services raise (the "HTTP <code>" prefix,
+# fixed message markers, the Google error "status" field) rather than on bare words:
+# error messages echo response bodies, which mention e.g. safetyRatings on success too.
+KNOWN_ERROR_MESSAGES = [
+    (r"GOOGLE_API_KEY is not set|QWEN_API_KEY is not set", "API 密钥未配置，请检查设置。"),
+    (r"HTTP 429\b|\"status\":\s*\"RESOURCE_EXHAUSTED\"|All API keys are rate limited", "请求过于频繁，请稍后重试。"),
+    (r"\bServer busy \(", "服务器繁忙，请稍后重试。"),
+    (r"\(Prompt Unsafe\)|['\"]blockReason['\"]:\s*['\"][A-Z_]+", "提示词包含敏感内容，请修改后重试。"),
+    (
+        r"\(Safety Filter Triggered\)|Finish Reason: (IMAGE_)?SAFETY\b|['\"]finishReason['\"]:\s*['\"](IMAGE_)?SAFETY['\"]",
+        "生成内容涉及敏感信息，已被拦截，请修改提示词。",
+    ),
+    (
+        r"\(Recitation\)|Finish Reason: RECITATION\b|['\"]finishReason['\"]:\s*['\"]RECITATION['\"]",
+        "生成内容可能涉及版权保护，请修改提示词。",
+    ),
+    (
+        r"HTTP 40[13]\b|\"status\":\s*\"(PERMISSION_DENIED|UNAUTHENTICATED)\"|API key not valid|\bAPI_KEY_INVALID\b",
+        "API 密钥无效或已过期，请检查配置。",
+    ),
+    (
+        r"\b(Read|Write|Connect|Pool)Timeout:|\bTimeoutError:|HTTP 504\b|\"status\":\s*\"DEADLINE_EXCEEDED\"",
+        "请求超时，请稍后重试。",
+    ),
+    (r"\bConnectError:|Connection refused|Name or service not known", "服务器连接失败，请检查网络后重试。"),
+    (r"HTTP 50[023]\b|\"status\":\s*\"(UNAVAILABLE|INTERNAL)\"", "服务暂时不可用，请稍后重试。"),
+]
@@ -38,3 +38,6 @@ nsfw, nude, people, crowded, ugly, deformed, blurry, pixelated,
 artifacts, noise, glitch, cartoon, anime, illustration, painting, drawing, sketch, 
 out of frame, cut off, bad composition, weird colors
 """
+
+# Appended to every generation prompt; built once at import instead of per request
+NEGATIVE_PROMPT_SUFFIX = f"\n\n[Negative Prompt / Exclude]: {DEFAULT_NEGATIVE_PROMPT.strip()}"
@@ -0,0 +1,178 @@
+import asyncio
+import base64
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from core.blobs import blob_store
+from core.config import settings
+from core.http_client import http_client
+from core.key_pool import key_id, key_suffix
+from core.metrics import upstream_span
+from core.singleflight import SingleFlight
+
+# Files uploaded to the Gemini File API are deleted after 48 hours
+FILE_TTL = 48 * 3600
+# Re-upload rather than send a URI that could expire mid-request
+_MIN_REMAINING = 3600
+# After the upstream rejects the upload endpoint (e.g. a relay without /upload/), retry this much later
+_DISABLE_SECONDS = 600
+
+
+class ReferenceExpired(ValueError):
+    """A stored reference handle is unknown or has been evicted."""
+
+    def __init__(self, handle: str):
+        self.handle = handle
+        super().__init__(f"reference image {handle[:12]}... is no longer stored")
+
+
+def _parse_expiry(value: Optional[str]) -> float:
+    if value:
+        try:
+            # RFC 3339 with up to nanosecond fractions; Python reads at most microseconds
+            head = value.rstrip("Z").partition(".")[0]
+            return datetime.fromisoformat(head + "+00:00").timestamp()
+        except ValueError:
+            pass
+    return time.time() + FILE_TTL
+
+
+def _encode_blob(handle: str) -> Dict[str, str]:
+    found = blob_store.read(handle)
+    if found is None:
+        raise ReferenceExpired(handle)
+    data, mime_type = found
+    return {"data": base64.b64encode(data).decode("ascii"), "mime_type": mime_type}
+
+
+async def inline_image(image: Dict[str, Any]) -> Dict[str, Any]:
+    """`{"handle"}` -> `{"data": <base64>, "mime_type"}`; other images pass through."""
+    handle = image.get("handle") if isinstance(image, dict) else None
+    if not handle:
+        return image
+    return await asyncio.get_running_loop().run_in_executor(None, _encode_blob, handle)
+
+
+async def inline_images(images: List[Any]) -> List[Any]:
+    if not any(isinstance(img, dict) and img.get("handle") for img in images):
+        return images
+    return list(await asyncio.gather(*[inline_image(img) for img in images]))
+
+
+class GeminiFiles:
+    """Map stored blob handles to Gemini File API URIs, uploading each at most once per key.
+
+    A request that references images by handle then carries a `fileData` URI
+    per image instead of the base64 payload, and repeat requests skip the
+    upload too. Any failure falls back to inline data for that image.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.uploads = 0
+        self.reused = 0
+        self.failures = 0
+        self._disabled_until = 0.0
+        self._flights = SingleFlight()
+
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._disabled_until
+
+    async def uri_for(self, handle: str, api_key: str) -> Optional[str]:
+        """File URI of `handle` usable with `api_key`, uploading it if needed; None = send inline."""
+        if not self.available():
+            return None
+        kid = key_id(api_key)
+        uri = await blob_store.afile_uri(handle, kid, _MIN_REMAINING)
+        if uri:
+            self.reused += 1
+            return uri
+        return await self._flights.do(f"{handle}:{kid}", lambda: self._upload(handle, kid, api_key))
+
+    async def _upload(self, handle: str, kid: str, api_key: str) -> Optional[str]:
+        found = await blob_store.aread(handle)
+        if found is None:
+            raise ReferenceExpired(handle)
+        data, mime_type = found
+        base_url = settings.GOOGLE_API_BASE_URL.rstrip('/')
+        client = http_client.get_client("gemini")
+        try:
+            with upstream_span("gemini", model="files", key=key_suffix(api_key)):
+                # Resumable protocol: "start" returns an upload URL, then one "upload, finalize"
+                start = await client.post(
+                    f"{base_url}/upload/v1beta/files",
+                    json={"file": {"display_name": handle[:16]}},
+                    headers={
+                        "x-goog-api-key": api_key,
+                        "X-Goog-Upload-Protocol": "resumable",
+                        "X-Goog-Upload-Command": "start",
+                        "X-Goog-Upload-Header-Content-Length": str(len(data)),
+                        "X-Goog-Upload-Header-Content-Type": mime_type,
+                    },
+                    timeout=30.0,
+                )
+                start.raise_for_status()
+                upload_url = start.headers.get("x-goog-upload-url")
+                if not upload_url:
+                    raise ValueError("upstream returned no x-goog-upload-url")
+                response = await client.post(
+                    upload_url,
+                    content=data,
+                    headers={
+                        "x-goog-api-key": api_key,
+                        "X-Goog-Upload-Offset": "0",
+                        "X-Goog-Upload-Command": "upload, finalize",
+                    },
+                    timeout=60.0,
+                )
+                response.raise_for_status()
+            info = response.json().get("file") or {}
+            uri = info.get("uri")
+            if not uri:
+                raise ValueError("upstream returned no file uri")
+            if info.get("state") not in (None, "ACTIVE"):
+                # Images are normally ACTIVE at once; don't wait on one that isn't
+                raise ValueError(f"file is {info.get('state')}")
+        except Exception as e:
+            self.failures += 1
+            unsupported = isinstance(e, ValueError) or (
+                isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (400, 404, 405, 501)
+            )
+            if unsupported:
+                self._disabled_until = time.monotonic() + _DISABLE_SECONDS
+            print(f"File API upload of {handle[:12]} failed, sending inline: {e}")
+            return None
+
+        await blob_store.aset_file_uri(handle, kid, uri, _parse_expiry(info.get("expirationTime")))
+        self.uploads += 1
+        return uri
+
+    async def images_for_key(self, images: List[Any], api_key: str) -> List[Any]:
+        """Resolve handles for one key: a File API URI where possible, inline base64 otherwise."""
+
+        async def resolve(image):
+            handle = image.get("handle") if isinstance(image, dict) else None
+            if not handle:
+                return image
+            uri = await self.uri_for(handle, api_key)
+            if uri:
+                return {"file_uri": uri, "mime_type": image.get("mime_type") or "image/jpeg"}
+            return await inline_image(image)
+
+        return list(await asyncio.gather(*[resolve(img) for img in images]))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "available": self.available(),
+            "uploads": self.uploads,
+            "reused": self.reused,
+            "failures": self.failures,
+            "uploads_in_flight": self._flights.in_flight(),
+        }
+
+
+gemini_files = GeminiFiles(enabled=settings.GEMINI_FILE_API_ENABLED)
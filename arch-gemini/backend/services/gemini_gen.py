@@ -1,11 +1,28 @@
+import asyncio
+import base64
 import httpx
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 from core.config import settings
 from core.http_client import http_client
+from core.serialization import adumps, aload_gemini_response, payload_size_hint
+from core.routing import ModelRouter, parse_retry_policy
+from core.limiter import Overloaded, get_limiter
+from core.key_pool import key_suffix
+from core.metrics import span, upstream_span
+from services.gemini_files import gemini_files, inline_image, inline_images
+from services.generation_cache import generation_cache
+from prompts import NEGATIVE_PROMPT_SUFFIX
+from analysis_prompts import REFERENCE_ANALYSIS_PROMPT
 
 def _extract_inline_image_part(result: dict) -> tuple[str, str]:
+    candidates = _checked_candidates(result)
+    return _extract_candidate_image(candidates[0], result)
+
+
+def _checked_candidates(result: dict) -> list:
     candidates = result.get("candidates") or []
     prompt_feedback = result.get("promptFeedback")
-    
+
     # Check for direct prompt block
     if prompt_feedback and prompt_feedback.get("blockReason"):
         raise Exception(f"请求被拒绝: {prompt_feedback.get('blockReason')} (Prompt Unsafe)")
@@ -13,9 +30,10 @@ def _extract_inline_image_part(result: dict) -> tuple[str, str]:
     if not candidates:
         # Check if it was blocked at the top level
         raise Exception(f"生成失败: 未返回任何结果。Response: {str(result)[:200]}")
+    return candidates
 
-    candidate = candidates[0]
-    
+
+def _extract_candidate_image(candidate: dict, result: dict) -> tuple[str, str]:
     # Check finish reason
     finish_reason = candidate.get("finishReason")
     if finish_reason == "SAFETY":
@@ -40,35 +58,26 @@ def _extract_inline_image_part(result: dict) -> tuple[str, str]:
     raise Exception(f"无法提取图片数据。Finish Reason: {finish_reason}. Response: {str(result)[:200]}")
 
 
-from typing import Any, Dict, List, Union
+# Encoded request body, or a builder for it per API key (File API references)
+GenerateBody = Union[bytes, Callable[[str], Awaitable[bytes]]]
 
-async def _generate_image_with_model(
+async def _build_generate_body(
     prompt: str,
     aspect_ratio: str,
     resolution: str,
-    model: str,
     images: List[Union[str, Dict[str, Any]]] = [],
-) -> tuple[str, str, str]:
-    # Use dynamic key rotation
-    api_key = settings.get_google_api_key()
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY is not set")
-
-    base_url = settings.GOOGLE_API_BASE_URL.rstrip('/')
-    url = f"{base_url}/v1beta/models/{model}:generateContent"
-
-    headers = {
-        "x-goog-api-key": api_key,
-        "Content-Type": "application/json"
-    }
-
-    from prompts import DEFAULT_NEGATIVE_PROMPT
-
+    candidate_count: int = 1,
+) -> bytes:
+    """Encode a generateContent request body. The body does not depend on the model or key."""
     # Construct parts: text first, then images
     # Append negative prompt to ensure quality and safety
-    full_prompt = f"{prompt}\n\n[Negative Prompt / Exclude]: {DEFAULT_NEGATIVE_PROMPT.strip()}"
+    full_prompt = prompt + NEGATIVE_PROMPT_SUFFIX
     parts = [{"text": full_prompt}]
     for img in images:
+        if isinstance(img, dict) and img.get("file_uri"):
+            # Uploaded once via the File API: a reference instead of the payload
+            parts.append({"fileData": {"mimeType": img.get("mime_type") or "image/jpeg", "fileUri": img["file_uri"]}})
+            continue
         if isinstance(img, dict):
             img_b64 = img.get("data")
             mime_type = img.get("mime_type") or "image/jpeg"
@@ -103,74 +112,448 @@ async def _generate_image_with_model(
             }
         }
     }
+    if candidate_count > 1:
+        data["generationConfig"]["candidateCount"] = candidate_count
 
-    client = http_client.get_client()
-    response = await client.post(url, json=data, headers=headers, timeout=60.0)
-    response.raise_for_status()
-    result = response.json()
-    image_data, mime_type = _extract_inline_image_part(result)
-    return image_data, mime_type, api_key
+    # Encode once (off-loop for large payloads); retries on other keys reuse the same body
+    with span("encode", resolution=resolution):
+        return await adumps(data, size_hint=payload_size_hint(parts))
 
 
-from services.gemini_vision import analyze_image
-import base64
+async def _prepare_body(
+    prompt: str,
+    aspect_ratio: str,
+    resolution: str,
+    images: List[Union[str, Dict[str, Any]]] = [],
+    candidate_count: int = 1,
+) -> GenerateBody:
+    """Encode the body once, or return a per-key builder when stored references can go by File API URI.
+
+    Images given as `{"handle"}` (see /api/uploads) are read from the blob
+    store. File API uploads belong to one key's project, so with the File API
+    on the body is built for whichever key the pool picks; it is small then,
+    since it carries URIs rather than base64.
+    """
+    if any(isinstance(img, dict) and img.get("handle") for img in images):
+        if gemini_files.available():
+            async def for_key(api_key: str) -> bytes:
+                resolved = await gemini_files.images_for_key(images, api_key)
+                return await _build_generate_body(prompt, aspect_ratio, resolution, resolved, candidate_count)
+            return for_key
+        images = await inline_images(images)
+    return await _build_generate_body(prompt, aspect_ratio, resolution, images, candidate_count)
+
+
+async def _post_generate(model: str, body: GenerateBody, resolution: str = "") -> tuple[dict, str]:
+    """POST a prepared body (or per-key builder) to `model`. Returns the parsed response and the key used."""
+    if not settings.GOOGLE_API_KEYS:
+        raise ValueError("GOOGLE_API_KEY is not set")
+
+    base_url = settings.GOOGLE_API_BASE_URL.rstrip('/')
+    url = f"{base_url}/v1beta/models/{model}:generateContent"
+    client = http_client.get_client("gemini")
+
+    async def call(api_key: str) -> dict:
+        content = body if isinstance(body, bytes) else await body(api_key)
+        headers = {
+            "x-goog-api-key": api_key,
+            "Content-Type": "application/json"
+        }
+        with upstream_span("gemini", model=model, resolution=resolution, key=key_suffix(api_key)):
+            response = await client.post(url, content=content, headers=headers, timeout=60.0)
+            response.raise_for_status()
+        # Parse the envelope without materialising the multi-MB image string twice
+        with span("decode", model=model, resolution=resolution):
+            return await aload_gemini_response(response.content)
+
+    # Least-loaded healthy key; throttled (429) or rejected (401/403) keys are retried on another key
+    async with get_limiter("upstream:gemini").slot():
+        return await settings.key_pool.call(call)
+
+
+async def _sse_payloads(response: httpx.Response, on_first_byte: Optional[Callable[[], None]] = None):
+    """Yield the `data:` payload of each server-sent event as soon as it is complete."""
+    buffer = bytearray()
+    scanned = 0
+    data: List[bytes] = []
+    async for chunk in response.aiter_bytes():
+        if on_first_byte is not None:
+            on_first_byte()
+            on_first_byte = None
+        buffer += chunk
+        while True:
+            # Only scan the new bytes: an image event is one multi-MB line
+            end = buffer.find(b"\n", scanned)
+            if end == -1:
+                scanned = len(buffer)
+                break
+            line = bytes(buffer[:end]).rstrip(b"\r")
+            del buffer[:end + 1]
+            scanned = 0
+            if not line:
+                if data:
+                    yield b"\n".join(data)
+                    data = []
+            elif line.startswith(b"data:"):
+                data.append(line[6:] if line[5:6] == b" " else line[5:])
+    line = bytes(buffer).rstrip(b"\r")
+    if line.startswith(b"data:"):
+        data.append(line[6:] if line[5:6] == b" " else line[5:])
+    if data:
+        yield b"\n".join(data)
+
 
-async def _analyze_reference_images(images: List[str]) -> str:
-    """Analyze multiple images and return a combined description prompt."""
+def _has_inline_image(result: dict) -> bool:
+    for candidate in result.get("candidates") or []:
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            inline_data = part.get("inlineData") or part.get("inline_data")
+            if inline_data and inline_data.get("data"):
+                return True
+    return False
+
+
+async def _stream_generate(
+    model: str, body: GenerateBody, resolution: str, emit: Callable[[str, dict], None]
+) -> tuple[dict, str]:
+    """`_post_generate` over streamGenerateContent (SSE), reporting progress through `emit`.
+
+    Each streamed chunk is parsed on its own as it arrives; the one carrying
+    the image is returned (with the key used), so the caller can extract it
+    exactly like a unary response.
+    """
+    if not settings.GOOGLE_API_KEYS:
+        raise ValueError("GOOGLE_API_KEY is not set")
+
+    base_url = settings.GOOGLE_API_BASE_URL.rstrip('/')
+    url = f"{base_url}/v1beta/models/{model}:streamGenerateContent?alt=sse"
+    client = http_client.get_client("gemini")
+
+    async def call(api_key: str) -> dict:
+        content = body if isinstance(body, bytes) else await body(api_key)
+        headers = {
+            "x-goog-api-key": api_key,
+            "Content-Type": "application/json"
+        }
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        emit("upstream_started", {"model": model})
+        image_chunk, last_chunk = None, None
+        with upstream_span("gemini", model=model, resolution=resolution, key=key_suffix(api_key)):
+            async with client.stream("POST", url, content=content, headers=headers, timeout=60.0) as response:
+                if response.is_error:
+                    # Read the error body so retries and error translation can see it
+                    await response.aread()
+                    response.raise_for_status()
+                def first_byte():
+                    emit("first_byte", {"model": model, "ms": round((loop.time() - start) * 1000)})
+
+                async for payload in _sse_payloads(response, first_byte):
+                    if len(payload) > 64 * 1024:
+                        emit("decoding", {"model": model, "bytes": len(payload)})
+                    with span("decode", model=model, resolution=resolution):
+                        chunk = await aload_gemini_response(payload)
+                    last_chunk = chunk
+                    if image_chunk is None and _has_inline_image(chunk):
+                        image_chunk = chunk
+        if image_chunk is not None:
+            return image_chunk
+        if last_chunk is None:
+            raise Exception("生成失败: 未返回任何结果。")
+        # No image: let the usual checks turn the last chunk's finishReason into an error
+        return last_chunk
+
+    async with get_limiter("upstream:gemini").slot():
+        return await settings.key_pool.call(call)
+
+
+async def _analyze_reference_images(images: List[Union[str, Dict[str, Any]]]) -> str:
+    """Analyze multiple images concurrently and return a combined description prompt.
+
+    Concurrency is bounded by REFERENCE_ANALYSIS_CONCURRENCY and by the number of
+    healthy API keys, so throttled keys don't get extra load. Each image has its
+    own timeout; failed images are skipped and the rest keep their input order.
+    """
     if not images:
         return ""
-    
-    descriptions = []
-    # Process sequentially to avoid rate limits or complex concurrency for now
-    for i, img_b64 in enumerate(images):
+    # Only needed for describe_references; keeps the generation path from importing the vision service
+    from services.gemini_vision import analyze_image
+
+    limit = settings.REFERENCE_ANALYSIS_CONCURRENCY
+    limit = max(1, min(limit, settings.key_pool.healthy_count() or 1))
+    semaphore = asyncio.Semaphore(limit)
+
+    async def describe(i: int, img: Union[str, Dict[str, Any]]):
+        if isinstance(img, dict) and img.get("handle"):
+            try:
+                img = await inline_image(img)
+            except Exception as e:
+                print(f"Failed to load reference image {i}: {e}")
+                return None
+        if isinstance(img, dict):
+            img_b64 = img.get("data")
+            mime_type = img.get("mime_type") or "image/jpeg"
+        else:
+            img_b64 = img
+            mime_type = "image/jpeg"
         try:
-            # Simple decoding to bytes for the existing analyze_image function
-            img_bytes = base64.b64decode(img_b64)
-            # analyze_image handles key internally, but we might want to standardize
-            desc, _ = await analyze_image(
-                img_bytes, 
-                mime_type="image/jpeg", # Defaulting to jpeg/png as generic
-                prompt="请详细描述这张图片的视觉特征、构图、材质和光照，用于指导AI重新生成类似的画面。"
-            )
-            descriptions.append(f"参考图 {i+1} 特征: {desc}")
+            async with semaphore:
+                # Simple decoding to bytes for the existing analyze_image function
+                img_bytes = base64.b64decode(img_b64)
+                desc, _ = await asyncio.wait_for(
+                    analyze_image(img_bytes, mime_type=mime_type, prompt=REFERENCE_ANALYSIS_PROMPT),
+                    timeout=settings.REFERENCE_ANALYSIS_TIMEOUT,
+                )
+            return f"参考图 {i+1} 特征: {desc}"
+        except asyncio.TimeoutError:
+            print(f"Timed out analyzing reference image {i}")
         except Exception as e:
             print(f"Failed to analyze reference image {i}: {e}")
-            
+        return None
+
+    results = await asyncio.gather(*[describe(i, img) for i, img in enumerate(images)])
+    descriptions = [d for d in results if d]
+
     if not descriptions:
         return ""
-        
+
     return "\n\n【参考图像分析】:\n" + "\n".join(descriptions)
 
-async def generate_image(prompt: str, aspect_ratio: str = "16:9", resolution: str = "1K", images: List[dict] = []) -> tuple[str, str, str, str]:
-    primary_model = settings.GEMINI_IMAGE_MODEL
-    fallback_model = settings.GEMINI_IMAGE_FALLBACK_MODEL
+async def _with_reference_descriptions(prompt: str, images: List[dict], describe_references: bool) -> str:
+    """Optional pipeline stage: append text descriptions of the references to the prompt."""
+    if not describe_references or not images:
+        return prompt
+    return prompt + await _analyze_reference_images(images)
+
+# Primary/fallback routing with per-class retries and optional p95 hedging
+generation_router = ModelRouter(
+    primary=settings.GEMINI_IMAGE_MODEL,
+    fallback=settings.GEMINI_IMAGE_FALLBACK_MODEL,
+    retry_policy=parse_retry_policy(settings.GEMINI_RETRY_POLICY),
+    backoff_base=settings.GEMINI_RETRY_BACKOFF_BASE,
+    backoff_max=settings.GEMINI_RETRY_BACKOFF_MAX,
+    hedge_enabled=settings.GEMINI_HEDGE_ENABLED,
+    hedge_quantile=settings.GEMINI_HEDGE_QUANTILE,
+    hedge_min_samples=settings.GEMINI_HEDGE_MIN_SAMPLES,
+    hedge_max_ratio=settings.GEMINI_HEDGE_MAX_RATIO,
+    hedge_to_fallback=settings.GEMINI_HEDGE_TO_FALLBACK,
+)
 
+async def generate_image(prompt: str, aspect_ratio: str = "16:9", resolution: str = "1K", images: List[dict] = [], describe_references: bool = False, force_fresh: bool = False) -> tuple[str, str, str, str]:
+    """Returns (image_base64, mime_type, model_used, api_key).
+
+    With GENERATION_CACHE_ENABLED an identical earlier request is answered from
+    the generation cache and `api_key` is None; `force_fresh` skips the lookup
+    (the new result replaces the cached one).
+    """
     # Use explicit imageSize parameter for Gemini 3 Pro
     # Ref: https://ai.google.dev/gemini-api/docs/image-generation?hl=zh-cn
     # Valid values: "1K", "2K", "4K"
-    
+
     # Ensure resolution is uppercase just in case
     clean_resolution = resolution.upper() if resolution else "1K"
 
+    cache_key = None
+    if generation_cache.enabled:
+        # Keyed on the caller's prompt: reference descriptions are model output, not input
+        cache_key = await generation_cache.key(prompt, aspect_ratio, clean_resolution, images, describe_references)
+        if force_fresh:
+            generation_cache.bypassed += 1
+        else:
+            hit = await generation_cache.get(cache_key)
+            if hit is not None:
+                image_b64, mime_type, model_used = hit
+                return image_b64, mime_type, model_used, None
+
+    prompt = await _with_reference_descriptions(prompt, images, describe_references)
+
     try:
-        image_b64, mime_type, api_key = await _generate_image_with_model(
-            prompt=prompt, 
-            aspect_ratio=aspect_ratio, 
-            resolution=clean_resolution,
-            model=primary_model, 
-            images=images
+        body = await _prepare_body(prompt, aspect_ratio, clean_resolution, images)
+
+        async def attempt(model: str):
+            result, api_key = await _post_generate(model, body, clean_resolution)
+            image_b64, mime_type = _extract_inline_image_part(result)
+            return image_b64, mime_type, api_key
+
+        # Latency is tracked per model and resolution: a 4K render is not slow for 4K
+        (image_b64, mime_type, api_key), model_used = await generation_router.run(
+            attempt, latency_key=clean_resolution
         )
-        return image_b64, mime_type, primary_model, api_key
-    except httpx.HTTPStatusError as e:
-        if e.response.status_code == 404 and fallback_model and fallback_model != primary_model:
-            image_b64, mime_type, api_key = await _generate_image_with_model(
-                prompt=prompt, 
-                aspect_ratio=aspect_ratio, 
-                resolution=clean_resolution,
-                model=fallback_model, 
-                images=images
-            )
-            return image_b64, mime_type, fallback_model, api_key
-        raise Exception(f"Gemini API Error ({settings.GOOGLE_API_BASE_URL}): {e.response.text}")
+        if cache_key is not None:
+            generation_cache.put(cache_key, image_b64, mime_type, model_used)
+        return image_b64, mime_type, model_used, api_key
     except Exception as e:
-        raise Exception(f"Gemini Gen Service Error ({settings.GOOGLE_API_BASE_URL}): {str(e)}")
+        raise _service_error(e) from e
+
+
+async def generate_image_stream(
+    prompt: str,
+    aspect_ratio: str = "16:9",
+    resolution: str = "1K",
+    images: List[dict] = [],
+    describe_references: bool = False,
+):
+    """Streaming `generate_image`: yields lifecycle events, then the image.
+
+    Events are dicts with an `event` key: `describing_references`,
+    `upstream_started` (again on each retry or fallback, with `model`),
+    `first_byte` (`ms` since the request went out), `decoding` (`bytes`) and
+    finally `done` with `image_base64`, `mime_type`, `model_used` and
+    `api_key`. Retries and fallback follow `generation_router`; hedging is
+    off, since a hedge would open a second stream. Errors are raised the same
+    way as `generate_image`.
+    """
+    clean_resolution = resolution.upper() if resolution else "1K"
+    events: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str, data: dict):
+        events.put_nowait({"event": event, **data})
+
+    async def produce():
+        nonlocal prompt
+        if describe_references and images:
+            emit("describing_references", {"count": len(images)})
+        prompt = await _with_reference_descriptions(prompt, images, describe_references)
+        body = await _prepare_body(prompt, aspect_ratio, clean_resolution, images)
+
+        async def attempt(model: str):
+            result, api_key = await _stream_generate(model, body, clean_resolution, emit)
+            image_b64, mime_type = _extract_inline_image_part(result)
+            return image_b64, mime_type, api_key
+
+        return await generation_router.run(attempt, latency_key=clean_resolution, hedge=False)
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while not task.done() or not events.empty():
+            if events.empty():
+                getter = asyncio.ensure_future(events.get())
+                await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    continue
+                yield getter.result()
+            else:
+                yield events.get_nowait()
+        try:
+            (image_b64, mime_type, api_key), model_used = task.result()
+        except Exception as e:
+            raise _service_error(e) from e
+        yield {
+            "event": "done",
+            "image_base64": image_b64,
+            "mime_type": mime_type,
+            "model_used": model_used,
+            "api_key": api_key,
+        }
+    finally:
+        # Client went away mid-stream: stop the upstream call too
+        task.cancel()
+
+
+async def _post_generate_with_fallback(body: GenerateBody, resolution: str = "") -> tuple[dict, str, str]:
+    """Route one prepared body (retries + fallback, no hedging). Returns (result, model, key)."""
+    (result, api_key), model_used = await generation_router.run(
+        lambda model: _post_generate(model, body, resolution), latency_key=resolution, hedge=False
+    )
+    return result, model_used, api_key
+
+
+def _service_error(e: Exception) -> Exception:
+    if isinstance(e, Overloaded):
+        return e
+    if isinstance(e, httpx.HTTPStatusError):
+        return Exception(
+            f"Gemini API Error ({settings.GOOGLE_API_BASE_URL}): HTTP {e.response.status_code}: {e.response.text}"
+        )
+    if isinstance(e, (httpx.TransportError, asyncio.TimeoutError)):
+        # str() of these is often empty; the type says what went wrong
+        return Exception(f"Gemini Gen Service Error ({settings.GOOGLE_API_BASE_URL}): {type(e).__name__}: {e}")
+    return Exception(f"Gemini Gen Service Error ({settings.GOOGLE_API_BASE_URL}): {str(e)}")
+
+
+async def generate_image_variants(
+    prompt: str,
+    aspect_ratio: str = "16:9",
+    resolution: str = "1K",
+    images: List[dict] = [],
+    count: int = 2,
+    describe_references: bool = False,
+):
+    """Generate `count` variants of one prompt, yielding each as soon as it is ready.
+
+    The request body (prompt + reference images) is encoded once and shared.
+    Models listed in GEMINI_CANDIDATE_COUNT_MODELS get a single call with
+    `candidateCount`; otherwise the variants fan out as concurrent calls, which
+    the key pool spreads over the least-loaded keys. Failures are per variant:
+    yields `{"index", "image_base64", "mime_type", "model_used", "api_key"}` or
+    `{"index", "error"}`, so partial success is possible.
+    """
+    clean_resolution = resolution.upper() if resolution else "1K"
+    count = max(1, count)
+    prompt = await _with_reference_descriptions(prompt, images, describe_references)
+
+    if settings.GEMINI_IMAGE_MODEL in settings.GEMINI_CANDIDATE_COUNT_MODELS and count > 1:
+        body = await _prepare_body(prompt, aspect_ratio, clean_resolution, images, candidate_count=count)
+        try:
+            result, model_used, api_key = await _post_generate_with_fallback(body, clean_resolution)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                error = str(_service_error(e))
+                for index in range(count):
+                    yield {"index": index, "error": error}
+                return
+            # Model rejected candidateCount: fall through to fan-out
+            print(f"candidateCount rejected by {settings.GEMINI_IMAGE_MODEL}, fanning out instead")
+        except Exception as e:
+            error = str(_service_error(e))
+            for index in range(count):
+                yield {"index": index, "error": error}
+            return
+        else:
+            try:
+                candidates = _checked_candidates(result)
+            except Exception as e:
+                candidates = []
+                print(f"Batch generation returned no candidates: {e}")
+            for index in range(count):
+                if index >= len(candidates):
+                    yield {"index": index, "error": f"生成失败: 仅返回 {len(candidates)} 个结果"}
+                    continue
+                try:
+                    image_b64, mime_type = _extract_candidate_image(candidates[index], result)
+                except Exception as e:
+                    yield {"index": index, "error": str(e)}
+                    continue
+                yield {
+                    "index": index,
+                    "image_base64": image_b64,
+                    "mime_type": mime_type,
+                    "model_used": model_used,
+                    "api_key": api_key,
+                }
+            return
+
+    body = await _prepare_body(prompt, aspect_ratio, clean_resolution, images)
+
+    async def one(index: int) -> dict:
+        try:
+            result, model_used, api_key = await _post_generate_with_fallback(body, clean_resolution)
+            image_b64, mime_type = _extract_inline_image_part(result)
+        except Exception as e:
+            return {"index": index, "error": str(_service_error(e))}
+        return {
+            "index": index,
+            "image_base64": image_b64,
+            "mime_type": mime_type,
+            "model_used": model_used,
+            "api_key": api_key,
+        }
+
+    tasks = [asyncio.ensure_future(one(i)) for i in range(count)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Client went away mid-stream: don't keep burning quota
+        for task in tasks:
+            task.cancel()
@@ -1,60 +1,156 @@
 import httpx
 import base64
 import asyncio
+import hashlib
+import json
 from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Tuple
 from core.config import settings
 from core.http_client import http_client
+from core.cache import LRUCache, SQLiteCache, TieredCache
+from core.serialization import aloads
+from core.limiter import Overloaded, get_limiter
+from core.key_pool import key_suffix
+from core.metrics import span, upstream_span
+from services.image_preprocess import ImageSource, PreprocessReport, preprocess_raw, source_size
 
 # Create a thread pool for CPU-bound tasks
 executor = ThreadPoolExecutor(max_workers=4)
 
-async def analyze_image(image_bytes: bytes, mime_type: str = "image/png", prompt: str = "Describe this architectural image in detail, focusing on style, materials, and lighting.") -> tuple[str, str]:
-    # Use dynamic key rotation
-    api_key = settings.get_google_api_key()
-    if not api_key:
+# Content-addressed cache: same bytes + prompt + model -> same description
+analysis_cache = TieredCache(
+    "analysis",
+    memory=LRUCache(max_entries=settings.ANALYSIS_CACHE_MEMORY_ENTRIES, ttl=settings.ANALYSIS_CACHE_TTL),
+    disk=SQLiteCache(
+        settings.ANALYSIS_CACHE_DB,
+        max_bytes=settings.ANALYSIS_CACHE_MAX_BYTES,
+        ttl=settings.ANALYSIS_CACHE_TTL,
+        busy_timeout=settings.SQLITE_BUSY_TIMEOUT,
+    ),
+)
+
+# Hash small images inline, bigger ones on the executor
+_INLINE_HASH_LIMIT = 1024 * 1024
+
+# Files are hashed and base64-encoded this much at a time; a multiple of 3, so
+# encoded chunks concatenate into one valid base64 string
+_CHUNK_BYTES = 3 * 256 * 1024
+
+def _analysis_cache_key(image: ImageSource, prompt: str, model: str) -> str:
+    h = hashlib.sha256()
+    if isinstance(image, (bytes, bytearray)):
+        h.update(image)
+    else:
+        image.seek(0)
+        while chunk := image.read(_CHUNK_BYTES):
+            h.update(chunk)
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    h.update(b"\0")
+    h.update(model.encode("utf-8"))
+    return h.hexdigest()
+
+def _body_parts(prompt: str, mime_type: str) -> Tuple[bytes, bytes]:
+    """The request JSON before and after the base64 image data."""
+    head = json.dumps(
+        {"contents": [{"parts": [{"text": prompt}, {"inlineData": {"mimeType": mime_type, "data": ""}}]}]},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    # The empty "data" value is the last string in the document
+    split = head.rindex(b'""') + 1
+    return head[:split], head[split:]
+
+async def _stream_body(head: bytes, image: ImageSource, tail: bytes) -> AsyncIterator[bytes]:
+    """Encode `image` into the request body chunk by chunk; only one chunk is in memory."""
+    loop = asyncio.get_running_loop()
+    yield head
+    if isinstance(image, (bytes, bytearray)):
+        view = memoryview(image)
+        for start in range(0, len(view), _CHUNK_BYTES):
+            yield base64.b64encode(view[start:start + _CHUNK_BYTES])
+    else:
+        await loop.run_in_executor(executor, image.seek, 0)
+        while chunk := await loop.run_in_executor(executor, image.read, _CHUNK_BYTES):
+            yield await loop.run_in_executor(executor, base64.b64encode, chunk)
+    yield tail
+
+async def analyze_image(image: ImageSource, mime_type: str = "image/png", prompt: str = "Describe this architectural image in detail, focusing on style, materials, and lighting.", use_cache: bool = True, report: PreprocessReport = None) -> tuple[str, str]:
+    """Describe an image with Gemini Vision.
+
+    `image` is bytes or a seekable binary file, which is read in chunks and
+    never held in memory whole. Results are cached by (original image bytes,
+    prompt, model). On a cache hit no API key is used and the returned key is
+    None. Pass `use_cache=False` to force a fresh call. On a miss the image is
+    downscaled to VISION_MAX_EDGE before upload; pass a `PreprocessReport` to
+    collect the bytes saved.
+    """
+    model = settings.GEMINI_VISION_MODEL
+    loop = asyncio.get_running_loop()
+    cache_key = None
+    if use_cache and settings.ANALYSIS_CACHE_ENABLED:
+        if isinstance(image, (bytes, bytearray)) and len(image) <= _INLINE_HASH_LIMIT:
+            cache_key = _analysis_cache_key(image, prompt, model)
+        else:
+            cache_key = await loop.run_in_executor(executor, _analysis_cache_key, image, prompt, model)
+        cached = await analysis_cache.get(cache_key)
+        if cached is not None:
+            return cached, None
+
+    if not settings.GOOGLE_API_KEYS:
         raise ValueError("GOOGLE_API_KEY is not set")
 
     base_url = settings.GOOGLE_API_BASE_URL.rstrip('/')
-    model = settings.GEMINI_VISION_MODEL
     url = f"{base_url}/v1beta/models/{model}:generateContent"
 
-    headers = {
-        "x-goog-api-key": api_key,
-        "Content-Type": "application/json"
-    }
+    # Downscale/strip metadata on a miss only, so cache hits stay cheap.
+    # A file that passes through unchanged is streamed from disk as it is.
+    upload, mime_type = await preprocess_raw(image, mime_type, settings.VISION_MAX_EDGE, report)
+
+    # Base64 is produced while the body is sent, so no encoded copy is ever held whole
+    head, tail = _body_parts(prompt, mime_type)
+    upload_size = await loop.run_in_executor(executor, source_size, upload)
+    content_length = len(head) + 4 * ((upload_size + 2) // 3) + len(tail)
+
+    client = http_client.get_client("gemini")
+
+    async def call(api_key: str) -> dict:
+        headers = {
+            "x-goog-api-key": api_key,
+            "Content-Type": "application/json",
+            # Known up front, so the streamed body isn't sent chunked
+            "Content-Length": str(content_length),
+        }
+        with upstream_span("gemini", model=model, key=key_suffix(api_key)):
+            response = await client.post(
+                url, content=_stream_body(head, upload, tail), headers=headers, timeout=60.0
+            )
+            response.raise_for_status()
+        with span("decode", model=model):
+            return await aloads(response.content)
 
-    # Offload base64 encoding to a thread to avoid blocking the event loop
-    loop = asyncio.get_running_loop()
-    b64_image = await loop.run_in_executor(executor, lambda: base64.b64encode(image_bytes).decode('utf-8'))
-
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inlineData": {
-                            "mimeType": mime_type,
-                            "data": b64_image
-                        }
-                    }
-                ]
-            }
-        ]
-    }
-
-    client = http_client.get_client()
     try:
-        response = await client.post(url, json=data, headers=headers, timeout=60.0)
-        response.raise_for_status()
-        result = response.json()
-        
+        # Least-loaded healthy key; throttled or rejected keys are retried on another key
+        async with get_limiter("upstream:gemini").slot():
+            result, api_key = await settings.key_pool.call(call)
+
         try:
-            return result['candidates'][0]['content']['parts'][0]['text'], api_key
+            description = result['candidates'][0]['content']['parts'][0]['text']
         except (KeyError, IndexError):
                 raise Exception(f"Unexpected response structure: {str(result)[:200]}")
 
+        # Cache on both paths: a bypass still refreshes the stored description
+        if cache_key is None and settings.ANALYSIS_CACHE_ENABLED:
+            cache_key = await loop.run_in_executor(executor, _analysis_cache_key, image, prompt, model)
+        if cache_key is not None:
+            await analysis_cache.set(cache_key, description)
+        return description, api_key
+
+    except Overloaded:
+        raise
     except httpx.HTTPStatusError as e:
-        raise Exception(f"Gemini API Error ({base_url}): {e.response.text}")
+        raise Exception(f"Gemini API Error ({base_url}): HTTP {e.response.status_code}: {e.response.text}")
+    except (httpx.TransportError, asyncio.TimeoutError) as e:
+        raise Exception(f"Gemini Vision Service Error ({base_url}): {type(e).__name__}: {e}")
     except Exception as e:
         raise Exception(f"Gemini Vision Service Error ({base_url}): {str(e)}")
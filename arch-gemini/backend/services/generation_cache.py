@@ -0,0 +1,129 @@
+import asyncio
+import base64
+import hashlib
+import os
+from typing import Any, List, Optional, Set, Tuple
+
+from core.blobs import BlobStore
+from core.config import settings
+from core.dedup import fingerprint
+from prompts import NEGATIVE_PROMPT_SUFFIX
+
+# Bump when the request body changes in a way that changes outputs for the same inputs
+_BODY_VERSION = 1
+# Editing the negative prompt changes every output, so it is part of the key
+NEGATIVE_PROMPT_VERSION = hashlib.sha256(NEGATIVE_PROMPT_SUFFIX.encode("utf-8")).hexdigest()[:12]
+
+# X-Cache response header values
+HIT = "HIT"
+MISS = "MISS"
+BYPASS = "BYPASS"
+DISABLED = "DISABLED"
+
+
+class GenerationCache:
+    """Generated images by request fingerprint, persisted across restarts.
+
+    The key covers everything that shapes the output: prompt, primary model,
+    negative-prompt version, aspect ratio, resolution, the describe-references
+    flag and the reference images (content hashes). Images live in a
+    `BlobStore` under HISTORY_IMAGES_DIR/cache/ with LRU eviction to the disk
+    quota. Writes happen in the background so a miss isn't slowed down.
+    """
+
+    def __init__(self, store: BlobStore, enabled: bool):
+        self.store = store
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.errors = 0
+        self._pending: Set[asyncio.Task] = set()
+
+    async def key(
+        self, prompt: str, aspect_ratio: str, resolution: str, images: List[Any], describe_references: bool
+    ) -> str:
+        references, blobs = [], []
+        for img in images:
+            if isinstance(img, dict) and img.get("handle"):
+                # Stored uploads are already named by their content hash
+                references.append(["handle", img["handle"]])
+                continue
+            data = img.get("data") if isinstance(img, dict) else img
+            references.append(["inline", len(blobs)])
+            blobs.append(data or "")
+        fields = {
+            "version": _BODY_VERSION,
+            "prompt": prompt,
+            "model": settings.GEMINI_IMAGE_MODEL,
+            "negative_prompt": NEGATIVE_PROMPT_VERSION,
+            "aspect_ratio": aspect_ratio,
+            "resolution": (resolution or "1K").upper(),
+            "describe_references": describe_references,
+            "references": references,
+        }
+        return await fingerprint(fields, tuple(blobs))
+
+    async def get(self, key: str) -> Optional[Tuple[str, str, str]]:
+        """`(image_base64, mime_type, model_used)` for `key`, or None."""
+        try:
+            found = await self.store.aget_keyed(key)
+        except Exception as e:
+            self.errors += 1
+            print(f"Generation cache read failed: {e}")
+            return None
+        if found is None:
+            self.misses += 1
+            return None
+        data, mime_type, meta = found
+        image_base64 = await asyncio.to_thread(lambda: base64.b64encode(data).decode("ascii"))
+        self.hits += 1
+        return image_base64, mime_type, meta.get("model_used") or settings.GEMINI_IMAGE_MODEL
+
+    def put(self, key: str, image_base64: str, mime_type: str, model_used: str):
+        """Store a fresh result in the background."""
+        task = asyncio.ensure_future(self._put(key, image_base64, mime_type, model_used))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _put(self, key: str, image_base64: str, mime_type: str, model_used: str):
+        try:
+            data = await asyncio.to_thread(base64.b64decode, image_base64)
+            await self.store.aput_keyed(key, data, mime_type, {"model_used": model_used})
+        except Exception as e:
+            self.errors += 1
+            print(f"Generation cache write failed: {e}")
+
+    def status(self, api_key_used: Optional[str], force_fresh: bool) -> str:
+        """X-Cache header value for a generation; `generate_image` returns no key on a hit."""
+        if api_key_used is None:
+            return HIT
+        if not self.enabled:
+            return DISABLED
+        return BYPASS if force_fresh else MISS
+
+    async def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        info = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "pending_writes": len(self._pending),
+            "negative_prompt_version": NEGATIVE_PROMPT_VERSION,
+        }
+        if self.enabled:
+            info["store"] = await self.store.astats()
+        return info
+
+
+generation_cache = GenerationCache(
+    BlobStore(
+        os.path.join(settings.HISTORY_IMAGES_DIR, "cache"),
+        max_bytes=settings.GENERATION_CACHE_MAX_BYTES,
+        busy_timeout=settings.SQLITE_BUSY_TIMEOUT,
+    ),
+    enabled=settings.GENERATION_CACHE_ENABLED,
+)
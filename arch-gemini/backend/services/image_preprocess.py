@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+from core.config import settings
+from core.metrics import span
+
+# Longest edge sent upstream per target resolution; larger inputs add upload time, not quality
+MAX_EDGE_BY_RESOLUTION = {
+    "1K": 1536,
+    "2K": 2048,
+    "4K": 3072,
+}
+
+# Formats Gemini accepts that we can pass through untouched when already small
+_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Raw bytes, or a seekable binary file (e.g. a spooled upload) read in place
+ImageSource = Union[bytes, BinaryIO]
+
+# Pillow releases the GIL while decoding/resizing/encoding, so threads are enough
+executor = ThreadPoolExecutor(max_workers=settings.PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+
+
+class PreprocessReport:
+    """Per-request totals for bytes saved and time spent preprocessing inputs."""
+
+    def __init__(self):
+        self.images = 0
+        self.resized = 0
+        self.original_bytes = 0
+        self.output_bytes = 0
+        self.elapsed_ms = 0.0
+
+    def add(self, original: int, output: int, elapsed_ms: float, resized: bool):
+        self.images += 1
+        self.resized += 1 if resized else 0
+        self.original_bytes += original
+        self.output_bytes += output
+        self.elapsed_ms += elapsed_ms
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.output_bytes
+
+    def headers(self) -> Dict[str, str]:
+        if not self.images:
+            return {}
+        return {
+            "X-Preprocess-Images": str(self.images),
+            "X-Preprocess-Saved-Bytes": str(self.saved_bytes),
+            "X-Preprocess-Ms": f"{self.elapsed_ms:.1f}",
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.images} image(s), {self.resized} re-encoded, "
+            f"{self.original_bytes} -> {self.output_bytes} bytes "
+            f"(saved {self.saved_bytes}), {self.elapsed_ms:.1f} ms"
+        )
+
+
+def max_edge_for(resolution: Optional[str]) -> int:
+    return MAX_EDGE_BY_RESOLUTION.get((resolution or "1K").upper(), MAX_EDGE_BY_RESOLUTION["1K"])
+
+
+def source_size(source: ImageSource) -> int:
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    source.seek(0, io.SEEK_END)
+    return source.tell()
+
+
+def preprocess_bytes(data: ImageSource, mime_type: str, max_edge: int) -> Tuple[ImageSource, str, bool]:
+    """Downscale to `max_edge`, apply EXIF orientation, strip metadata and re-encode.
+
+    Returns `(data, mime_type, changed)`. Small inputs that already fit, and
+    anything Pillow cannot read, are returned unchanged (a file stays a file).
+    Blocking.
+    """
+    from PIL import Image, ImageOps
+
+    size = source_size(data)
+    try:
+        if isinstance(data, (bytes, bytearray)):
+            img = Image.open(io.BytesIO(data))
+        else:
+            data.seek(0)
+            img = Image.open(data)
+    except Exception:
+        return data, mime_type, False
+
+    with img:
+        fits = max(img.size) <= max_edge
+        if fits and size <= settings.PREPROCESS_SKIP_BYTES and img.format in _PASSTHROUGH_FORMATS:
+            return data, _PASSTHROUGH_FORMATS[img.format], False
+
+        # Shrink before transposing: the box is square, and JPEGs then decode at reduced scale
+        if not fits:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        img = ImageOps.exif_transpose(img)
+
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        out = io.BytesIO()
+        if has_alpha:
+            # Transparent sketches/screenshots: WebP keeps alpha at a fraction of PNG size
+            img.convert("RGBA").save(out, "WEBP", quality=settings.PREPROCESS_QUALITY, method=4)
+            out_mime = "image/webp"
+        else:
+            img.convert("RGB").save(out, "JPEG", quality=settings.PREPROCESS_QUALITY, optimize=True)
+            out_mime = "image/jpeg"
+
+    encoded = out.getvalue()
+    if fits and len(encoded) >= size:
+        # Re-encoding did not help and nothing needed resizing
+        return data, mime_type, False
+    return encoded, out_mime, True
+
+
+def _preprocess_to_base64(image: Dict[str, Any], max_edge: int, enabled: bool) -> Tuple[Dict[str, str], int, int, float, bool]:
+    start = time.perf_counter()
+    mime_type = image.get("mime_type") or "image/jpeg"
+    raw = image.get("bytes")
+    if raw is None:
+        raw = base64.b64decode(image.get("data") or "")
+    original = len(raw)
+
+    changed = False
+    if enabled and raw:
+        raw, mime_type, changed = preprocess_bytes(raw, mime_type, max_edge)
+
+    if changed or image.get("data") is None:
+        data = base64.b64encode(raw).decode("ascii")
+    else:
+        data = image["data"]
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return {"data": data, "mime_type": mime_type}, original, len(raw), elapsed_ms, changed
+
+
+async def preprocess_images(
+    images: List[Dict[str, Any]],
+    resolution: Optional[str],
+    report: Optional[PreprocessReport] = None,
+) -> List[Dict[str, str]]:
+    """Prepare reference images for a Gemini request.
+
+    Each input is `{"data": <base64>}` or `{"bytes": <raw>}` plus `mime_type`;
+    the output is always `{"data": <base64>, "mime_type": ...}` ready for
+    `generate_image`. Images are processed concurrently on the executor.
+    """
+    if not images:
+        return []
+    loop = asyncio.get_running_loop()
+    max_edge = max_edge_for(resolution)
+    enabled = settings.PREPROCESS_ENABLED
+    with span("preprocess", resolution=(resolution or "1K").upper()):
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, _preprocess_to_base64, image, max_edge, enabled)
+            for image in images
+        ])
+    processed = []
+    for image, original, output, elapsed_ms, changed in results:
+        if report is not None:
+            report.add(original, output, elapsed_ms, changed)
+        processed.append(image)
+    return processed
+
+
+async def preprocess_raw(
+    data: ImageSource,
+    mime_type: str,
+    max_edge: int,
+    report: Optional[PreprocessReport] = None,
+) -> Tuple[ImageSource, str]:
+    """Preprocess one raw upload (e.g. for vision analysis) on the executor."""
+    if not settings.PREPROCESS_ENABLED or not data:
+        return data, mime_type
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    with span("preprocess"):
+        out, out_mime, changed = await loop.run_in_executor(executor, preprocess_bytes, data, mime_type, max_edge)
+    if report is not None:
+        original = await loop.run_in_executor(executor, source_size, data)
+        output = len(out) if changed else original
+        report.add(original, output, (time.perf_counter() - start) * 1000, changed)
+    return out, out_mime
@@ -1,78 +1,108 @@
+import hashlib
+import re
 import httpx
 from core.config import settings
 from core.http_client import http_client
+from core.cache import LRUCache
+from core.singleflight import SingleFlight
+from core.serialization import dumps, loads
+from core.limiter import Overloaded, get_limiter
+from core.metrics import span, upstream_span
 from prompts import ARCH_RENDER_SYSTEM_PROMPT
-from error_prompts import ERROR_TRANSLATION_SYSTEM_PROMPT
+from error_prompts import ERROR_TRANSLATION_SYSTEM_PROMPT, KNOWN_ERROR_MESSAGES
 
-async def optimize_prompt(text: str) -> str:
-    if not settings.QWEN_API_KEY:
-        raise ValueError("QWEN_API_KEY is not set")
+# Completed results, and coalescing of identical concurrent requests
+_result_cache = LRUCache(max_entries=settings.QWEN_CACHE_ENTRIES, ttl=settings.QWEN_CACHE_TTL)
+_flights = SingleFlight()
+
+_KNOWN_ERRORS = [(re.compile(pattern), message) for pattern, message in KNOWN_ERROR_MESSAGES]
 
+def _cache_key(kind: str, text: str) -> str:
+    return hashlib.sha256(f"{kind}\0{settings.QWEN_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+def match_known_error(error_msg: str):
+    """Map well-known upstream failures straight to a user message, or None."""
+    for pattern, message in _KNOWN_ERRORS:
+        if pattern.search(error_msg):
+            return message
+    return None
+
+async def _chat_completion(system_prompt: str, user_content: str, timeout: float) -> str:
     headers = {
         "Authorization": f"Bearer {settings.QWEN_API_KEY}",
         "Content-Type": "application/json"
     }
-    
+
     data = {
         "model": settings.QWEN_MODEL,
         "messages": [
-            {"role": "system", "content": ARCH_RENDER_SYSTEM_PROMPT},
-            {"role": "user", "content": text}
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
         ]
     }
 
     # Handle trailing slash in base URL
     base_url = settings.QWEN_API_BASE_URL.rstrip('/')
-    
-    client = http_client.get_client()
+
+    client = http_client.get_client("qwen")
+    async with get_limiter("upstream:qwen").slot():
+        with upstream_span("qwen", model=settings.QWEN_MODEL):
+            response = await client.post(
+                f"{base_url}/chat/completions",
+                content=dumps(data),
+                headers=headers,
+                timeout=timeout
+            )
+            response.raise_for_status()
+    with span("decode", model=settings.QWEN_MODEL):
+        result = loads(response.content)
+    return result['choices'][0]['message']['content'].strip()
+
+async def _cached_completion(kind: str, system_prompt: str, user_content: str, timeout: float) -> str:
+    key = _cache_key(kind, user_content)
+    cached = _result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def call():
+        result = await _chat_completion(system_prompt, user_content, timeout)
+        _result_cache.set(key, result)
+        return result
+
+    return await _flights.do(key, call)
+
+async def optimize_prompt(text: str) -> str:
+    if not settings.QWEN_API_KEY:
+        raise ValueError("QWEN_API_KEY is not set")
+
     try:
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            json=data,
-            headers=headers,
-            timeout=30.0
-        )
-        response.raise_for_status()
-        result = response.json()
-        return result['choices'][0]['message']['content'].strip()
+        return await _cached_completion("optimize", ARCH_RENDER_SYSTEM_PROMPT, text, timeout=30.0)
+    except Overloaded:
+        raise
     except httpx.HTTPStatusError as e:
-        raise Exception(f"Qwen API Error: {e.response.text}")
+        raise Exception(f"Qwen API Error: HTTP {e.response.status_code}: {e.response.text}")
+    except httpx.TransportError as e:
+        raise Exception(f"Qwen Service Error: {type(e).__name__}: {e}")
     except Exception as e:
         raise Exception(f"Qwen Service Error: {str(e)}")
 
 async def translate_error(error_msg: str) -> str:
     """Use Qwen to translate technical error messages into user-friendly Chinese."""
+    known = match_known_error(error_msg)
+    if known:
+        return known
+
     if not settings.QWEN_API_KEY:
         return "发生未知错误（且Qwen API未配置）。"
 
-    headers = {
-        "Authorization": f"Bearer {settings.QWEN_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "model": settings.QWEN_MODEL,
-        "messages": [
-            {"role": "system", "content": ERROR_TRANSLATION_SYSTEM_PROMPT},
-            {"role": "user", "content": f"Error Message: {error_msg}"}
-        ]
-    }
-
-    base_url = settings.QWEN_API_BASE_URL.rstrip('/')
-    
     try:
-        client = http_client.get_client()
         # Use a short timeout for error translation to avoid long waits
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            json=data,
-            headers=headers,
-            timeout=5.0
+        return await _cached_completion(
+            "translate_error", ERROR_TRANSLATION_SYSTEM_PROMPT, f"Error Message: {error_msg}", timeout=5.0
         )
-        response.raise_for_status()
-        result = response.json()
-        return result['choices'][0]['message']['content'].strip()
     except Exception:
         # Fallback if translation fails
         return "系统繁忙，请稍后重试。"
 
+def cache_stats() -> dict:
+    return {"entries": len(_result_cache), **_flights.stats()}
@@ -0,0 +1,216 @@
+import asyncio
+
+import pytest
+
+from core import dedup
+from core.dedup import (
+    JOINED, MISS, REPLAYED, IdempotencyConflict, ReplayStore, RequestDeduplicator, SharedCodec, fingerprint,
+)
+from core.shared_state import SQLiteState
+
+
+def _dedup(replay_window: float = 0, max_bytes: int = 1024 * 1024) -> RequestDeduplicator:
+    return RequestDeduplicator("test", replay_window=replay_window, idempotency_ttl=60, max_bytes=max_bytes)
+
+
+def _counting(value="image"):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return value
+
+    return fn, calls
+
+
+def test_fingerprint_ignores_field_order_but_not_blob_boundaries():
+    async def main():
+        a = await fingerprint({"prompt": "villa", "resolution": "4K"}, ("ab", "c"))
+        b = await fingerprint({"resolution": "4K", "prompt": "villa"}, ("ab", "c"))
+        c = await fingerprint({"resolution": "4K", "prompt": "villa"}, ("a", "bc"))
+        return a, b, c
+
+    a, b, c = asyncio.run(main())
+    assert a == b != c
+
+
+def test_concurrent_duplicates_join_one_call():
+    deduplicator = _dedup()
+    fn, calls = _counting()
+
+    async def main():
+        return await asyncio.gather(*(deduplicator.run("alice", "fp", fn) for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(outcome for _, outcome in results) == [JOINED, JOINED, MISS]
+    assert all(value == "image" for value, _ in results)
+
+
+def test_other_clients_and_bodies_are_not_joined():
+    deduplicator = _dedup()
+    fn, calls = _counting()
+
+    async def main():
+        await asyncio.gather(
+            deduplicator.run("alice", "fp", fn),
+            deduplicator.run("bob", "fp", fn),
+            deduplicator.run("alice", "fp2", fn),
+        )
+
+    asyncio.run(main())
+    assert len(calls) == 3
+
+
+def test_finished_requests_are_not_replayed_by_default():
+    deduplicator = _dedup(replay_window=0)
+    fn, calls = _counting()
+
+    async def main():
+        first = await deduplicator.run("alice", "fp", fn)
+        second = await deduplicator.run("alice", "fp", fn)
+        return first, second
+
+    assert [outcome for _, outcome in asyncio.run(main())] == [MISS, MISS]
+    assert len(calls) == 2
+
+
+def test_replay_window_and_idempotency_key_replay():
+    deduplicator = _dedup(replay_window=30)
+    fn, calls = _counting()
+
+    async def main():
+        outcomes = [
+            (await deduplicator.run("alice", "fp", fn))[1],
+            (await deduplicator.run("alice", "fp", fn))[1],
+            (await deduplicator.run("alice", "fp2", fn, idempotency_key="k1"))[1],
+            (await deduplicator.run("alice", "fp2", fn, idempotency_key="k1"))[1],
+        ]
+        # The key is scoped per client
+        outcomes.append((await deduplicator.run("bob", "fp2", fn, idempotency_key="k1"))[1])
+        return outcomes
+
+    assert asyncio.run(main()) == [MISS, REPLAYED, MISS, REPLAYED, MISS]
+    assert len(calls) == 3
+
+
+def test_reused_key_with_another_body_conflicts():
+    deduplicator = _dedup()
+    fn, calls = _counting()
+
+    async def main():
+        await deduplicator.run("alice", "fp", fn, idempotency_key="k1")
+        with pytest.raises(IdempotencyConflict):
+            await deduplicator.run("alice", "other-fp", fn, idempotency_key="k1")
+
+        # Also while the first request is still in flight
+        first = asyncio.ensure_future(deduplicator.run("alice", "fp", fn, idempotency_key="k2"))
+        await asyncio.sleep(0)
+        with pytest.raises(IdempotencyConflict):
+            await deduplicator.run("alice", "other-fp", fn, idempotency_key="k2")
+        await first
+
+    asyncio.run(main())
+    assert len(calls) == 2
+    assert deduplicator.conflicts == 2
+
+
+def test_failures_are_not_replayed():
+    deduplicator = _dedup(replay_window=30)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("upstream failed")
+        return "image"
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await deduplicator.run("alice", "fp", flaky, idempotency_key="k1")
+        return await deduplicator.run("alice", "fp", flaky, idempotency_key="k1")
+
+    assert asyncio.run(main()) == ("image", MISS)
+
+
+def test_replay_store_is_bounded_by_size():
+    store = ReplayStore(max_bytes=10)
+    store.put("a", "fp", "x" * 6, ttl=30)
+    store.put("b", "fp", "y" * 6, ttl=30)
+    assert store.get("a") is None
+    assert store.get("b") == ("fp", "y" * 6)
+    # Bigger than the whole store: not kept at all
+    store.put("c", "fp", "z" * 11, ttl=30)
+    assert store.get("c") is None
+    assert store.bytes == 6
+
+
+class _HandleCodec(SharedCodec):
+    """Keeps the payload in a dict and shares only its handle, like the BlobStore codec."""
+
+    def __init__(self):
+        self.blobs = {}
+
+    async def pack(self, value):
+        self.blobs[len(self.blobs)] = value
+        return {"handle": len(self.blobs) - 1}
+
+    async def unpack(self, doc):
+        return self.blobs.get(doc["handle"])
+
+
+@pytest.fixture
+def distributed_state(tmp_path, monkeypatch):
+    state = SQLiteState(str(tmp_path / "shared_state.db"))
+    monkeypatch.setattr(dedup, "shared_state", state)
+    yield state
+    asyncio.run(state.close())
+
+
+def test_shared_results_are_replayed_by_other_workers(distributed_state):
+    worker_a, worker_b = _dedup(), _dedup()
+    codec = _HandleCodec()
+    fn, calls = _counting("x" * 100_000)
+
+    async def main():
+        first = await worker_a.run("alice", "fp", fn, "k1", share_results=True, codec=codec)
+        second = await worker_b.run("alice", "fp", fn, "k1", share_results=True, codec=codec)
+        doc = await distributed_state.get_json("idempotency:test:alice:key:k1")
+        with pytest.raises(IdempotencyConflict):
+            await worker_b.run("alice", "other-fp", fn, "k1", share_results=True, codec=codec)
+        return first, second, doc
+
+    first, second, doc = asyncio.run(main())
+    assert (first[1], second[1]) == (MISS, REPLAYED)
+    assert second[0] == first[0]
+    assert len(calls) == 1
+    # Only the handle went into the shared state
+    assert doc == {"fingerprint": "fp", "value": {"handle": 0}}
+
+
+def test_large_results_are_not_shared(distributed_state):
+    worker_a, worker_b = _dedup(), _dedup()
+    fn, calls = _counting("x" * 100_000)
+
+    async def main():
+        await worker_a.run("alice", "fp", fn, "k1", share_results=True)
+        await worker_b.run("alice", "fp", fn, "k1", share_results=True)
+        return await distributed_state.get_json("idempotency:test:alice:key:k1")
+
+    assert asyncio.run(main()) is None
+    assert len(calls) == 2
+
+
+def test_missing_shared_payload_is_generated_again(distributed_state):
+    worker_a, worker_b = _dedup(), _dedup()
+    codec = _HandleCodec()
+    fn, calls = _counting()
+
+    async def main():
+        await worker_a.run("alice", "fp", fn, "k1", share_results=True, codec=codec)
+        codec.blobs.clear()  # evicted from the blob store
+        return await worker_b.run("alice", "fp", fn, "k1", share_results=True, codec=codec)
+
+    assert asyncio.run(main()) == ("image", MISS)
+    assert len(calls) == 2
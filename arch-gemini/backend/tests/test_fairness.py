@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from core import fairness
+from core.fairness import ClientRegistry, RateLimited, parse_rate_limits, resolution_cost
+from core.limiter import AdaptiveLimiter
+from core.shared_state import MemoryState
+
+
+def _registry(**kwargs) -> ClientRegistry:
+    kwargs.setdefault("token_header", "X-Client-Token")
+    kwargs.setdefault("tokens", {"secret-a": "studio-a"})
+    kwargs.setdefault("trusted_proxies", ["10.0.0.1"])
+    kwargs.setdefault("weights", {})
+    kwargs.setdefault("rate_limits", {})
+    return ClientRegistry(**kwargs)
+
+
+def _request(peer: str, headers: dict = None):
+    return SimpleNamespace(client=SimpleNamespace(host=peer), headers=headers or {})
+
+
+@pytest.fixture
+def state(monkeypatch):
+    state = MemoryState()
+    monkeypatch.setattr(fairness, "shared_state", state)
+    return state
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("generate:30/8, analyze:60,bad:x") == {
+        "generate": (0.5, 8.0),
+        "analyze": (1.0, 60.0),
+    }
+    assert resolution_cost("4k") == 4.0
+    assert resolution_cost(None) == 1.0
+
+
+def test_identify_by_known_token_or_ip():
+    registry = _registry()
+    assert registry.identify(_request("1.2.3.4", {"X-Client-Token": "secret-a"})) == "studio-a"
+    # An unknown token doesn't get a fresh identity (and a fresh bucket)
+    assert registry.identify(_request("1.2.3.4", {"X-Client-Token": "made-up"})) == "1.2.3.4"
+    # Forwarded addresses are only trusted from the proxy
+    assert registry.identify(_request("10.0.0.1", {"x-forwarded-for": "5.6.7.8, 10.0.0.1"})) == "5.6.7.8"
+    assert registry.identify(_request("1.2.3.4", {"x-forwarded-for": "5.6.7.8"})) == "1.2.3.4"
+
+
+def test_bucket_is_charged_by_cost_and_refunded(state):
+    registry = _registry(rate_limits={"generate": (0.0001, 8.0)})
+
+    async def main():
+        await registry.charge("generate", "alice", 4)
+        await registry.charge("generate", "alice", 4)
+        with pytest.raises(RateLimited) as info:
+            await registry.charge("generate", "alice", 1)
+        assert info.value.retry_after > 0
+        # Other clients have their own bucket
+        await registry.charge("generate", "bob", 4)
+        await registry.refund("generate", "alice", 4)
+        await registry.charge("generate", "alice", 4)
+
+    asyncio.run(main())
+    assert registry.rate_limited == {"alice": 1}
+
+
+def test_weight_scales_the_allowance(state):
+    registry = _registry(weights={"studio-a": 2.0}, rate_limits={"generate": (0.0001, 4.0)})
+
+    async def main():
+        for _ in range(2):
+            await registry.charge("generate", "studio-a", 4)
+        with pytest.raises(RateLimited):
+            await registry.charge("generate", "studio-a", 4)
+
+    asyncio.run(main())
+
+
+def test_routes_without_a_limit_are_not_charged(state):
+    registry = _registry(rate_limits={"generate": (0.0001, 1.0)})
+
+    async def main():
+        for _ in range(10):
+            await registry.charge("optimize", "alice")
+
+    asyncio.run(main())
+    assert registry.rate_limited == {}
+
+
+def test_limiter_queue_is_weighted_fair_across_clients():
+    limiter = AdaptiveLimiter("test", initial=1, max_queue=10)
+    order = []
+
+    async def request(client: str, cost: float):
+        await limiter.acquire(client, cost)
+        order.append(client)
+        limiter.release()
+
+    async def main():
+        await limiter.acquire()
+        # One client queues three 4K jobs before another client's single 1K job
+        waiters = [asyncio.ensure_future(request("heavy", 4)) for _ in range(3)]
+        waiters.append(asyncio.ensure_future(request("light", 1)))
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*waiters)
+
+    asyncio.run(main())
+    assert order.index("light") == 0
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from core.jobs import FAILED, SUCCEEDED, JobManager, JobQueueFull
+from core.shared_state import SQLiteState
+
+
+async def _wait_done(job, timeout: float = 2.0):
+    async def drain():
+        async for _ in job.stream_events(keepalive=0.05):
+            pass
+
+    await asyncio.wait_for(drain(), timeout)
+
+
+def test_finished_jobs_are_reaped_after_the_ttl():
+    manager = JobManager(workers=2, result_ttl=0.05)
+
+    async def main():
+        await manager.start()
+        release = asyncio.Event()
+
+        async def slow(job):
+            await release.wait()
+            return "late"
+
+        async def fast(job):
+            return {"image": "done"}
+
+        running = manager.submit("generate", slow)
+        finished = manager.submit("generate", fast)
+        await _wait_done(finished)
+        assert finished.to_dict()["result"] == {"image": "done"}
+
+        await asyncio.sleep(0.1)
+        manager.expire()
+        # Only finished jobs expire; one still running is kept however old it is
+        assert manager.get(finished.id) is None
+        assert manager.get(running.id) is running
+
+        release.set()
+        await _wait_done(running)
+        assert manager.get(running.id).status == SUCCEEDED
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_reaper_runs_in_the_background():
+    manager = JobManager(workers=1, result_ttl=0.05)
+
+    async def main():
+        await manager.start()
+
+        async def boom(job):
+            raise RuntimeError("upstream failed")
+
+        job = manager.submit("generate", boom)
+        await _wait_done(job)
+        assert job.status == FAILED and job.error == "upstream failed"
+        # The reaper wakes every result_ttl / 2, but no more often than once a second
+        for _ in range(30):
+            if manager.get(job.id) is None:
+                break
+            await asyncio.sleep(0.05)
+        assert manager.get(job.id) is None
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_full_queue_is_refused():
+    manager = JobManager(workers=1, queue_size=1)
+
+    async def main():
+        await manager.start()
+        release = asyncio.Event()
+
+        async def wait(job):
+            await release.wait()
+
+        first = manager.submit("generate", wait)
+        await asyncio.sleep(0.01)  # picked up by the worker
+        manager.submit("generate", wait)
+        with pytest.raises(JobQueueFull):
+            manager.submit("generate", wait)
+        release.set()
+        await _wait_done(first)
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_snapshots_are_visible_to_other_workers(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    owner = JobManager(workers=1, result_ttl=30, store=SQLiteState(path))
+    other = JobManager(workers=1, result_ttl=30, store=SQLiteState(path))
+
+    async def main():
+        await owner.start()
+
+        async def fn(job):
+            return {"image_url": "/api/history/x/image"}
+
+        job = owner.submit("generate", fn)
+        await _wait_done(job)
+        assert other.get(job.id) is None
+        # The final snapshot is saved just after the last event
+        for _ in range(40):
+            snapshot = await other.lookup(job.id)
+            if snapshot["status"] == SUCCEEDED:
+                break
+            await asyncio.sleep(0.01)
+        assert snapshot["status"] == SUCCEEDED
+        assert snapshot["result"] == {"image_url": "/api/history/x/image"}
+        assert await other.lookup("unknown") is None
+        await owner.stop()
+        await owner.store.close()
+        await other.store.close()
+
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+import asyncio
+
+import httpx
+import pytest
+
+from core.key_pool import KeyPool, NoHealthyKeyError, key_id
+
+
+def _status_error(status: int, headers: dict = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://example.test/v1beta/models/m:generateContent")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def _cooling(pool: KeyPool) -> dict:
+    return {s["key_suffix"]: s["cooldown_remaining"] for s in pool.stats() if s["cooldown_remaining"] > 0}
+
+
+def test_throttled_key_is_retried_on_another_and_cooled_down():
+    pool = KeyPool(["key-aaaa", "key-bbbb", "key-cccc"], throttle_cooldown=30)
+    calls = []
+
+    async def fn(key):
+        calls.append(key)
+        if len(calls) == 1:
+            raise _status_error(429, {"retry-after": "12"})
+        return "ok"
+
+    result, used = asyncio.run(pool.call(fn))
+    assert result == "ok"
+    assert used == calls[1] != calls[0]
+    cooling = _cooling(pool)
+    assert list(cooling) == [calls[0][-4:]]
+    # Retry-After wins over the default cooldown
+    assert 11 < cooling[calls[0][-4:]] <= 12
+    assert pool.healthy_count() == 2
+    assert all(s["in_flight"] == 0 for s in pool.stats())
+
+
+def test_rejected_key_gets_the_long_cooldown():
+    pool = KeyPool(["key-aaaa", "key-bbbb"], rejected_cooldown=300)
+    state = pool.acquire()
+    pool.release(state, status=403)
+    assert _cooling(pool)[state.key[-4:]] > 290
+    # The other key is handed out while this one cools down
+    assert pool.acquire().key != state.key
+
+
+def test_server_errors_are_not_retried():
+    pool = KeyPool(["key-aaaa", "key-bbbb"])
+    calls = []
+
+    async def fn(key):
+        calls.append(key)
+        raise _status_error(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(pool.call(fn))
+    assert len(calls) == 1
+    assert pool.healthy_count() == 2
+
+
+def test_every_key_throttled_raises_the_last_error():
+    pool = KeyPool(["key-aaaa", "key-bbbb"], throttle_cooldown=30)
+
+    async def fn(key):
+        raise _status_error(429)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(pool.call(fn))
+    assert pool.healthy_count() == 0
+
+    # Nothing left to try: fail fast with the time until the first key is back
+    with pytest.raises(NoHealthyKeyError) as info:
+        asyncio.run(pool.call(fn))
+    assert 29 < info.value.retry_after <= 30
+
+
+def test_least_loaded_key_first():
+    pool = KeyPool(["key-aaaa", "key-bbbb"])
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first.key != second.key
+    pool.release(first, latency=0.1)
+    assert pool.acquire().key == first.key
+
+
+def test_cancelled_call_does_not_count_against_the_key():
+    pool = KeyPool(["key-aaaa"])
+
+    async def fn(key):
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(pool.call(fn))
+    stats = pool.stats()[0]
+    assert (stats["in_flight"], stats["failures"], stats["successes"]) == (0, 0, 0)
+
+
+def test_cooldowns_are_exchanged_by_key_id():
+    here = KeyPool(["key-aaaa", "key-bbbb"])
+    there = KeyPool(["key-aaaa", "key-bbbb"])
+    state = here.acquire()
+    here.release(state, status=429, retry_after=20)
+
+    drained = here.drain_cooldowns()
+    assert [kid for kid, _ in drained] == [key_id(state.key)]
+    assert here.drain_cooldowns() == []
+
+    there.apply_cooldowns(dict(drained))
+    assert list(_cooling(there)) == [state.key[-4:]]
@@ -0,0 +1,82 @@
+import httpx
+import pytest
+
+from core.limiter import Overloaded
+from core.key_pool import NoHealthyKeyError
+from services.gemini_gen import _checked_candidates, _extract_candidate_image, _service_error
+from services.qwen_service import match_known_error
+
+BLOCKED = "生成内容涉及敏感信息，已被拦截，请修改提示词。"
+UNAVAILABLE = "服务暂时不可用，请稍后重试。"
+
+
+def _http_error(status: int, body: str) -> str:
+    request = httpx.Request("POST", "https://example.test/v1beta/models/m:generateContent")
+    response = httpx.Response(status, text=body, request=request)
+    error = httpx.HTTPStatusError("error", request=request, response=response)
+    return str(_service_error(error))
+
+
+def _google_error(status: int, name: str, message: str) -> str:
+    return (
+        '{\n  "error": {\n    "code": %d,\n    "message": "%s",\n    "status": "%s"\n  }\n}\n'
+        % (status, message, name)
+    )
+
+
+def _raised(fn, *args) -> str:
+    with pytest.raises(Exception) as info:
+        fn(*args)
+    return str(info.value)
+
+
+def test_no_image_with_safety_ratings_is_not_a_block():
+    result = {"candidates": [{"content": {"parts": []}, "finishReason": "STOP", "safetyRatings": []}]}
+    message = _raised(_extract_candidate_image, result["candidates"][0], result)
+    assert "safetyRatings" in message
+    assert match_known_error(message) is None
+
+
+def test_invalid_safety_settings_is_not_a_block():
+    message = _http_error(
+        400, _google_error(400, "INVALID_ARGUMENT", "Invalid value at 'safety_settings[0].category'")
+    )
+    assert match_known_error(message) is None
+
+
+def test_numbers_and_words_in_echoed_body_do_not_match():
+    result = {"candidates": [{"content": {"parts": [{"text": "INTERNAL courtyard, 500 m2, 403 rooms"}]}}]}
+    message = _raised(_extract_candidate_image, result["candidates"][0], result)
+    assert match_known_error(message) is None
+
+
+@pytest.mark.parametrize("finish_reason", ["SAFETY", "IMAGE_SAFETY"])
+def test_safety_finish_reason_is_a_block(finish_reason):
+    result = {"candidates": [{"content": {"parts": []}, "finishReason": finish_reason}]}
+    message = _raised(_extract_candidate_image, result["candidates"][0], result)
+    assert match_known_error(message) == BLOCKED
+
+
+def test_prompt_block():
+    message = _raised(_checked_candidates, {"promptFeedback": {"blockReason": "PROHIBITED_CONTENT"}})
+    assert match_known_error(message) == "提示词包含敏感内容，请修改后重试。"
+
+
+@pytest.mark.parametrize(
+    "message, expected",
+    [
+        (_http_error(429, _google_error(429, "RESOURCE_EXHAUSTED", "Quota exceeded")), "请求过于频繁，请稍后重试。"),
+        (_http_error(500, _google_error(500, "INTERNAL", "Internal error")), UNAVAILABLE),
+        (_http_error(502, "<html>Bad Gateway</html>"), UNAVAILABLE),
+        (_http_error(503, _google_error(503, "UNAVAILABLE", "The model is overloaded")), UNAVAILABLE),
+        (_http_error(403, _google_error(403, "PERMISSION_DENIED", "Forbidden")), "API 密钥无效或已过期，请检查配置。"),
+        (_http_error(504, ""), "请求超时，请稍后重试。"),
+        (str(_service_error(httpx.ReadTimeout(""))), "请求超时，请稍后重试。"),
+        (str(_service_error(httpx.ConnectError("boom"))), "服务器连接失败，请检查网络后重试。"),
+        (str(Overloaded("upstream:gemini", 3)), "服务器繁忙，请稍后重试。"),
+        (str(NoHealthyKeyError(5)), "请求过于频繁，请稍后重试。"),
+        ("GOOGLE_API_KEY is not set", "API 密钥未配置，请检查设置。"),
+    ],
+)
+def test_known_errors(message, expected):
+    assert match_known_error(message) == expected
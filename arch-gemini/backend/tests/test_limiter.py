@@ -0,0 +1,150 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from core.key_pool import NoHealthyKeyError
+from core.limiter import AdaptiveLimiter, Overloaded
+from core.routing import CLIENT, OTHER, SERVER, THROTTLED, classify_error, classify_error_chain
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://example.test/v1beta/models/m:generateContent")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+def _wrapped_429() -> HTTPException:
+    """What the generate endpoints raise for an upstream 429."""
+    try:
+        try:
+            try:
+                raise _status_error(429)
+            except Exception as e:
+                raise Exception("Gemini API Error: HTTP 429") from e
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="请求过于频繁，请稍后重试。") from e
+    except HTTPException as e:
+        return e
+
+
+async def _run_in_slot(limiter: AdaptiveLimiter, error: BaseException = None):
+    async with limiter.slot():
+        if error is not None:
+            raise error
+
+
+def test_successes_grow_the_limit_additively():
+    limiter = AdaptiveLimiter("test", initial=4, max_limit=5)
+
+    async def main():
+        for _ in range(4):
+            await _run_in_slot(limiter)
+
+    asyncio.run(main())
+    # +1/limit per success: four successes at limit ~4 add about one
+    assert 4.9 < limiter.limit <= 5
+    assert limiter.in_flight == 0
+    assert limiter.admitted == 4
+
+
+def test_throttled_outcomes_shrink_the_limit_once_per_interval():
+    limiter = AdaptiveLimiter("test", initial=10, backoff_ratio=0.5, decrease_interval=60)
+    # The interval is measured from the last decrease; pretend there was none
+    limiter._last_decrease = float("-inf")
+
+    async def main():
+        for error in (_status_error(429), NoHealthyKeyError(5)):
+            with pytest.raises(type(error)):
+                await _run_in_slot(limiter, error)
+
+    asyncio.run(main())
+    assert limiter.limit == 5
+    assert limiter.throttled == 2
+
+
+def test_wrapped_429_counts_as_throttled():
+    limiter = AdaptiveLimiter("route:generate", initial=8, backoff_ratio=0.5, decrease_interval=0)
+
+    async def main():
+        with pytest.raises(HTTPException):
+            await _run_in_slot(limiter, _wrapped_429())
+        with pytest.raises(HTTPException):
+            await _run_in_slot(limiter, HTTPException(status_code=500, detail="生成失败"))
+
+    asyncio.run(main())
+    assert limiter.throttled == 1
+    assert limiter.limit == 4
+
+
+def test_limit_stays_within_bounds():
+    limiter = AdaptiveLimiter("test", initial=2, min_limit=1, max_limit=3, backoff_ratio=0.1, decrease_interval=0)
+    for _ in range(5):
+        limiter.in_flight += 1
+        limiter.release(throttled=True)
+    assert limiter.limit == 1
+    for _ in range(50):
+        limiter.in_flight += 1
+        limiter.release(latency=0.1)
+    assert limiter.limit == 3
+
+
+def test_slow_successes_count_as_congestion():
+    limiter = AdaptiveLimiter("test", initial=10, latency_tolerance=3.0, decrease_interval=0)
+    for latency in (1.0, 1.0, 5.0):
+        limiter.in_flight += 1
+        limiter.release(latency=latency)
+    # Two on-baseline successes grow it a little, the 5x-baseline one takes 10% off
+    assert limiter.limit == pytest.approx((10 + 1 / 10 + 1 / 10.1) * 0.9, rel=1e-3)
+
+
+def test_full_queue_sheds_immediately():
+    limiter = AdaptiveLimiter("test", initial=1, max_queue=1, queue_timeout=5)
+
+    async def main():
+        await limiter.acquire()
+        queued = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as info:
+            await limiter.acquire()
+        assert info.value.name == "test"
+        assert info.value.retry_after >= 1
+        limiter.release(latency=0.1)
+        await queued
+        limiter.release(latency=0.1)
+
+    asyncio.run(main())
+    assert limiter.shed == 1
+    assert limiter.in_flight == 0
+
+
+def test_queue_timeout_sheds():
+    limiter = AdaptiveLimiter("test", initial=1, max_queue=10, queue_timeout=0.05)
+
+    async def main():
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        limiter.release()
+
+    asyncio.run(main())
+    assert limiter.shed == 1
+    assert limiter.in_flight == 0
+    assert limiter.stats()["queued"] == 0
+
+
+def test_classify_error_chain_sees_through_wrappers():
+    wrapped = _wrapped_429()
+    assert classify_error(wrapped) == OTHER
+    assert classify_error_chain(wrapped) == THROTTLED
+
+    try:
+        try:
+            raise _status_error(503)
+        except Exception:
+            raise RuntimeError("服务暂时不可用")
+    except RuntimeError as e:
+        assert classify_error_chain(e) == SERVER
+
+    assert classify_error_chain(_status_error(400)) == CLIENT
+    assert classify_error_chain(ValueError("bad")) == OTHER
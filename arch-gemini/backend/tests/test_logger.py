@@ -0,0 +1,39 @@
+import os
+
+from core import logger
+
+
+def _entry(i: int, image: bytes) -> dict:
+    return {
+        "id": str(i),
+        "timestamp": "2026-01-01T00:00:00",
+        "client_ip": "127.0.0.1",
+        "prompt": "p",
+        "model": "m",
+        "api_key_suffix": "1234",
+        "image_filename": f"{i}.png",
+        "request_type": "generation",
+        "image": image,
+    }
+
+
+def test_queue_is_bounded_by_image_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "DB_PATH", str(tmp_path / "history.db"))
+    monkeypatch.setattr(logger, "IMAGES_DIR", str(tmp_path / "images"))
+    monkeypatch.setattr(logger, "_db_ready", False)
+    image = b"\0" * (1024 * 1024)
+    writer = logger.RequestLogWriter(logger.DB_PATH, max_queue=100, max_bytes=2 * len(image))
+
+    # Not started: everything stays queued, so only two images fit the budget
+    monkeypatch.setattr(writer, "start", lambda: None)
+    assert all(writer.submit(_entry(i, image)) for i in range(4))
+    stats = writer.stats()
+    assert stats["queued_bytes"] == 2 * len(image)
+    assert stats["images_dropped"] == 2
+
+    logger.RequestLogWriter.start(writer)
+    assert writer.flush()
+    writer.close()
+    assert writer.stats()["queued_bytes"] == 0
+    assert writer.stats()["written"] == 4
+    assert sorted(os.listdir(tmp_path / "images")) == ["0.png", "1.png"]
@@ -0,0 +1,126 @@
+import asyncio
+
+import httpx
+import pytest
+
+from core.key_pool import NoHealthyKeyError
+from core.routing import LatencyHistogram, ModelRouter
+
+
+def _status_error(status: int, headers: dict = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://example.test/v1beta/models/m:generateContent")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def _router(**kwargs) -> ModelRouter:
+    kwargs.setdefault("backoff_base", 0.001)
+    kwargs.setdefault("backoff_max", 0.01)
+    return ModelRouter("primary", "fallback", **kwargs)
+
+
+def _failing(errors: dict):
+    """fn(model) that raises the next queued error for that model, then answers."""
+    calls = []
+
+    async def fn(model):
+        calls.append(model)
+        queued = errors.get(model)
+        if queued:
+            raise queued.pop(0)
+        return f"image from {model}"
+
+    return fn, calls
+
+
+def test_server_errors_are_retried_on_the_same_model():
+    router = _router(retry_policy={"server": 2})
+    fn, calls = _failing({"primary": [_status_error(503), _status_error(500)]})
+    assert asyncio.run(router.run(fn)) == ("image from primary", "primary")
+    assert calls == ["primary"] * 3
+    assert (router.retries, router.fallbacks) == (2, 0)
+
+
+def test_fallback_after_retries_run_out():
+    router = _router(retry_policy={"throttled": 1})
+    fn, calls = _failing({"primary": [_status_error(429), NoHealthyKeyError(5)]})
+    assert asyncio.run(router.run(fn)) == ("image from fallback", "fallback")
+    assert calls == ["primary", "primary", "fallback"]
+    assert (router.retries, router.fallbacks) == (1, 1)
+
+
+def test_not_found_goes_straight_to_the_fallback():
+    router = _router(retry_policy={"not_found": 3})
+    fn, calls = _failing({"primary": [_status_error(404)]})
+    assert asyncio.run(router.run(fn)) == ("image from fallback", "fallback")
+    assert calls == ["primary", "fallback"]
+    assert router.retries == 0
+
+
+def test_client_errors_are_raised():
+    router = _router(retry_policy={"server": 2, "throttled": 2})
+    fn, calls = _failing({"primary": [_status_error(400)]})
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(router.run(fn))
+    assert calls == ["primary"]
+
+
+def test_fallback_failure_is_raised():
+    router = _router(retry_policy={})
+    fn, calls = _failing({"primary": [_status_error(503)], "fallback": [_status_error(503)]})
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(router.run(fn))
+    assert calls == ["primary", "fallback"]
+
+
+def test_backoff_honours_retry_after_up_to_the_cap():
+    router = ModelRouter("primary", backoff_base=0.001, backoff_max=20)
+    assert router._backoff(0, _status_error(429, {"retry-after": "7"})) == 7
+    assert router._backoff(0, NoHealthyKeyError(60)) == 20
+    assert router._backoff(0, _status_error(503)) <= 0.001
+
+
+def test_hedges_are_capped_by_ratio():
+    router = _router(hedge_enabled=True, hedge_min_samples=10, hedge_max_ratio=0.5)
+    # Fine buckets so the p95 deadline is ~10 ms instead of the default 250 ms bucket
+    histogram = router.histograms["primary:1K"] = LatencyHistogram([0.01, 0.02])
+    for _ in range(100):
+        histogram.record(0.005)
+
+    cancelled = 0
+
+    async def one_request():
+        calls = 0
+
+        async def fn(model):
+            nonlocal calls, cancelled
+            calls += 1
+            if calls == 1:
+                try:
+                    await asyncio.sleep(0.05)
+                except asyncio.CancelledError:
+                    cancelled += 1
+                    raise
+                return "slow"
+            return "hedge"
+
+        return await router.run(fn, latency_key="1K")
+
+    async def main():
+        return [await one_request() for _ in range(10)]
+
+    results = asyncio.run(main())
+    assert router.requests == 10
+    assert router.hedges == 5
+    assert router.hedges <= router.hedge_max_ratio * router.requests
+    assert router.hedge_wins == cancelled == 5
+    assert sorted(result for result, _ in results) == ["hedge"] * 5 + ["slow"] * 5
+
+
+def test_no_hedging_before_enough_samples():
+    router = _router(hedge_enabled=True, hedge_min_samples=20, hedge_max_ratio=1.0)
+    fn, _ = _failing({})
+    asyncio.run(router.run(fn, latency_key="1K"))
+    assert router.hedge_deadline("primary:1K") is None
+    assert router.hedges == 0
+
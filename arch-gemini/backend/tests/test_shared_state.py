@@ -0,0 +1,138 @@
+import asyncio
+import math
+import time
+
+import pytest
+
+from core.shared_state import MemoryState, SharedState, SQLiteState, bucket_update
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_state(request, tmp_path):
+    """Factory for the backend under test; SQLite instances share one file, like workers do."""
+    states = []
+
+    def make():
+        if request.param == "memory":
+            state = states[0] if states else MemoryState()
+        else:
+            state = SQLiteState(str(tmp_path / "shared_state.db"))
+        states.append(state)
+        return state
+
+    yield make
+
+    async def close():
+        for state in states:
+            await state.close()
+
+    asyncio.run(close())
+
+
+def test_bucket_update_refills_and_takes():
+    # A new bucket starts full
+    assert bucket_update(None, 0, 0, rate=1, burst=5, cost=2) == (3, 0.0)
+    # Refill over 2 s, capped at the burst
+    assert bucket_update(1, 0, 2, rate=1, burst=5, cost=0) == (3, 0.0)
+    assert bucket_update(4, 0, 10, rate=1, burst=5, cost=1) == (4, 0.0)
+    # Not enough: nothing is taken and the wait is until there would be
+    assert bucket_update(1, 0, 0, rate=0.5, burst=5, cost=2) == (1, 2.0)
+    # A refund never overfills
+    assert bucket_update(4, 0, 0, rate=1, burst=5, cost=-3) == (5, 0.0)
+
+
+def test_bucket_update_edge_cases():
+    # A request bigger than the burst is allowed once the bucket is full
+    assert bucket_update(None, 0, 0, rate=1, burst=4, cost=10) == (0, 0.0)
+    # A zero-rate bucket never refills
+    tokens, wait = bucket_update(0, 0, 100, rate=0, burst=4, cost=1)
+    assert tokens == 0 and math.isinf(wait)
+    # Clock going backwards doesn't drain the bucket
+    assert bucket_update(2, 10, 5, rate=1, burst=5, cost=0) == (2, 0.0)
+
+
+def test_slots_are_limited_across_instances(make_state):
+    worker_a, worker_b = make_state(), make_state()
+
+    async def main():
+        assert await worker_a.acquire_slot("upstream", "a:1", limit=2, ttl=30)
+        assert await worker_b.acquire_slot("upstream", "b:1", limit=2, ttl=30)
+        assert not await worker_a.acquire_slot("upstream", "a:2", limit=2, ttl=30)
+        assert await worker_b.slot_count("upstream") == 2
+        # Other names are independent
+        assert await worker_a.acquire_slot("other", "a:2", limit=1, ttl=30)
+
+        await worker_b.release_slot("upstream", "b:1")
+        assert await worker_a.acquire_slot("upstream", "a:2", limit=2, ttl=30)
+        # Releasing an unknown holder is harmless
+        await worker_a.release_slot("upstream", "gone")
+        assert await worker_a.slot_count("upstream") == 2
+
+    asyncio.run(main())
+
+
+def test_expired_leases_free_their_slot(make_state):
+    state = make_state()
+
+    async def main():
+        assert await state.acquire_slot("upstream", "crashed", limit=1, ttl=0.05)
+        assert not await state.acquire_slot("upstream", "next", limit=1, ttl=30)
+        await asyncio.sleep(0.1)
+        assert await state.slot_count("upstream") == 0
+        assert await state.acquire_slot("upstream", "next", limit=1, ttl=30)
+
+    asyncio.run(main())
+
+
+def test_token_buckets_are_shared(make_state):
+    worker_a, worker_b = make_state(), make_state()
+
+    async def main():
+        assert await worker_a.take_tokens("generate:alice", 0.001, 8, 4) == (4, 0.0)
+        tokens, wait = await worker_b.take_tokens("generate:alice", 0.001, 8, 4)
+        assert tokens == pytest.approx(0, abs=0.01) and wait == 0
+        tokens, wait = await worker_a.take_tokens("generate:alice", 0.001, 8, 1)
+        assert wait > 900
+        await worker_b.refund_tokens("generate:alice", 0.001, 8, 4)
+        tokens, wait = await worker_a.take_tokens("generate:alice", 0.001, 8, 4)
+        assert wait == 0
+        # Another client's bucket is untouched
+        assert await worker_a.take_tokens("generate:bob", 0.001, 8, 1) == (7, 0.0)
+
+    asyncio.run(main())
+
+
+def test_cooldowns_keep_the_latest_end(make_state):
+    worker_a, worker_b = make_state(), make_state()
+    now = time.time()
+
+    async def main():
+        await worker_a.set_cooldown("keys", "k1", now + 60)
+        await worker_b.set_cooldown("keys", "k1", now + 10)
+        await worker_b.set_cooldown("keys", "k2", now - 1)
+        assert await worker_b.cooldowns("keys") == {"k1": now + 60}
+
+    asyncio.run(main())
+
+
+def test_json_documents_expire(make_state):
+    worker_a, worker_b = make_state(), make_state()
+
+    async def main():
+        await worker_a.set_json("job:1", {"status": "done", "n": [1, 2]}, ttl=30)
+        await worker_a.set_json("job:2", {"status": "done"}, ttl=0.05)
+        assert await worker_b.get_json("job:1") == {"status": "done", "n": [1, 2]}
+        await asyncio.sleep(0.1)
+        assert await worker_b.get_json("job:2") is None
+        assert await worker_b.get_json("missing") is None
+
+    asyncio.run(main())
+
+
+def test_incomplete_backend_fails_when_created():
+    class SlotsOnly(SharedState):
+        async def acquire_slot(self, name, holder, limit, ttl):
+            return True
+
+    with pytest.raises(TypeError):
+        SlotsOnly()